@@ -25,6 +25,9 @@ class CircularAperture(field_processing.MultiplicativeFieldProcessor):
         self.spider_wane_width = float(spider_wane_width)
         self.spider_wane_halfwidth = self.spider_wane_width/2
 
+    def get_parameters(self):
+        return (self.diameter, self.inner_diameter, self.spider_wane_width)
+
     def compute_blocking_mask(self):
         '''
         Constructs a modulation field representing the shape of the aperture.
@@ -32,10 +35,12 @@ class CircularAperture(field_processing.MultiplicativeFieldProcessor):
         normalized_x_coordinates, normalized_y_coordinates = self.grid.get_coordinate_meshes_within_window()
         squared_normalized_distances = self.grid.compute_squared_distances_within_window()
 
+        wavelengths = self.get_wavelengths_in_slice()
+
         # Construct grids in spatial units by multiplying with wavelength
-        abs_x_coordinates = np.multiply.outer(self.wavelengths, np.abs(normalized_x_coordinates))
-        abs_y_coordinates = np.multiply.outer(self.wavelengths, np.abs(normalized_y_coordinates))
-        squared_distances = np.multiply.outer(self.wavelengths**2, squared_normalized_distances)
+        abs_x_coordinates = np.multiply.outer(wavelengths, np.abs(normalized_x_coordinates))
+        abs_y_coordinates = np.multiply.outer(wavelengths, np.abs(normalized_y_coordinates))
+        squared_distances = np.multiply.outer(wavelengths**2, squared_normalized_distances)
 
         blocking_mask = np.logical_and.reduce((squared_distances <= self.squared_radius,
                                                squared_distances >= self.squared_inner_radius,
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+# This file is part of the APSimulator API.
+# Author: Lars Frogner
+import numpy as np
+import os
+import tempfile
+import profiling_utils
+
+
+cache_directory = None # Directory holding the cached arrays (caching is disabled when None)
+max_cache_size = None # Maximum total number of bytes of the cached arrays before the least recently used ones are evicted
+
+cache_file_extension = '.npy'
+
+
+def enable_cache(directory, max_size=2*1024**3):
+    '''
+    Enables the on-disk cache of arrays in the given directory, which is created if it does not exist.
+    The cache is content-addressed, so the same directory can be shared by separate runs and
+    processes. When the total size of the cached arrays exceeds max_size bytes, the least
+    recently used arrays are evicted.
+    '''
+    global cache_directory, max_cache_size
+    assert int(max_size) > 0
+    cache_directory = os.path.abspath(os.path.expanduser(str(directory)))
+    max_cache_size = int(max_size)
+    os.makedirs(cache_directory, exist_ok=True)
+    evict_least_recently_used()
+
+
+def disable_cache():
+    '''
+    Stops using the cache. Cached arrays are kept on disk.
+    '''
+    global cache_directory, max_cache_size
+    cache_directory = None
+    max_cache_size = None
+
+
+def cache_is_enabled():
+    return cache_directory is not None
+
+
+def get_cache_path(key):
+    return os.path.join(cache_directory, str(key) + cache_file_extension)
+
+
+def load_array(key, mmap_mode='r'):
+    '''
+    Returns the cached array with the given key, or None if it is not in the cache. By default the
+    array is memory mapped read-only, so only the parts that are used are read from disk.
+    '''
+    if not cache_is_enabled():
+        return None
+
+    path = get_cache_path(key)
+    try:
+        # Mark the array as recently used
+        os.utime(path)
+        values = np.load(path, mmap_mode=mmap_mode, allow_pickle=False)
+    except FileNotFoundError:
+        profiling_utils.increment_counter('cache_utils.misses')
+        return None
+    except (OSError, ValueError):
+        # Treat an unreadable file (for example from an interrupted write by another process) as a miss
+        remove_file(path)
+        profiling_utils.increment_counter('cache_utils.misses')
+        return None
+
+    profiling_utils.increment_counter('cache_utils.hits')
+    return values
+
+
+def store_array(key, values):
+    '''
+    Writes the given array to the cache under the given key, and evicts the least recently used
+    arrays if the cache has grown too large. Arrays larger than the maximum cache size are not stored.
+    '''
+    if not cache_is_enabled() or values.nbytes > max_cache_size:
+        return
+
+    # Write to a temporary file first so that other processes never see a partially written array
+    with tempfile.NamedTemporaryFile(dir=cache_directory, suffix='.tmp', delete=False) as temporary_file:
+        np.save(temporary_file, np.asarray(values), allow_pickle=False)
+    os.replace(temporary_file.name, get_cache_path(key))
+
+    profiling_utils.increment_counter('cache_utils.stored_bytes', values.nbytes)
+
+    evict_least_recently_used()
+
+
+def get_cached_files():
+    '''
+    Returns a list of (last use time, size, path) tuples for all the cached arrays.
+    '''
+    cached_files = []
+    for entry in os.scandir(cache_directory):
+        if entry.name.endswith(cache_file_extension):
+            try:
+                status = entry.stat()
+            except FileNotFoundError:
+                continue
+            cached_files.append((status.st_mtime, status.st_size, entry.path))
+    return cached_files
+
+
+def get_cache_size():
+    return sum(size for _, size, _ in get_cached_files()) if cache_is_enabled() else 0
+
+
+def evict_least_recently_used():
+    '''
+    Removes the least recently used arrays until the total size of the cache is within the maximum size.
+    '''
+    if not cache_is_enabled():
+        return
+
+    cached_files = sorted(get_cached_files())
+    total_size = sum(size for _, size, _ in cached_files)
+
+    for _, size, path in cached_files:
+        if total_size <= max_cache_size:
+            break
+        remove_file(path)
+        total_size -= size
+        profiling_utils.increment_counter('cache_utils.evictions')
+
+
+def clear_cache():
+    if cache_is_enabled():
+        for _, _, path in get_cached_files():
+            remove_file(path)
+
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        # The file may already have been removed by another process, or still be open elsewhere
+        pass
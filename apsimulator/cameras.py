@@ -2,16 +2,19 @@
 # This file is part of the APSimulator API.
 # Author: Lars Frogner
 import numpy as np
+import fields
 import filters
+import parallel_utils
 
 
 class Camera:
 
-    def __init__(self, gain=1, quantum_efficiency=1, filter_set=[], seed=None):
+    def __init__(self, gain=1, quantum_efficiency=1, filter_set=[], seed=None, sampling_backend='serial'):
         self.set_gain(gain)
         self.set_filter_set(filter_set)
         self.set_quantum_efficiency(quantum_efficiency)
         self.set_seed(seed)
+        self.set_sampling_backend(sampling_backend) # How to parallelize the sampling of photon counts
         self.has_signal_field = False
         self.has_captured_signal_field = False
 
@@ -41,6 +44,17 @@ class Camera:
         self.seed = None if seed is None else int(seed)
         self.random_generator = np.random.RandomState(seed=self.seed)
 
+    def set_sampling_backend(self, sampling_backend):
+        '''
+        With 'serial', the photon counts of all channels are sampled with the random generator of the
+        camera. With 'threads' or 'processes', the channels are sampled in parallel with the given
+        backend of parallel_utils.parallelize_over_axis, each with a generator seeded from the camera
+        generator. The sampled counts then do not depend on the number of workers. Sampling holds the
+        global interpreter lock, so only 'processes' gives a speedup.
+        '''
+        assert sampling_backend in ('serial', 'threads', 'processes')
+        self.sampling_backend = sampling_backend
+
     def compute_signal_field(self, image_field, use_memmap=False):
         '''
         The camera signal field is the spatial distribution of photon rates
@@ -57,13 +71,60 @@ class Camera:
         self.signal_field = self.filter_set_with_quantum_efficiency.compute_filtered_image_field(image_field, convert_to_photon_rates=True, use_memmap=use_memmap)
         self.has_signal_field = True
 
-    def compute_captured_signal_field(self, exposure_time, use_memmap=False):
+    def initialize_signal_field(self, grid, wavelengths, dtype='float64', use_memmap=False):
+        '''
+        Initializes a zero signal field on the given image grid, to which image fields for consecutive
+        ranges of the given wavelengths can be added with add_to_signal_field.
+        '''
+        self.filter_set_with_quantum_efficiency = self.filter_set.copy_with_added_filter_on_top(self.quantum_efficiency)
+        self.signal_integration_weights = self.filter_set_with_quantum_efficiency.compute_integration_weights(wavelengths, convert_to_photon_rates=True)
+        self.signal_field = self.filter_set_with_quantum_efficiency.create_filtered_image_field(grid, dtype=dtype, use_memmap=use_memmap)
+        self.has_signal_field = True
+
+    def add_to_signal_field(self, image_field, wavelength_slice):
+        '''
+        Adds the photon rates from the given image field, containing the given slice of the wavelengths
+        that the signal field was initialized with, to the signal field.
+        '''
+        assert self.has_signal_field
+        self.filter_set_with_quantum_efficiency.add_to_filtered_image_field(self.signal_field, image_field,
+                                                                            self.signal_integration_weights[:, wavelength_slice])
+
+    def compute_captured_signal_field(self, exposure_time, use_memmap=False, use_lazy_expression=False):
         '''
         The captured signal field has units of photons/pixel.
+        With serial sampling, the mean photon counts are computed block by block as they are
+        sampled, instead of being stored in a full-size field first. With use_lazy_expression=True,
+        the blocks are evaluated through a lazy expression (see fields.LazyFieldExpression).
+        The sampled counts are the same either way.
         '''
         assert self.has_signal_field
-        self.captured_signal_field = self.signal_field.multiplied(exposure_time*self.pixel_area, use_memmap=use_memmap)
-        self.captured_signal_field.set_values(self.random_generator.poisson(lam=self.captured_signal_field.values), copy=False)
+        if self.sampling_backend == 'serial':
+            mean_photon_counts = self.signal_field.multiplied(exposure_time*self.pixel_area, lazy=True) if use_lazy_expression else None
+            self.captured_signal_field = fields.FilteredSpectralField(*self.signal_field.create_constructor_argument_list(),
+                                                                      initial_value=None,
+                                                                      dtype=np.int_,
+                                                                      use_memmap=use_memmap)
+            # Blocks of single channels are visited in memory order, so consecutive draws consume the random
+            # stream in the same order as a single draw for all the values
+            for block_indices, signal_values in self.signal_field.generate_blocks(n_wavelengths_per_block=1):
+                block_mean_photon_counts = signal_values*(exposure_time*self.pixel_area) if mean_photon_counts is None else mean_photon_counts[block_indices]
+                self.captured_signal_field.values[block_indices] = self.random_generator.poisson(lam=block_mean_photon_counts)
+        else:
+            # Compute the mean photon counts directly into shared memory when sampling in worker processes
+            if self.sampling_backend == 'processes':
+                mean_photon_counts = parallel_utils.create_shared_array(self.signal_field.shape, self.signal_field.dtype)
+            else:
+                mean_photon_counts = np.empty(self.signal_field.shape, dtype=self.signal_field.dtype)
+            np.multiply(self.signal_field.values, exposure_time*self.pixel_area, out=mean_photon_counts)
+
+            channel_seeds = self.random_generator.randint(0, 2**31 - 1, size=self.signal_field.n_channels)
+            photon_counts = parallel_utils.parallel_poisson(mean_photon_counts, channel_seeds, backend=self.sampling_backend)
+
+            self.captured_signal_field = fields.FilteredSpectralField(*self.signal_field.create_constructor_argument_list(),
+                                                                      initial_value=photon_counts,
+                                                                      use_memmap=use_memmap,
+                                                                      copy_initial_array=False)
         self.has_captured_signal_field = True
 
     def get_signal_field(self):
@@ -77,6 +138,9 @@ class Camera:
     def get_gain(self):
         return self.gain
 
+    def get_sampling_backend(self):
+        return self.sampling_backend
+
     def get_quantum_efficiency(self):
         return self.quantum_efficiency
 
@@ -0,0 +1,557 @@
+# -*- coding: utf-8 -*-
+# This file is part of the APSimulator API.
+# Author: Lars Frogner
+import numpy as np
+import scipy.fft
+import os
+import pickle
+import threading
+import collections
+import io_utils
+
+try:
+    import pyfftw
+    import pyfftw.builders
+except ImportError:
+    pyfftw = None
+
+
+available_backends = ('numpy', 'scipy') if pyfftw is None else ('numpy', 'scipy', 'pyfftw')
+
+backend = None
+
+pyfftw_planner_effort = 'FFTW_MEASURE' # How hard FFTW should work to find a fast plan the first time a transform shape is seen
+pyfftw_wisdom_path = io_utils.get_path_relative_to_root('fftw_wisdom.pickle') # Where accumulated FFTW wisdom is stored between runs
+has_loaded_pyfftw_wisdom = False
+
+max_plans = 64 # Largest number of cached transform plans kept (the least recently used are discarded first)
+plans = collections.OrderedDict() # Cached transform plans, keyed by backend, transform kind, shapes, dtype, thread count and calling thread
+centering_checkerboards = {} # Cached sign patterns used for centered transforms, keyed by shape and dtype
+transform_matrices = {} # Cached DFT matrices and phase ramps for windowed transforms
+plan_lock = threading.Lock()
+
+
+def set_backend(backend_argument='auto'):
+    '''
+    Selects the library used for computing FFTs. If backend='auto', the fastest
+    available library is used (pyFFTW if installed, otherwise scipy.fft).
+    Selecting pyFFTW loads any previously saved FFTW wisdom, so that plans for
+    transform shapes seen in earlier runs can be created without measuring again.
+    '''
+    global backend
+    if backend_argument == 'auto':
+        backend_argument = available_backends[-1]
+    assert backend_argument in available_backends
+    backend = backend_argument
+    if backend == 'pyfftw' and not has_loaded_pyfftw_wisdom:
+        load_pyfftw_wisdom()
+
+
+def get_backend():
+    return backend
+
+
+def has_native_threading():
+    '''
+    Whether the current backend can distribute a single transform call over several threads
+    by itself.
+    '''
+    return backend != 'numpy'
+
+
+def set_pyfftw_planner_effort(planner_effort):
+    global pyfftw_planner_effort
+    assert planner_effort in ('FFTW_ESTIMATE', 'FFTW_MEASURE', 'FFTW_PATIENT', 'FFTW_EXHAUSTIVE')
+    pyfftw_planner_effort = planner_effort
+    clear_plans()
+
+
+def set_pyfftw_wisdom_path(wisdom_path):
+    global pyfftw_wisdom_path
+    pyfftw_wisdom_path = str(wisdom_path)
+
+
+def load_pyfftw_wisdom(wisdom_path=None):
+    '''
+    Imports FFTW wisdom from the given file (or the default wisdom file). Returns whether
+    any wisdom was imported.
+    '''
+    global has_loaded_pyfftw_wisdom
+    if pyfftw is None:
+        return False
+    wisdom_path = pyfftw_wisdom_path if wisdom_path is None else wisdom_path
+    has_loaded_pyfftw_wisdom = True
+    if not os.path.isfile(wisdom_path):
+        return False
+    with open(wisdom_path, 'rb') as f:
+        pyfftw.import_wisdom(pickle.load(f))
+    return True
+
+
+def save_pyfftw_wisdom(wisdom_path=None):
+    '''
+    Exports the FFTW wisdom accumulated so far to the given file (or the default wisdom file),
+    so that later runs can skip planning for the same transform shapes.
+    '''
+    if pyfftw is None:
+        return
+    wisdom_path = pyfftw_wisdom_path if wisdom_path is None else wisdom_path
+    with open(wisdom_path, 'wb') as f:
+        pickle.dump(pyfftw.export_wisdom(), f)
+
+
+def clear_plans():
+    with plan_lock:
+        plans.clear()
+
+
+def set_max_plans(max_number_of_plans):
+    '''
+    Sets the largest number of transform plans to keep cached. FFTW plans hold buffers and are cached
+    per calling thread, so the limit keeps plans of threads that have finished from accumulating.
+    When the limit is reached, the least recently used plans are discarded. With None, all plans are kept.
+    '''
+    global max_plans
+    with plan_lock:
+        max_plans = None if max_number_of_plans is None else int(max_number_of_plans)
+        assert max_plans is None or max_plans > 0
+        discard_least_recently_used_plans()
+
+
+def get_max_plans():
+    return max_plans
+
+
+def discard_least_recently_used_plans():
+    while max_plans is not None and len(plans) > max_plans:
+        plans.popitem(last=False)
+
+
+def create_pyfftw_plan(kind, input_shape, input_dtype, output_shape, axes, threads, overwrite_input):
+    input_array = pyfftw.empty_aligned(input_shape, dtype=input_dtype)
+    builder_kwargs = dict(axes=axes, threads=threads, planner_effort=pyfftw_planner_effort, auto_align_input=True)
+    if kind == 'irfft':
+        # Multidimensional complex-to-real FFTW transforms always overwrite their input
+        return pyfftw.builders.irfftn(input_array, s=[output_shape[axis] for axis in axes], **builder_kwargs)
+    else:
+        builder = {'fft': pyfftw.builders.fftn, 'ifft': pyfftw.builders.ifftn, 'rfft': pyfftw.builders.rfftn}[kind]
+        return builder(input_array, overwrite_input=overwrite_input, **builder_kwargs)
+
+
+def create_plan(kind, input_shape, input_dtype, output_shape, axes, threads, overwrite_input):
+    '''
+    Creates a callable computing the given kind of transform over the given axes for inputs of the
+    given shape and dtype. The callable writes the result into the output array if one is given.
+    '''
+    s = [output_shape[axis] for axis in axes] if kind == 'irfft' else None
+
+    if backend == 'pyfftw':
+        fftw_object = create_pyfftw_plan(kind, input_shape, input_dtype, output_shape, axes, threads, overwrite_input)
+        # The FFTW object reuses its output buffer, so the result must be copied out before the next call
+        def plan(values, output_values=None):
+            return fftw_object(values).copy() if output_values is None else store_result(fftw_object(values), output_values)
+
+    elif backend == 'scipy':
+        function = getattr(scipy.fft, kind + 'n')
+        def plan(values, output_values=None):
+            return store_result(function(values, s=s, axes=axes, workers=threads, overwrite_x=overwrite_input), output_values)
+
+    else:
+        function = getattr(np.fft, kind + 'n')
+        def plan(values, output_values=None):
+            return store_result(function(values, s=s, axes=axes), output_values)
+
+    return plan
+
+
+def store_result(result, output_values):
+    if output_values is None or result is output_values:
+        return result
+    output_values[:] = result
+    return output_values
+
+
+def get_plan(kind, input_shape, input_dtype, output_shape=None, axes=(-2, -1), threads=1, overwrite_input=False):
+    '''
+    Returns a cached plan for the given kind of transform ('fft', 'ifft', 'rfft' or 'irfft'),
+    creating it if necessary. FFTW plans carry internal buffers, so they are additionally cached
+    per calling thread. At most max_plans plans are kept (see set_max_plans).
+    '''
+    thread_id = threading.get_ident() if backend == 'pyfftw' else None
+    key = (backend, kind, tuple(input_shape), np.dtype(input_dtype).str, None if output_shape is None else tuple(output_shape),
+           tuple(axes), threads, overwrite_input, thread_id)
+    with plan_lock:
+        plan = plans.get(key)
+        if plan is not None:
+            plans.move_to_end(key)
+    if plan is None:
+        plan = create_plan(kind, input_shape, input_dtype, output_shape, tuple(axes), threads, overwrite_input)
+        with plan_lock:
+            plans[key] = plan
+            discard_least_recently_used_plans()
+    return plan
+
+
+def fft(values, axis=-1, inverse=False, output_values=None, overwrite_input=False, threads=1):
+    '''
+    Computes the (inverse) 1D FFT along the given axis of the given array.
+    '''
+    plan = get_plan('ifft' if inverse else 'fft', values.shape, values.dtype, axes=(axis,), threads=threads, overwrite_input=overwrite_input)
+    return plan(values, output_values=output_values)
+
+
+def fft2(values, inverse=False, output_values=None, overwrite_input=False, threads=1):
+    '''
+    Computes the (inverse) 2D FFT over the last two axes of the given array. If an output array
+    is given, the result is written into it. The output array may be the input array itself.
+    '''
+    plan = get_plan('ifft' if inverse else 'fft', values.shape, values.dtype, threads=threads, overwrite_input=overwrite_input)
+    return plan(values, output_values=output_values)
+
+
+def has_even_size(shape):
+    return shape[-2] % 2 == 0 and shape[-1] % 2 == 0
+
+
+def get_centering_checkerboards(shape, dtype):
+    '''
+    Returns the arrays that the input and output of an FFT over the last two axes of the given shape
+    must be multiplied with in order to obtain the transform of centered values, without shifting the
+    arrays. For even sizes N_x and N_y, the centered transform is
+
+        X[k_x, k_y] = (-1)^(N_x/2 + N_y/2)*(-1)^(k_x + k_y)*FFT((-1)^(n_x + n_y)*x[n_x, n_y])[k_x, k_y],
+
+    so the input is multiplied with the checkerboard (-1)^(n_x + n_y) and the output with the same
+    checkerboard times the global sign. The same relation holds for the inverse transform.
+    '''
+    assert has_even_size(shape)
+    real_dtype = np.finfo(np.dtype(dtype)).dtype
+    key = (tuple(shape[-2:]), real_dtype.str)
+    checkerboards = centering_checkerboards.get(key)
+    if checkerboards is None:
+        size_x, size_y = shape[-2:]
+        input_checkerboard = np.where((np.arange(size_x)[:, np.newaxis] + np.arange(size_y)[np.newaxis, :]) % 2 == 0, 1, -1).astype(real_dtype)
+        output_checkerboard = input_checkerboard if (size_x//2 + size_y//2) % 2 == 0 else -input_checkerboard
+        checkerboards = (input_checkerboard, output_checkerboard)
+        with plan_lock:
+            centering_checkerboards[key] = checkerboards
+    return checkerboards
+
+
+def centered_fft2(values, inverse=False, output_values=None, threads=1):
+    '''
+    Computes the (inverse) 2D FFT over the last two axes of the given array, where the origin is in the
+    center of the array for both the input and the output. For even sizes, this is done without
+    shifting the arrays, by multiplying with checkerboards of alternating signs. The result is
+    written into the output array if one is given, and the transform is done in place in it.
+    '''
+    if not has_even_size(values.shape):
+        shifted_values = np.fft.ifftshift(values, axes=(-2, -1))
+        fourier_coefficients = np.fft.fftshift(fft2(shifted_values, inverse=inverse, overwrite_input=True, threads=threads), axes=(-2, -1))
+        return store_result(fourier_coefficients, output_values)
+
+    input_checkerboard, output_checkerboard = get_centering_checkerboards(values.shape, values.dtype)
+
+    if output_values is None:
+        output_values = np.empty(values.shape, dtype=np.result_type(values.dtype, np.complex64))
+
+    np.multiply(values, input_checkerboard, out=output_values)
+    fft2(output_values, inverse=inverse, output_values=output_values, overwrite_input=True, threads=threads)
+    output_values *= output_checkerboard
+
+    return output_values
+
+
+def rfft2(values, threads=1):
+    '''
+    Computes the 2D FFT over the last two axes of the given real array, returning only the
+    non-redundant half of the last axis.
+    '''
+    plan = get_plan('rfft', values.shape, values.dtype, threads=threads)
+    return plan(values)
+
+
+def irfft2(values, shape, threads=1):
+    '''
+    Computes the real inverse of rfft2, where the given shape is the shape of the real output.
+    The input array may be overwritten.
+    '''
+    plan = get_plan('irfft', values.shape, values.dtype, output_shape=shape, threads=threads, overwrite_input=True)
+    return plan(values)
+
+
+def compute_convolution_shape(values_shape, kernel_shape):
+    '''
+    Determines the shape of the zero padded arrays needed for computing the linear convolution
+    of arrays with the given (last two) shapes with FFTs, rounded up to sizes that transform fast.
+    '''
+    return tuple(scipy.fft.next_fast_len(values_size + kernel_size - 1, real=True)
+                 for values_size, kernel_size in zip(values_shape[-2:], kernel_shape[-2:]))
+
+
+def zero_pad(values, padded_shape):
+    padded_values = np.zeros((*values.shape[:-2], *padded_shape), dtype=values.dtype)
+    padded_values[..., :values.shape[-2], :values.shape[-1]] = values
+    return padded_values
+
+
+def compute_kernel_spectrum(kernel, convolution_shape, threads=1):
+    '''
+    Computes the Fourier transform of the given real kernel zero padded to the given convolution shape.
+    '''
+    return rfft2(zero_pad(kernel, convolution_shape), threads=threads)
+
+
+def convolve_with_kernel_spectrum(values, kernel_spectrum, kernel_shape, convolution_shape, threads=1):
+    '''
+    Convolves the given real array with the kernel whose padded spectrum is given, returning the
+    central part of the convolution with the same shape as the input array (like mode='same'
+    in scipy.signal.fftconvolve).
+    '''
+    full_shape = [values_size + kernel_size - 1 for values_size, kernel_size in zip(values.shape[-2:], kernel_shape[-2:])]
+    start_x = (full_shape[0] - values.shape[-2])//2
+    start_y = (full_shape[1] - values.shape[-1])//2
+
+    padded_values = zero_pad(values, convolution_shape)
+    convolved_values = irfft2(rfft2(padded_values, threads=threads)*kernel_spectrum, padded_values.shape, threads=threads)
+
+    return convolved_values[..., start_x:start_x+values.shape[-2], start_y:start_y+values.shape[-1]]
+
+
+def fftconvolve(values, kernel, threads=1):
+    '''
+    Computes the convolution of the given real array with the given real kernel over the last two
+    axes, returning an array with the same shape as the input array.
+    '''
+    convolution_shape = compute_convolution_shape(values.shape, kernel.shape)
+    kernel_spectrum = compute_kernel_spectrum(kernel, convolution_shape, threads=threads)
+    return convolve_with_kernel_spectrum(values, kernel_spectrum, kernel.shape, convolution_shape, threads=threads)
+
+
+def compute_periodic_kernel_spectrum(kernel, threads=1):
+    '''
+    Computes the Fourier transform of the given real periodic kernel, whose origin is in the center
+    of the array, for use with correlate_with_periodic_kernel_spectrum.
+    '''
+    return rfft2(np.fft.ifftshift(kernel, axes=(-2, -1)), threads=threads)
+
+
+def correlate_with_periodic_kernel_spectrum(values, kernel_spectrum, threads=1):
+    '''
+    Computes the periodic cross-correlation sum_n values[n]*kernel[n + m] over the last two axes of
+    the given real array, where the kernel has the same shape as the array and its spectrum is given.
+    The returned array is indexed like the given one.
+    '''
+    return irfft2(np.conj(rfft2(values, threads=threads))*kernel_spectrum, values.shape[-2:], threads=threads)
+
+
+def compute_centered_dft_phases(size, output_numbers, input_numbers, shift, inverse):
+    '''
+    Computes the phases 2*pi*(k - shift)*(n - shift)/size (with negative sign for the forward
+    transform) for the given output and input index arrays. The products are reduced modulo
+    the size using integer arithmetic to keep the phases accurate for large grids.
+    '''
+    sign = 1 if inverse else -1
+    products = np.multiply.outer(np.asarray(output_numbers) - shift, np.asarray(input_numbers) - shift) % size
+    return (sign*2*np.pi/size)*products
+
+
+def get_pruned_fft_phase_ramps(size, input_range, output_range, shift, inverse, dtype):
+    '''
+    Returns the phase factors that the input and output of an ordinary FFT of the given size must be
+    multiplied with to obtain a transform whose origin is shifted by the given number of indices
+    in both the input and output. Only the factors for the given input and output index ranges
+    are returned. The normalization of the inverse transform is left to the FFT.
+    '''
+    key = ('ramps', size, input_range.start, input_range.end, output_range.start, output_range.end, shift, inverse, np.dtype(dtype).str)
+    phase_ramps = transform_matrices.get(key)
+    if phase_ramps is None:
+        # exp(i*phase*(k - s)*(n - s)) = exp(i*phase*s*s)*exp(-i*phase*k*s)*exp(-i*phase*n*s)*exp(i*phase*k*n)
+        input_phases = -compute_centered_dft_phases(size, [shift], np.arange(input_range.start, input_range.end), 0, inverse)[0]
+        output_phases = compute_centered_dft_phases(size, [shift], [shift], 0, inverse)[0, 0] - \
+                        compute_centered_dft_phases(size, np.arange(output_range.start, output_range.end), [shift], 0, inverse)[:, 0]
+        phase_ramps = (np.exp(1j*input_phases).astype(dtype), np.exp(1j*output_phases).astype(dtype))
+        with plan_lock:
+            transform_matrices[key] = phase_ramps
+    return phase_ramps
+
+
+def pruned_fft(values, axis, size, input_range, output_range, shift=0, inverse=False, threads=1):
+    '''
+    Computes the (inverse) 1D FFT along the given axis of a signal of the given size that is zero
+    outside the given input index range, where the given values are the ones inside the range.
+    Only the Fourier coefficients inside the given output index range are returned. The origin of
+    both the signal and the spectrum is shifted by the given number of indices.
+    '''
+    complex_dtype = np.result_type(values.dtype, np.complex64)
+    input_phase_ramp, output_phase_ramp = get_pruned_fft_phase_ramps(size, input_range, output_range, shift, inverse, complex_dtype)
+
+    ramp_shape = [1]*values.ndim
+    ramp_shape[axis] = -1
+
+    padded_shape = list(values.shape)
+    padded_shape[axis] = size
+    padded_values = np.zeros(padded_shape, dtype=complex_dtype)
+
+    input_slices = [slice(None)]*values.ndim
+    input_slices[axis] = slice(input_range.start, input_range.end)
+    np.multiply(values, input_phase_ramp.reshape(ramp_shape), out=padded_values[tuple(input_slices)])
+
+    fourier_coefficients = fft(padded_values, axis=axis, inverse=inverse, output_values=padded_values, overwrite_input=True, threads=threads)
+
+    output_slices = [slice(None)]*values.ndim
+    output_slices[axis] = slice(output_range.start, output_range.end)
+    return fourier_coefficients[tuple(output_slices)]*output_phase_ramp.reshape(ramp_shape)
+
+
+def compute_fft_cost(size):
+    return 5*size*np.log2(max(size, 2))
+
+
+def estimate_pruned_fft2_costs(shape, input_window, output_window):
+    '''
+    Estimates the number of floating point operations required for a pruned 2D FFT when transforming
+    along the x-axis first and along the y-axis first, respectively.
+    '''
+    size_x, size_y = shape[-2:]
+    x_first_cost = input_window.size_y*compute_fft_cost(size_x) + output_window.size_x*compute_fft_cost(size_y)
+    y_first_cost = input_window.size_x*compute_fft_cost(size_y) + output_window.size_y*compute_fft_cost(size_x)
+    return x_first_cost, y_first_cost
+
+
+def estimate_matrix_fourier_transform_costs(input_window, output_window):
+    '''
+    Estimates the number of floating point operations required for a matrix Fourier transform when
+    multiplying with the x-matrix first and the y-matrix first, respectively.
+    '''
+    x_first_cost = 8*output_window.size_x*input_window.size_y*(input_window.size_x + output_window.size_y)
+    y_first_cost = 8*input_window.size_x*output_window.size_y*(input_window.size_y + output_window.size_x)
+    return x_first_cost, y_first_cost
+
+
+def estimate_windowed_transform_costs(shape, input_window, output_window):
+    '''
+    Estimates the number of floating point operations for each way of computing the windowed
+    part of a 2D transform of an array that is zero outside a window.
+    '''
+    return {'fft': compute_fft_cost(shape[-2]*shape[-1]),
+            'pruned': min(estimate_pruned_fft2_costs(shape, input_window, output_window)),
+            'matrix': min(estimate_matrix_fourier_transform_costs(input_window, output_window))}
+
+
+def select_windowed_transform_method(shape, input_window, output_window):
+    costs = estimate_windowed_transform_costs(shape, input_window, output_window)
+    return min(costs, key=costs.get)
+
+
+def pruned_fft2(window_values, shape, input_window, output_window, centered=True, inverse=False, threads=1):
+    '''
+    Computes the Fourier coefficients inside the given output window of the (inverse) 2D FFT of an array
+    of the given shape that is zero outside the given input window. The window_values argument holds
+    the values inside the input window. Only the rows with nonzero input are transformed along the
+    first axis, and only the columns inside the output window are transformed along the second,
+    in the order that requires the least work.
+    '''
+    size_x, size_y = shape[-2:]
+    shift_x = size_x//2 if centered else 0
+    shift_y = size_y//2 if centered else 0
+
+    x_first_cost, y_first_cost = estimate_pruned_fft2_costs(shape, input_window, output_window)
+
+    if x_first_cost <= y_first_cost:
+        partial_coefficients = pruned_fft(window_values, -2, size_x, input_window.x, output_window.x, shift=shift_x, inverse=inverse, threads=threads)
+        return pruned_fft(partial_coefficients, -1, size_y, input_window.y, output_window.y, shift=shift_y, inverse=inverse, threads=threads)
+    else:
+        partial_coefficients = pruned_fft(window_values, -1, size_y, input_window.y, output_window.y, shift=shift_y, inverse=inverse, threads=threads)
+        return pruned_fft(partial_coefficients, -2, size_x, input_window.x, output_window.x, shift=shift_x, inverse=inverse, threads=threads)
+
+
+def get_dft_matrix(size, input_range, output_range, shift, inverse, dtype):
+    '''
+    Returns the matrix mapping the signal values inside the given input index range to the Fourier
+    coefficients inside the given output index range, for a (shifted) DFT of the given size.
+    '''
+    key = ('matrix', size, input_range.start, input_range.end, output_range.start, output_range.end, shift, inverse, np.dtype(dtype).str)
+    dft_matrix = transform_matrices.get(key)
+    if dft_matrix is None:
+        phases = compute_centered_dft_phases(size,
+                                             np.arange(output_range.start, output_range.end),
+                                             np.arange(input_range.start, input_range.end),
+                                             shift, inverse)
+        dft_matrix = np.exp(1j*phases)
+        if inverse:
+            dft_matrix /= size
+        dft_matrix = dft_matrix.astype(dtype)
+        with plan_lock:
+            transform_matrices[key] = dft_matrix
+    return dft_matrix
+
+
+def matrix_fourier_transform(window_values, shape, input_window, output_window, centered=True, inverse=False):
+    '''
+    Computes the same as pruned_fft2, but by multiplying the window values with DFT matrices for each
+    axis. This is faster than FFTs when both windows are small compared to the full grid.
+    '''
+    size_x, size_y = shape[-2:]
+    shift_x = size_x//2 if centered else 0
+    shift_y = size_y//2 if centered else 0
+    complex_dtype = np.result_type(window_values.dtype, np.complex64)
+
+    matrix_x = get_dft_matrix(size_x, input_window.x, output_window.x, shift_x, inverse, complex_dtype)
+    matrix_y = get_dft_matrix(size_y, input_window.y, output_window.y, shift_y, inverse, complex_dtype)
+
+    x_first_cost, y_first_cost = estimate_matrix_fourier_transform_costs(input_window, output_window)
+
+    if x_first_cost <= y_first_cost:
+        return np.matmul(np.matmul(matrix_x, window_values), matrix_y.T)
+    else:
+        return np.matmul(matrix_x, np.matmul(window_values, matrix_y.T))
+
+
+def compute_point_source_phase_factors(size, output_range, positions, shift, inverse, dtype):
+    '''
+    Returns the matrix of phase factors mapping the values at the given (not necessarily integer)
+    positions along an axis to the Fourier coefficients inside the given output index range, for
+    a (shifted) DFT of the given size.
+    '''
+    phases = compute_centered_dft_phases(size, np.arange(output_range.start, output_range.end), positions, shift, inverse)
+    phase_factors = np.exp(1j*phases)
+    if inverse:
+        phase_factors /= size
+    return phase_factors.astype(dtype)
+
+
+def point_source_fourier_transform(x_positions, y_positions, amplitudes, shape, output_window, centered=True, inverse=False, max_block_size=2**22):
+    '''
+    Computes the Fourier coefficients inside the given output window of the (inverse) 2D DFT of an array
+    of the given shape that is zero except at a set of points. The x- and y-positions of the points are
+    given in grid indices and need not be integers, so this is a direct non-uniform DFT. The amplitudes
+    array has shape (n_slices, n_points), and a transform is computed for each slice. The cost scales
+    with the number of points rather than with the size of the grid. The points are processed in blocks
+    so that the phase factor matrices have at most about max_block_size elements.
+    '''
+    size_x, size_y = shape[-2:]
+    shift_x = size_x//2 if centered else 0
+    shift_y = size_y//2 if centered else 0
+    complex_dtype = np.result_type(amplitudes.dtype, np.complex64)
+
+    x_positions = np.asarray(x_positions)
+    y_positions = np.asarray(y_positions)
+    n_points_per_block = max(1, max_block_size//max(output_window.size_x, output_window.size_y))
+
+    fourier_coefficients = np.zeros((amplitudes.shape[0], *output_window.shape), dtype=complex_dtype)
+
+    for start_idx in range(0, x_positions.size, n_points_per_block):
+        block = slice(start_idx, start_idx + n_points_per_block)
+
+        phase_factors_x = compute_point_source_phase_factors(size_x, output_window.x, x_positions[block], shift_x, inverse, complex_dtype)
+        phase_factors_y = compute_point_source_phase_factors(size_y, output_window.y, y_positions[block], shift_y, inverse, complex_dtype)
+
+        for idx in range(amplitudes.shape[0]):
+            # Sum the contributions of the points one slice at a time to limit the size of the temporary arrays
+            fourier_coefficients[idx, :, :] += np.matmul(phase_factors_x*amplitudes[idx, np.newaxis, block], phase_factors_y.T)
+
+    return fourier_coefficients
+
+
+set_backend('auto')
@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+# This file is part of the APSimulator API.
+# Author: Lars Frogner
+import numpy as np
+import os
+import json
+import zipfile
+import tempfile
+import grids
+import fields
+import profiling_utils
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+
+available_formats = ('npz',) if h5py is None else ('hdf5', 'npz')
+
+file_extensions = {'.h5': 'hdf5', '.hdf5': 'hdf5', '.npz': 'npz'}
+
+compression_level = 4 # Level of the deflate compression applied to each chunk (0 means no compression)
+chunk_size = 1024**2 # Maximum number of bytes of field values in each chunk
+
+field_classes = {field_class.__name__: field_class for field_class in (fields.Regular2DField,
+                                                                       fields.SpectralField,
+                                                                       fields.FilteredSpectralField,
+                                                                       fields.UniformSpectralField)}
+
+
+def set_compression_level(level):
+    global compression_level
+    assert 0 <= int(level) <= 9
+    compression_level = int(level)
+
+
+def set_chunk_size(n_bytes):
+    global chunk_size
+    assert int(n_bytes) > 0
+    chunk_size = int(n_bytes)
+
+
+def determine_file_format(path, file_format=None):
+    '''
+    Returns the file format to use for the given path. If no format is given, it is determined by
+    the file extension, using HDF5 for .h5 and .hdf5 files and chunked NPZ archives otherwise.
+    '''
+    if file_format is None:
+        file_format = file_extensions.get(os.path.splitext(str(path))[1].lower(), 'npz')
+    assert file_format in ('hdf5', 'npz')
+    if file_format == 'hdf5' and h5py is None:
+        raise ImportError('Writing and reading HDF5 files requires h5py')
+    return file_format
+
+
+def compute_chunk_shape(field):
+    '''
+    Returns the shape of the chunks the stored values of the given field are divided into. For spectral
+    fields, each chunk holds a single wavelength, so that wavelength ranges can be read on their own.
+    The spatial tiles are squares spanning at most chunk_size bytes.
+    '''
+    storage_shape = field.storage_shape
+    tile_size = max(1, int(np.sqrt(chunk_size//field.dtype.itemsize)))
+    tile_shape = (min(storage_shape[-2], tile_size), min(storage_shape[-1], tile_size))
+    return (1, *tile_shape) if len(storage_shape) == 3 else tile_shape
+
+
+def create_grid_metadata(grid):
+    if isinstance(grid, grids.FFTGrid):
+        metadata = {'grid_class': 'FFTGrid',
+                    'size_exponent_x': grid.size_exponent_x,
+                    'size_exponent_y': grid.size_exponent_y,
+                    'is_centered': grid.is_centered}
+    else:
+        metadata = {'grid_class': 'Regular2DGrid',
+                    'size_x': grid.size_x,
+                    'size_y': grid.size_y,
+                    'shift_x': grid.shift_x,
+                    'shift_y': grid.shift_y}
+    metadata.update({'extent_x': grid.extent_x,
+                     'extent_y': grid.extent_y,
+                     'grid_type': grid.grid_type,
+                     'window': create_window_metadata(grid.window)})
+    return metadata
+
+
+def create_grid_from_metadata(metadata):
+    if metadata['grid_class'] == 'FFTGrid':
+        grid = grids.FFTGrid(metadata['size_exponent_x'], metadata['size_exponent_y'], metadata['extent_x'], metadata['extent_y'],
+                             is_centered=metadata['is_centered'],
+                             grid_type=metadata['grid_type'])
+    else:
+        grid = grids.Regular2DGrid(metadata['size_x'], metadata['size_y'], metadata['extent_x'], metadata['extent_y'],
+                                   shift_x=metadata['shift_x'], shift_y=metadata['shift_y'],
+                                   grid_type=metadata['grid_type'])
+    grid.window = create_window_from_metadata(metadata['window'])
+    return grid
+
+
+def create_window_metadata(window):
+    return [window.x.start, window.x.end, window.y.start, window.y.end]
+
+
+def create_window_from_metadata(metadata):
+    return grids.IndexRange2D(*metadata)
+
+
+def create_field_metadata(field):
+    '''
+    Returns a JSON serializable dictionary with everything except the values needed to recreate the
+    given field.
+    '''
+    assert field.__class__.__name__ in field_classes
+    padding_value = complex(field.padding_value)
+    metadata = {'field_class': field.__class__.__name__,
+                'grid': create_grid_metadata(field.grid),
+                'dtype': field.dtype.str,
+                'storage_shape': list(field.storage_shape),
+                'chunk_shape': list(compute_chunk_shape(field)),
+                'window_only': field.window_only,
+                'storage_window': create_window_metadata(field.storage_window) if field.window_only else None,
+                'padding_value': [padding_value.real, padding_value.imag]}
+    if isinstance(field, fields.SpectralField):
+        metadata['wavelengths'] = field.wavelengths.tolist()
+    if isinstance(field, fields.FilteredSpectralField):
+        metadata['filter_labels'] = field.filter_labels
+    return metadata
+
+
+def write_field(field, path, file_format=None):
+    '''
+    Writes the values of the given field together with its grid, grid window, wavelengths and storage
+    mode to the given path. The values are divided into compressed chunks (see compute_chunk_shape),
+    so that wavelength ranges and windows can later be read without decompressing the whole file.
+    Only the stored values are written, so window-only fields only write their window. The values are
+    written one chunk at a time, so memory mapped fields are never read into memory at once. The file
+    is first written under a temporary name, so an existing file is only replaced by a complete one.
+    '''
+    file_format = determine_file_format(path, file_format=file_format)
+    metadata = create_field_metadata(field)
+    chunk_shape = tuple(metadata['chunk_shape'])
+
+    path = os.path.abspath(os.path.expanduser(str(path)))
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), suffix='.tmp', delete=False) as temporary_file:
+        temporary_path = temporary_file.name
+
+    with profiling_utils.timed('field_io.write_field'):
+        try:
+            if file_format == 'hdf5':
+                write_hdf5_file(temporary_path, field, metadata, chunk_shape)
+            else:
+                write_npz_file(temporary_path, field, metadata, chunk_shape)
+            os.replace(temporary_path, path)
+        except BaseException:
+            os.remove(temporary_path)
+            raise
+
+    profiling_utils.increment_counter('field_io.written_bytes', field.values.nbytes)
+
+
+def write_hdf5_file(path, field, metadata, chunk_shape):
+    with h5py.File(path, 'w') as output_file:
+        dataset = output_file.create_dataset('values', shape=field.storage_shape, dtype=field.dtype, chunks=chunk_shape,
+                                             compression=('gzip' if compression_level > 0 else None),
+                                             compression_opts=(compression_level if compression_level > 0 else None),
+                                             shuffle=(compression_level > 0))
+        dataset.attrs['metadata'] = json.dumps(metadata)
+        for chunk_indices, chunk_values in field.generate_blocks(n_wavelengths_per_block=1, tile_shape=chunk_shape[-2:]):
+            dataset[chunk_indices] = chunk_values
+
+
+def write_npz_file(path, field, metadata, chunk_shape):
+    compression = zipfile.ZIP_DEFLATED if compression_level > 0 else zipfile.ZIP_STORED
+    with zipfile.ZipFile(path, 'w', compression=compression, compresslevel=(compression_level if compression_level > 0 else None), allowZip64=True) as archive:
+        write_npz_member(archive, 'metadata', np.array(json.dumps(metadata)))
+        for chunk_indices, chunk_values in field.generate_blocks(n_wavelengths_per_block=1, tile_shape=chunk_shape[-2:]):
+            write_npz_member(archive, get_npz_chunk_name(chunk_indices, chunk_shape), chunk_values)
+
+
+def write_npz_member(archive, name, values):
+    with archive.open(name + '.npy', 'w', force_zip64=True) as member:
+        np.lib.format.write_array(member, np.ascontiguousarray(values), allow_pickle=False)
+
+
+def get_npz_chunk_name(chunk_indices, chunk_shape):
+    return 'chunk_' + '_'.join(str(index.start//length) for index, length in zip(chunk_indices, chunk_shape))
+
+
+def read_metadata(path, file_format=None):
+    '''
+    Returns the dictionary of metadata written together with the field values in the given file.
+    '''
+    file_format = determine_file_format(path, file_format=file_format)
+    if file_format == 'hdf5':
+        with h5py.File(path, 'r') as input_file:
+            return json.loads(input_file['values'].attrs['metadata'])
+    else:
+        with np.load(path, allow_pickle=False) as archive:
+            return json.loads(archive['metadata'].item())
+
+
+def find_wavelength_slice(metadata, wavelength_range=None):
+    '''
+    Returns the slice of the stored wavelengths lying within the given (inclusive) range of
+    wavelengths. The wavelengths within the range must be contiguous.
+    '''
+    if 'wavelengths' not in metadata or wavelength_range is None:
+        return slice(None)
+    assert len(wavelength_range) == 2
+    wavelengths = np.asarray(metadata['wavelengths'])
+    included_indices = np.nonzero(np.logical_and(wavelengths >= wavelength_range[0], wavelengths <= wavelength_range[1]))[0]
+    assert included_indices.size > 0
+    assert included_indices[-1] - included_indices[0] + 1 == included_indices.size
+    return slice(included_indices[0], included_indices[-1] + 1)
+
+
+def find_storage_indices(metadata, wavelength_slice, window=None):
+    '''
+    Returns the index tuple selecting the given wavelengths and grid window (an IndexRange2D for the
+    grid of the field) from the stored values. The window must lie inside the stored window.
+    '''
+    storage_shape = metadata['storage_shape']
+    has_wavelengths = len(storage_shape) == 3
+    if window is None or metadata['field_class'] == 'UniformSpectralField':
+        spatial_indices = (slice(None), slice(None))
+    else:
+        storage_window = create_window_from_metadata(metadata['storage_window']) if metadata['window_only'] else grids.IndexRange2D(0, storage_shape[-2], 0, storage_shape[-1])
+        assert storage_window.x.start <= window.x.start <= window.x.end <= storage_window.x.end
+        assert storage_window.y.start <= window.y.start <= window.y.end <= storage_window.y.end
+        spatial_indices = (slice(window.x.start - storage_window.x.start, window.x.end - storage_window.x.start),
+                           slice(window.y.start - storage_window.y.start, window.y.end - storage_window.y.start))
+    return (wavelength_slice, *spatial_indices) if has_wavelengths else spatial_indices
+
+
+def read_values_into(path, file_format, metadata, indices, output_values):
+    '''
+    Copies the stored values selected by the given index tuple (of slices) into the given array,
+    reading only the chunks overlapping the selection.
+    '''
+    storage_shape = metadata['storage_shape']
+    ranges = [index.indices(size)[:2] for index, size in zip(indices, storage_shape)]
+
+    if file_format == 'hdf5':
+        with h5py.File(path, 'r') as input_file:
+            input_file['values'].read_direct(output_values, source_sel=tuple(slice(start, end) for start, end in ranges))
+        return
+
+    chunk_shape = metadata['chunk_shape']
+    chunk_number_ranges = [range(start//length, (end + length - 1)//length) for (start, end), length in zip(ranges, chunk_shape)]
+    with np.load(path, allow_pickle=False) as archive:
+        for chunk_numbers in np.ndindex(*[len(number_range) for number_range in chunk_number_ranges]):
+            chunk_numbers = [number_range[idx] for number_range, idx in zip(chunk_number_ranges, chunk_numbers)]
+            chunk_values = archive['chunk_' + '_'.join(str(number) for number in chunk_numbers)]
+            chunk_indices = []
+            output_indices = []
+            for number, length, (start, end) in zip(chunk_numbers, chunk_shape, ranges):
+                chunk_start = number*length
+                overlap_start = max(start, chunk_start)
+                overlap_end = min(end, chunk_start + length)
+                chunk_indices.append(slice(overlap_start - chunk_start, overlap_end - chunk_start))
+                output_indices.append(slice(overlap_start - start, overlap_end - start))
+            output_values[tuple(output_indices)] = chunk_values[tuple(chunk_indices)]
+
+
+def read_values(path, wavelength_range=None, window=None, file_format=None):
+    '''
+    Returns an array with the stored field values in the given file, optionally limited to the given
+    (inclusive) range of wavelengths and the given window (an IndexRange2D for the grid of the field).
+    Only the chunks overlapping the selection are read.
+    '''
+    file_format = determine_file_format(path, file_format=file_format)
+    metadata = read_metadata(path, file_format=file_format)
+    indices = find_storage_indices(metadata, find_wavelength_slice(metadata, wavelength_range=wavelength_range), window=window)
+    output_shape = tuple(len(range(*index.indices(size))) for index, size in zip(indices, metadata['storage_shape']))
+    values = np.empty(output_shape, dtype=np.dtype(metadata['dtype']))
+    read_values_into(path, file_format, metadata, indices, values)
+    return values
+
+
+def read_field(path, wavelength_range=None, window=None, use_memmap=False, memmap_name=None, file_format=None):
+    '''
+    Recreates the field written to the given file, optionally limited to the given (inclusive) range
+    of wavelengths and the given window (an IndexRange2D for the grid of the field). Only the chunks
+    overlapping the selection are read. The field gets a new grid equal to the original one.
+    If a window is given, or the written field only stored its window values, the returned field only
+    stores the values inside the window that was read, and the grid window is set to that window.
+    The window is ignored for spatially uniform fields.
+    '''
+    file_format = determine_file_format(path, file_format=file_format)
+    metadata = read_metadata(path, file_format=file_format)
+    field_class = field_classes[metadata['field_class']]
+    dtype = np.dtype(metadata['dtype'])
+
+    grid = create_grid_from_metadata(metadata['grid'])
+    window_only = metadata['window_only']
+    if field_class is not fields.UniformSpectralField and (window is not None or window_only):
+        grid.window = create_window_from_metadata(metadata['storage_window']) if window is None else \
+                      grids.IndexRange2D(window.x.start, window.x.end, window.y.start, window.y.end)
+        window_only = True
+
+    wavelength_slice = find_wavelength_slice(metadata, wavelength_range=wavelength_range)
+    constructor_arguments = [grid]
+    if 'wavelengths' in metadata:
+        constructor_arguments.append(np.asarray(metadata['wavelengths'])[wavelength_slice])
+    if 'filter_labels' in metadata:
+        constructor_arguments.append(metadata['filter_labels'][wavelength_slice])
+
+    padding_value = complex(*metadata['padding_value']) if dtype.kind == 'c' else metadata['padding_value'][0]
+
+    with profiling_utils.timed('field_io.read_field'):
+        field = field_class(*constructor_arguments, initial_value=None, dtype=dtype, use_memmap=use_memmap, memmap_name=memmap_name,
+                            window_only=window_only, padding_value=padding_value)
+        read_values_into(path, file_format, metadata, find_storage_indices(metadata, wavelength_slice, window=grid.window if window_only else None), field.values)
+
+    profiling_utils.increment_counter('field_io.read_bytes', field.values.nbytes)
+    return field
@@ -3,7 +3,11 @@
 # Author: Lars Frogner
 import numpy as np
 import collections
+import hashlib
 import fields
+import profiling_utils
+import parallel_utils
+import cache_utils
 
 
 class FieldProcessor:
@@ -24,6 +28,8 @@ class FieldProcessor:
         assert(self.wavelengths.ndim == 1)
         self.n_wavelengths = self.wavelengths.size
 
+        self.set_wavelength_slice(None)
+
         # Run possible additional precomputations
         self.precompute_processing_quantities()
 
@@ -34,12 +40,67 @@ class FieldProcessor:
         '''
         return None
 
+    def set_wavelength_slice(self, wavelength_slice):
+        '''
+        Specifies the slice of the wavelengths of the unprocessed field that the fields given to
+        the process method will contain. If None, the fields contain all the wavelengths.
+        Processors with wavelength dependent quantities must only apply the part of the quantities
+        corresponding to this slice.
+        '''
+        self.wavelength_slice = slice(0, self.n_wavelengths) if wavelength_slice is None else wavelength_slice
+
+    def get_wavelengths_in_slice(self):
+        return self.wavelengths[self.wavelength_slice]
+
+    def begin_wavelength_chunks(self):
+        '''
+        Called before a series of fields covering consecutive wavelength slices is processed. Processors
+        that draw random realizations should draw one here and reuse it for every slice, so that all
+        wavelengths see the same realization.
+        '''
+        return None
+
+    def end_wavelength_chunks(self):
+        '''
+        Called after the last wavelength slice has been processed.
+        '''
+        self.set_wavelength_slice(None)
+
     def process(self, field):
         '''
         Should apply the physical process to the given SpectralField object, updating its values.
+        The values array may be modified directly, since the pipeline makes sure it is not shared
+        with other fields.
         '''
         raise NotImplementedError
 
+    def get_parameters(self):
+        '''
+        Should return a tuple of all the parameters (numbers, strings, arrays or tuples of these) that
+        determine the result of the process, so that the pipeline can detect when the result has to be
+        recomputed, so the parameters must determine the result completely for as long as the processor
+        is in use. Processors drawing a realization once should include what identifies it, like the seed.
+        Processors drawing a new realization every time they are applied must return None. The default
+        value None means that the process must always be reapplied.
+        '''
+        return None
+
+    def is_deterministic(self):
+        '''
+        Whether the result of the process is fully determined by the reported parameters, so that it can
+        be shared with other runs through the cache in cache_utils. Processors whose parameters identify
+        a realization that can not be reproduced, like one drawn without a seed, should override this
+        to return False. Their results are then never looked up in or written to the cache.
+        '''
+        return True
+
+    def is_spatially_uniform(self):
+        '''
+        Whether the process acts the same way on every grid cell, so that its process field only needs
+        a single value per wavelength. This can be overridden to return True for such processes.
+        '''
+        return False
+
     def can_create_process_field(self):
         '''
         Whether the process is independent of the values of the input field, so that a field
@@ -60,15 +121,23 @@ class LinearFieldProcessor(FieldProcessor):
     identity field, which can be stored. This "process field" can then be applied to an arbitrary
     field, with the result being the same as if the process was applied directly to the field.
     '''
+    def get_process_field_class(self):
+        '''
+        Returns the field class used for process fields, which only stores a single value per
+        wavelength for spatially uniform processes.
+        '''
+        return fields.UniformSpectralField if self.is_spatially_uniform() else fields.SpectralField
+
     def create_identity_field_with_value(self, identity_value, use_memmap):
         '''
         Creates a SpectralField object with values corresponding to the identity value of
-        the linear process. This can be used to generate a process field.
+        the linear process. This can be used to generate a process field. The small fields
+        of spatially uniform processes are never memory mapped.
         '''
-        return fields.SpectralField(self.grid, self.wavelengths,
-                                    dtype=self.dtype,
-                                    initial_value=identity_value,
-                                    use_memmap=use_memmap)
+        return self.get_process_field_class()(self.grid, self.wavelengths,
+                                              dtype=self.dtype,
+                                              initial_value=identity_value,
+                                              use_memmap=(use_memmap and not self.is_spatially_uniform()))
 
     def create_process_field(self, use_memmap=True):
         '''
@@ -96,7 +165,7 @@ class MultiplicativeFieldProcessor(LinearFieldProcessor):
         return self.create_identity_field_with_value(1, use_memmap)
 
     def apply_process_field(self, field, process_field):
-        field.multiply_within_window(process_field.values)
+        field.multiply_within_window(process_field.get_values_inside_window())
 
 
 class AdditiveFieldProcessor(LinearFieldProcessor):
@@ -105,7 +174,23 @@ class AdditiveFieldProcessor(LinearFieldProcessor):
         return self.create_identity_field_with_value(0, use_memmap)
 
     def apply_process_field(self, field, process_field):
-        field.add_within_window(process_field.values)
+        field.add_within_window(process_field.get_values_inside_window())
+
+
+class PointSourceFieldProcessor(AdditiveFieldProcessor):
+    '''
+    Additive process that adds flux to a set of single grid cells, like the stars of a star field.
+    Besides being added to a field, the point sources can be obtained as a list of positions and
+    spectral fluxes, so that the dense field can be skipped when only point sources are present.
+    '''
+    def compute_point_sources(self):
+        '''
+        Should return arrays with the x- and y-indices of the grid cells holding the point sources,
+        and an array of shape (n_wavelengths_in_slice, n_point_sources) with their spectral fluxes
+        for the wavelengths in the current wavelength slice. Each grid cell should occur at most once,
+        with the flux it would get when the process is applied to a field.
+        '''
+        raise NotImplementedError
 
 
 class FieldProcessingPipelineStage:
@@ -125,15 +210,178 @@ class FieldProcessingPipelineStage:
 
         self.process_field = None
         self.has_stored_process_field = False
+        self.process_field_fingerprint = None # Parameter fingerprint of the processor when the process field was created
+
+        self.output_snapshot = None # Copy of the pipeline field right after this stage was applied (if the pipeline is incremental)
+        self.output_fingerprint = None # Fingerprint identifying the content of the output snapshot
+
+    def get_parameter_fingerprint(self):
+        '''
+        Returns a fingerprint of the processor parameters and the properties of the field the processor
+        was initialized for, or None if the processor does not report its parameters.
+        '''
+        parameters = self.field_processor.get_parameters()
+        if parameters is None:
+            return None
+        grid = self.field_processor.grid
+        return compute_fingerprint((self.field_processor.__class__.__name__, parameters,
+                                    self.field_processor.wavelengths, self.field_processor.dtype.str,
+                                    grid.shape, grid.extent_x, grid.extent_y,
+                                    grid.window.x.start, grid.window.x.end, grid.window.y.start, grid.window.y.end))
+
+    def get_cache_fingerprint(self):
+        '''
+        Returns the parameter fingerprint if the result of the processor can be cached, and None otherwise.
+        '''
+        return self.get_parameter_fingerprint() if self.field_processor.is_deterministic() else None
+
+    def process(self, field, wavelength_slice=None, input_fingerprint=None, process_field=None):
+        '''
+        Applies the process to the given field. If a wavelength slice is given, the field is
+        assumed to only contain the wavelengths in that slice. If a process field generated with
+        generate_process_field is given, it is applied instead.
+
+        If the cache in cache_utils is enabled, the results of processors reporting their parameters
+        are loaded from the cache when available, and stored in it otherwise, unless the processor is
+        not deterministic. For linear processors, the process field is cached. For other processors,
+        the processed field is cached, provided that a fingerprint identifying the values of the input
+        field is given and all wavelengths are processed at once.
+
+        When only a wavelength slice is processed, a process field is only used if an up to date one
+        is already stored or cached, since creating it would require all the wavelengths at once.
+        '''
+        if process_field is None:
+            if wavelength_slice is None:
+                process_field = self.get_process_field()
+            else:
+                process_field = self.find_existing_process_field() if self.uses_process_field() else None
+
+        if process_field is not None:
+            if wavelength_slice is not None:
+                process_field = process_field.get_wavelength_slice_field(wavelength_slice)
+            self.field_processor.apply_process_field(field, process_field)
+            return
+
+        output_cache_key = self.get_output_cache_key(input_fingerprint) if wavelength_slice is None else None
+
+        if output_cache_key is not None:
+            cached_values = cache_utils.load_array(output_cache_key)
+            if cached_values is not None and cached_values.shape == field.values.shape and cached_values.dtype == field.dtype:
+                field.set_values(cached_values, copy=True)
+                return
+
+        self.field_processor.set_wavelength_slice(wavelength_slice)
+        # Processors may modify the values array directly, so it must not be shared with other fields
+        field.prepare_for_modification()
+        self.field_processor.process(field)
+
+        if output_cache_key is not None:
+            cache_utils.store_array(output_cache_key, field.values)
+
+    def uses_process_field(self):
+        '''
+        Whether the process is applied through a process field, which is the case if it is stored or
+        can be cached.
+        '''
+        return self.field_processor.can_create_process_field() and \
+               (self.store_process_field or (cache_utils.cache_is_enabled() and self.get_cache_fingerprint() is not None))
+
+    def get_process_field(self):
+        '''
+        Returns the process field to apply, or None if the process should be applied directly. A process
+        field is used if it is stored or if it can be cached, and is recreated (or loaded from the cache)
+        when the parameters of the processor change.
+        '''
+        if not self.uses_process_field():
+            return None
+
+        process_field = self.find_existing_process_field()
+
+        if process_field is None:
+            process_field = self.generate_process_field()
+            self.keep_process_field(process_field)
+
+        return process_field
+
+    def find_existing_process_field(self):
+        '''
+        Returns the stored process field, or the one in the cache, if it is up to date with the
+        parameters of the processor. Otherwise None is returned.
+        '''
+        parameter_fingerprint = self.get_parameter_fingerprint()
+
+        if self.has_stored_process_field and (parameter_fingerprint is None or parameter_fingerprint == self.process_field_fingerprint):
+            return self.process_field
+
+        process_field = None
+        cache_fingerprint = self.get_cache_fingerprint()
+
+        if cache_utils.cache_is_enabled() and cache_fingerprint is not None:
+            cached_values = cache_utils.load_array(compute_fingerprint(('process field', cache_fingerprint)))
+            if cached_values is not None:
+                # The cached values are memory mapped read-only, which is sufficient for applying them
+                process_field = self.field_processor.get_process_field_class()(self.field_processor.grid, self.field_processor.wavelengths,
+                                                                               initial_value=cached_values,
+                                                                               copy_initial_array=False)
+                self.keep_process_field(process_field, store_in_cache=False)
+
+        return process_field
+
+    def generate_process_field(self, use_memmap=True):
+        '''
+        Applies the process to an identity field covering all the wavelengths and returns the resulting
+        process field. This does not depend on the field being processed, so process fields for
+        different stages can be generated concurrently.
+        '''
+        return generate_process_field(self.field_processor, use_memmap)
+
+    def keep_process_field(self, process_field, store_in_cache=True):
+        '''
+        Stores the given process field for the current processor parameters if process fields are
+        stored, and writes it to the cache if the cache is enabled and the processor is deterministic.
+        '''
+        parameter_fingerprint = self.get_parameter_fingerprint()
+        cache_fingerprint = self.get_cache_fingerprint()
+
+        if store_in_cache and cache_utils.cache_is_enabled() and cache_fingerprint is not None:
+            cache_utils.store_array(compute_fingerprint(('process field', cache_fingerprint)), process_field.values)
 
-    def process(self, field):
         if self.store_process_field:
-            if not self.has_stored_process_field:
-                self.process_field = self.field_processor.create_process_field()
-                self.has_stored_process_field = True
-            self.field_processor.apply_process_field(field, self.process_field)
-        else:
-            self.field_processor.process(field)
+            self.process_field = process_field
+            self.process_field_fingerprint = parameter_fingerprint
+            self.has_stored_process_field = True
+
+    def get_output_cache_key(self, input_fingerprint):
+        '''
+        Returns the key for caching the output of the process applied to an input field with the given
+        fingerprint, or None if the output can not be cached.
+        '''
+        if input_fingerprint is None or not cache_utils.cache_is_enabled():
+            return None
+        cache_fingerprint = self.get_cache_fingerprint()
+        return None if cache_fingerprint is None else compute_fingerprint(('processed field', input_fingerprint, cache_fingerprint))
+
+    def begin_wavelength_chunks(self):
+        self.field_processor.begin_wavelength_chunks()
+
+    def end_wavelength_chunks(self):
+        self.field_processor.end_wavelength_chunks()
+
+    def store_output_snapshot(self, field, output_fingerprint):
+        self.output_snapshot = field.copy()
+        self.output_fingerprint = output_fingerprint
+
+    def invalidate_output_snapshot(self):
+        self.output_snapshot = None
+        self.output_fingerprint = None
+
+    def invalidate_process_field(self):
+        self.process_field = None
+        self.has_stored_process_field = False
+        self.process_field_fingerprint = None
+
+    def has_valid_output_snapshot(self, output_fingerprint):
+        return self.output_snapshot is not None and output_fingerprint is not None and output_fingerprint == self.output_fingerprint
 
     def visualize_process_field(self, **plot_kwargs):
         assert self.has_stored_process_field
@@ -144,12 +392,60 @@ class FieldProcessingPipeline:
     '''
     Holds a set of FieldProcessor objects and allows for applying them to an initial
     field one by one in order to produce a processed field.
+
+    If the pipeline is incremental, the field after each stage is kept as a snapshot together
+    with a fingerprint of the original field and the parameters of all stages up to that point.
+    A new computation then resumes from the snapshot of the last stage preceding the first stage
+    whose fingerprint changed, at the cost of storing one field copy per stage. Stages whose
+    processors do not report their parameters (see FieldProcessor.get_parameters) are always
+    recomputed, as are all the stages if the fingerprint of the original field is unknown.
+
+    With a concurrent backend ('threads' or 'processes'), the process fields of the linear stages to
+    be applied are generated concurrently with parallel_utils.run_tasks_concurrently before the
+    stages are applied, each into its own buffer, since they do not depend on the field being
+    processed. The process fields are then applied one by one in the order of the stages, so the
+    result is the same as with sequential processing. This requires memory for one process field per
+    concurrently generated stage.
     '''
-    def __init__(self, original_field):
+    def __init__(self, original_field, label='pipeline', processed_memmap_name=None, incremental=False, concurrent_backend=None):
         assert isinstance(original_field, fields.SpectralField)
         self.original_field = original_field
+        self.label = str(label) # Name of the pipeline, used for identifying the stages when profiling
+        self.processed_memmap_name = processed_memmap_name # Name of the backing file for the processed field if it is memory mapped (anonymous if None)
         self.processed_field = self.original_field
         self.stages = collections.OrderedDict()
+        self.original_field_fingerprint = None # Fingerprint identifying the current values of the original field (None if unknown)
+        self.original_field_is_deterministic = True # Whether the original field values are reproducible from their fingerprint
+        self.processed_field_fingerprint = None # Fingerprint identifying the current values of the processed field (None if unknown)
+        self.set_incremental(incremental)
+        self.set_concurrent_backend(concurrent_backend)
+
+    def set_incremental(self, incremental):
+        self.incremental = bool(incremental)
+        if not self.incremental:
+            self.invalidate()
+
+    def set_concurrent_backend(self, concurrent_backend):
+        '''
+        Sets the backend used for generating the process fields of linear stages concurrently
+        ('threads' or 'processes'). With None, the stages are processed sequentially. With 'processes',
+        the processors must be picklable. The process fields are then generated by copies of the
+        processors, so random generators in the processors are not advanced. Seeded random processors
+        only give the same results as with sequential processing if they draw the same realization
+        every time (like sources.UniformStarField with fixed_realization=True).
+        '''
+        assert concurrent_backend in (None, 'threads', 'processes')
+        self.concurrent_backend = concurrent_backend
+
+    def set_original_field_fingerprint(self, original_field_fingerprint, is_deterministic=True):
+        '''
+        Specifies a fingerprint identifying the current values of the original field. It must be
+        updated (or set to None) whenever the original field is modified. If the values depend on
+        a realization that can not be reproduced, is_deterministic should be False, so that no
+        results derived from them are cached.
+        '''
+        self.original_field_fingerprint = original_field_fingerprint
+        self.original_field_is_deterministic = bool(is_deterministic)
 
     def add_field_processor(self, label, field_processor, store_process_field_if_possible=False):
         '''
@@ -164,10 +460,205 @@ class FieldProcessingPipeline:
         '''
         Computes the processed output field from all the field processors.
         '''
-        self.processed_field = self.original_field.copy()
+        if self.incremental:
+            self.compute_processed_field_incrementally()
+            return
+
+        self.processed_field = self.original_field.copy(memmap_name=self.processed_memmap_name)
+
+        input_fingerprints = self.compute_cacheable_input_fingerprints(self.compute_stage_output_fingerprints()) if cache_utils.cache_is_enabled() else [None]*len(self.stages)
+
+        process_fields = self.generate_process_fields_concurrently(list(self.stages.items()))
+
+        for (label, stage), input_fingerprint in zip(self.stages.items(), input_fingerprints):
+            with profiling_utils.timed(self.get_stage_timer_name(label)):
+                stage.process(self.processed_field, input_fingerprint=input_fingerprint, process_field=process_fields.get(label))
+
+        self.processed_field_fingerprint = None
+
+    def compute_processed_field_incrementally(self):
+        '''
+        Computes the processed output field, starting from the output snapshot of the last stage
+        preceding the first stage with a changed fingerprint.
+        '''
+        output_fingerprints = self.compute_stage_output_fingerprints()
+        stages = list(self.stages.items())
+
+        first_dirty_stage_idx = 0
+        while first_dirty_stage_idx < len(stages) and stages[first_dirty_stage_idx][1].has_valid_output_snapshot(output_fingerprints[first_dirty_stage_idx]):
+            first_dirty_stage_idx += 1
+
+        profiling_utils.increment_counter('{}.reused_stages'.format(self.label), first_dirty_stage_idx)
+
+        final_fingerprint = output_fingerprints[-1] if len(stages) > 0 else self.original_field_fingerprint
+
+        if first_dirty_stage_idx == len(stages) and len(stages) > 0:
+            # Every stage is up to date, so the processed field only has to be recreated if it has been replaced
+            if self.processed_field_fingerprint is None or self.processed_field_fingerprint != final_fingerprint:
+                self.processed_field = stages[-1][1].output_snapshot.copy(memmap_name=self.processed_memmap_name)
+                self.processed_field_fingerprint = final_fingerprint
+            return
+
+        starting_field = self.original_field if first_dirty_stage_idx == 0 else stages[first_dirty_stage_idx-1][1].output_snapshot
+        self.processed_field = starting_field.copy(memmap_name=self.processed_memmap_name)
+
+        process_fields = self.generate_process_fields_concurrently(stages[first_dirty_stage_idx:])
+        input_fingerprints = self.compute_cacheable_input_fingerprints(output_fingerprints)
+
+        for stage_idx in range(first_dirty_stage_idx, len(stages)):
+            label, stage = stages[stage_idx]
+            with profiling_utils.timed(self.get_stage_timer_name(label)):
+                stage.process(self.processed_field, input_fingerprint=input_fingerprints[stage_idx], process_field=process_fields.get(label))
+
+            if output_fingerprints[stage_idx] is None:
+                stage.invalidate_output_snapshot()
+            else:
+                stage.store_output_snapshot(self.processed_field, output_fingerprints[stage_idx])
+
+        self.processed_field_fingerprint = final_fingerprint
+
+    def generate_process_fields_concurrently(self, stages):
+        '''
+        Generates the process fields for the given (label, stage) pairs whose processors are linear and
+        that have no up to date stored or cached process field, running the stages concurrently with
+        the concurrent backend. Returns a dictionary of the generated process fields keyed by stage
+        label, which is empty if there is no concurrent backend or fewer than two stages to generate.
+        '''
+        if self.concurrent_backend is None or parallel_utils.get_number_of_threads() < 2 or parallel_utils.is_worker_thread():
+            return {}
+
+        labels = [label for label, stage in stages if stage.field_processor.can_create_process_field() and stage.find_existing_process_field() is None]
+        if len(labels) < 2:
+            return {}
+
+        # Process fields that are kept are memory mapped like when generated sequentially. Memory mapped
+        # values can not be returned from worker processes.
+        task_arguments = [(self.stages[label].field_processor, self.concurrent_backend == 'threads' and (self.stages[label].uses_process_field() or self.original_field.use_memmap))
+                          for label in labels]
+
+        with profiling_utils.timed('{}.generate_process_fields'.format(self.label)):
+            process_fields = parallel_utils.run_tasks_concurrently(generate_process_field, task_arguments, backend=self.concurrent_backend)
+
+        profiling_utils.increment_counter('{}.concurrent_stages'.format(self.label), len(labels))
+
+        for label, process_field in zip(labels, process_fields):
+            if self.stages[label].uses_process_field():
+                self.stages[label].keep_process_field(process_field)
+
+        return dict(zip(labels, process_fields))
+
+    def compute_stage_output_fingerprints(self):
+        '''
+        Returns a list with a fingerprint for the output of each stage, combining the fingerprint of the
+        original field with the parameter fingerprints of all stages up to and including the stage.
+        A fingerprint is None if any of the fingerprints it combines is unknown.
+        '''
+        output_fingerprints = []
+        fingerprint = self.original_field_fingerprint
+        for stage in self.stages.values():
+            parameter_fingerprint = stage.get_parameter_fingerprint()
+            fingerprint = None if (fingerprint is None or parameter_fingerprint is None) else compute_fingerprint((fingerprint, parameter_fingerprint))
+            output_fingerprints.append(fingerprint)
+        return output_fingerprints
+
+    def compute_cacheable_input_fingerprints(self, output_fingerprints):
+        '''
+        Returns a list with a fingerprint for the input of each stage, given the output fingerprints of
+        the stages, for use in cache keys. A fingerprint is None if the input depends on a processor
+        that is not deterministic, since results derived from it would never be looked up again.
+        '''
+        input_fingerprints = []
+        fingerprint = self.original_field_fingerprint if self.original_field_is_deterministic else None
+        for stage, output_fingerprint in zip(self.stages.values(), output_fingerprints):
+            input_fingerprints.append(fingerprint)
+            fingerprint = output_fingerprint if (fingerprint is not None and stage.field_processor.is_deterministic()) else None
+        return input_fingerprints
+
+    def has_deterministic_stages(self):
+        return all(stage.field_processor.is_deterministic() for stage in self.stages.values())
+
+    def has_deterministic_output(self):
+        '''
+        Whether the processed field is reproducible from its fingerprint, so that results derived from
+        it can be cached.
+        '''
+        return self.original_field_is_deterministic and self.has_deterministic_stages()
+
+    def compute_stage_parameter_fingerprints(self):
+        '''
+        Returns an ordered dictionary with the parameter fingerprint of each stage (None if the
+        processor does not report its parameters), keyed by the stage timer names.
+        '''
+        return collections.OrderedDict([(self.get_stage_timer_name(label), stage.get_parameter_fingerprint()) for label, stage in self.stages.items()])
+
+    def invalidate_stage(self, label):
+        '''
+        Makes the stage with the given label and all later stages be recomputed the next time the
+        processed field is computed, for example to draw a new realization of a random process.
+        Any stored process field for the stage is discarded as well.
+        '''
+        assert self.has_processor(label)
+        self.stages[label].invalidate_process_field()
+        is_after_invalidated_stage = False
+        for stage_label, stage in self.stages.items():
+            is_after_invalidated_stage = is_after_invalidated_stage or stage_label == label
+            if is_after_invalidated_stage:
+                stage.invalidate_output_snapshot()
+        self.processed_field_fingerprint = None
+
+    def invalidate(self):
+        '''
+        Discards all the stage snapshots, so that every stage is recomputed the next time.
+        '''
+        for stage in self.stages.values():
+            stage.invalidate_output_snapshot()
+        self.processed_field_fingerprint = None
+
+    def get_processed_field_fingerprint(self):
+        '''
+        Returns a fingerprint identifying the current values of the processed field, or None if
+        they can not be identified (for example when the pipeline is not incremental).
+        '''
+        return self.processed_field_fingerprint
+
+    def apply_stages_to_field(self, field):
+        '''
+        Applies all the stages in order to the given field, which must have the same grid and wavelengths
+        as the original field. The processed field and the stage snapshots are left untouched.
+        '''
+        for label, stage in self.stages.items():
+            with profiling_utils.timed(self.get_stage_timer_name(label)):
+                stage.process(field)
+
+    def begin_wavelength_chunks(self):
+        for stage in self.stages.values():
+            stage.begin_wavelength_chunks()
+
+    def compute_processed_wavelength_chunk(self, wavelength_slice, input_field=None):
+        '''
+        Computes the processed field for only the wavelengths in the given slice. Processing starts
+        from the given input field, which must contain exactly those wavelengths and is modified in
+        place. If no input field is given, the corresponding part of the original field is copied.
+        Calls must be enclosed by begin_wavelength_chunks and end_wavelength_chunks.
+        '''
+        if input_field is None:
+            input_field = self.original_field.get_wavelength_slice_field(wavelength_slice).copy()
+
+        assert input_field.n_wavelengths == wavelength_slice.stop - wavelength_slice.start
+
+        self.processed_field = input_field
+        self.processed_field_fingerprint = None
+
+        for label, stage in self.stages.items():
+            with profiling_utils.timed(self.get_stage_timer_name(label)):
+                stage.process(self.processed_field, wavelength_slice=wavelength_slice)
 
+    def end_wavelength_chunks(self):
         for stage in self.stages.values():
-            stage.process(self.processed_field)
+            stage.end_wavelength_chunks()
+
+    def get_stage_timer_name(self, label):
+        return '{}.{}'.format(self.label, label)
 
     def has_processor(self, label):
         return label in self.stages
@@ -176,6 +667,9 @@ class FieldProcessingPipeline:
         assert self.has_processor(label)
         return self.stages[label].field_processor
 
+    def get_processors(self):
+        return [stage.field_processor for stage in self.stages.values()]
+
     def get_original_field(self):
         return self.original_field
 
@@ -185,3 +679,51 @@ class FieldProcessingPipeline:
     def visualize_process_field(self, label, **plot_kwargs):
         assert self.has_processor(label)
         self.stages[label].visualize_process_field(**plot_kwargs)
+
+
+def generate_process_field(field_processor, use_memmap):
+    field_processor.set_wavelength_slice(None)
+    return field_processor.create_process_field(use_memmap=use_memmap)
+
+
+def combine_overlapping_point_sources(grid, x_indices, y_indices, spectral_fluxes):
+    '''
+    Sums the spectral fluxes of point sources in the same grid cell, and returns the x- and
+    y-indices and spectral fluxes of the resulting point sources.
+    '''
+    flat_indices = np.ravel_multi_index((x_indices, y_indices), grid.shape)
+    unique_flat_indices, inverse_indices = np.unique(flat_indices, return_inverse=True)
+
+    if unique_flat_indices.size == flat_indices.size:
+        return x_indices, y_indices, spectral_fluxes
+
+    combined_spectral_fluxes = np.zeros((spectral_fluxes.shape[0], unique_flat_indices.size), dtype=spectral_fluxes.dtype)
+    np.add.at(combined_spectral_fluxes, (slice(None), inverse_indices), spectral_fluxes)
+
+    combined_x_indices, combined_y_indices = np.unravel_index(unique_flat_indices, grid.shape)
+    return combined_x_indices, combined_y_indices, combined_spectral_fluxes
+
+
+def compute_fingerprint(quantities):
+    '''
+    Returns a hexadecimal digest identifying the given number, string, array or (possibly nested)
+    tuple or list of these.
+    '''
+    digest = hashlib.sha1()
+    update_fingerprint_digest(digest, quantities)
+    return digest.hexdigest()
+
+
+def update_fingerprint_digest(digest, quantity):
+    if isinstance(quantity, np.ndarray):
+        digest.update('array{}{}'.format(quantity.dtype.str, quantity.shape).encode())
+        digest.update(np.ascontiguousarray(quantity).tobytes())
+    elif isinstance(quantity, (tuple, list)):
+        digest.update(b'(')
+        for element in quantity:
+            update_fingerprint_digest(digest, element)
+            digest.update(b',')
+        digest.update(b')')
+    else:
+        # The representation of floats is exact, so equal representations imply equal values
+        digest.update('{}:{!r}'.format(quantity.__class__.__name__, quantity).encode())
@@ -2,25 +2,52 @@
 # This file is part of the APSimulator API.
 # Author: Lars Frogner
 import numpy as np
-import tempfile
+import weakref
 import grids
 import plot_utils
 import image_utils
 import parallel_utils
+import fft_utils
+import memmap_utils
+import profiling_utils
 
 
 class Regular2DField:
     '''
     Represents a 2D field, specified by a regular 2D grid and an array of field values on the grid.
+
+    With window_only=True, only the values inside the grid window are stored, and the values outside
+    the window are taken to be the constant padding value. The values attribute then only holds the
+    window values, and get_full_values must be used to obtain the values on the whole grid. Scalar
+    operations on the field also apply to the padding value, but array operands only act inside the
+    window, so the field must only be modified inside the window.
+
+    The values can be processed in blocks with bounded size, each covering a chunk of wavelengths
+    (for spectral fields) and a spatial tile, using generate_blocks.
+
+    Copies, window fields and channel fields share the values of the original field with copy-on-write
+    semantics: while shared, the values are read-only, and the first field to be modified gets its
+    own copy. Code modifying the values array directly rather than through the field methods must
+    call prepare_for_modification first. Fields can be passed directly to numpy and other libraries
+    accepting arrays, which then see the values without copying.
     '''
-    def __init__(self, grid, initial_value=0, dtype='float64', use_memmap=False, copy_initial_array=True):
+    block_size = 4*1024**2 # Default maximum number of bytes in each block yielded by generate_blocks
+
+    def __init__(self, grid, initial_value=0, dtype='float64', use_memmap=False, copy_initial_array=True, memmap_name=None,
+                 window_only=False, padding_value=0):
         self.grid = grid # Grid2D object representing the shape and physical dimensions of the field
         self.dtype = np.dtype(dtype) # Numpy data type to use for the field values
         self.use_memmap = bool(use_memmap) # Whether to store the field values in a memory mapped file
+        self.memmap_name = None if memmap_name is None else str(memmap_name) # Name of a persistent backing file in the memmap storage
+                                                                             # directory (see memmap_utils). If None, the file is anonymous.
         self.copy_initial_array = bool(copy_initial_array) # If initial_value is an array (or memmap), this specifies
                                                            # whether to copy the values or use a reference
+        self.window_only = bool(window_only) # Whether to only store the values inside the grid window
+        self.padding_value = padding_value # Value of the field outside the grid window if only the window values are stored
+        self.value_sharers = None # Set of the fields sharing the values array with copy-on-write semantics (None if not shared)
 
         self.initialize_shape()
+        self.initialize_storage_window()
         self.initialize_values(initial_value)
 
     def create_constructor_argument_list(self, **new_args):
@@ -28,45 +55,264 @@ class Regular2DField:
 
     def initialize_shape(self):
         self.shape = self.grid.shape
-        self.window_shape = self.grid.window.shape
 
-    def initialize_values(self, initial_value):
+    def initialize_storage_window(self):
+        '''
+        Records the grid window whose values are stored, if only the window values are stored.
+        '''
+        window = self.grid.window
+        self.storage_window = grids.IndexRange2D(window.x.start, window.x.end, window.y.start, window.y.end) if self.window_only else None
+
+    def get_shape_for_window(self, window):
+        return window.shape
+
+    @property
+    def window_shape(self):
+        # Derived from the grid on demand, since the grid window may be (re)defined after the field is created
+        return self.get_shape_for_window(self.grid.window)
+
+    @property
+    def storage_shape(self):
+        '''
+        Shape of the array of stored values.
+        '''
+        return self.get_shape_for_window(self.storage_window) if self.window_only else self.shape
+
+    def initialize_values(self, initial_value, copy_initial_array=None):
+
+        self.stop_sharing_values()
 
         has_initial_value = initial_value is not None
         inital_value_is_array = isinstance(initial_value, np.ndarray)
+        copy_initial_array = self.copy_initial_array if copy_initial_array is None else copy_initial_array
 
         if inital_value_is_array:
-            assert initial_value.shape == self.shape
+            assert initial_value.shape == self.shape or initial_value.shape == self.storage_shape
             self.dtype = initial_value.dtype # Change the data type to that of the initial array
+            # Only keep the window of a full initial array if only the window values are stored
+            initial_value = self.get_storage_view_of_array(initial_value)
         elif has_initial_value:
             initial_value = float(initial_value)
 
-        if self.use_memmap and not (inital_value_is_array and not self.copy_initial_array):
-            # Store the field values in a memory mapped file.
-            # It will automatically be deleted when the memmap object goes out of scope.
-            with tempfile.NamedTemporaryFile() as temporary_file:
-                self.values = np.memmap(temporary_file, shape=self.shape, dtype=self.dtype, mode='w+')
-            if has_initial_value:
-                self.values[:] = initial_value
+        if self.use_memmap and not (inital_value_is_array and not copy_initial_array):
+            # Store the field values in a memory mapped file in the memmap storage directory.
+            # An anonymous file will automatically be deleted when the memmap object goes out of scope,
+            # while a named file is kept so that it can be reopened with memmap_utils.open_memmap.
+            self.values = memmap_utils.create_memmap(self.storage_shape, self.dtype, name=self.memmap_name)
+            if has_initial_value and (inital_value_is_array or initial_value != 0):
+                # A newly created file already reads as zeros, so only other values have to be written
+                memmap_utils.fill_by_tiles(self.values, initial_value)
         else:
             if inital_value_is_array:
-                self.values = initial_value.copy() if self.copy_initial_array else initial_value
+                self.values = initial_value.copy() if copy_initial_array else initial_value
             elif has_initial_value:
-                # Initialize value array with constant number
-                self.values = np.full(self.shape, initial_value, dtype=self.dtype)
+                # Initialize value array with constant number. Zero-initialized arrays are allocated lazily,
+                # so parts of large fields that are never written to do not occupy memory.
+                self.values = np.zeros(self.storage_shape, dtype=self.dtype) if initial_value == 0 else np.full(self.storage_shape, initial_value, dtype=self.dtype)
             else:
-                self.values = np.empty(self.shape, dtype=self.dtype)
+                self.values = np.empty(self.storage_shape, dtype=self.dtype)
+
+    def set_window_only(self, window_only):
+        '''
+        Switches between storing the values on the whole grid and only the values inside the current
+        grid window. Values outside the window are discarded when only the window is stored, and
+        replaced with the padding value when the whole grid is stored again. This can also be used
+        to move the stored window after the grid window has been redefined.
+        '''
+        values = self.get_full_values()
+        if self.is_memmapped() and self.memmap_name is not None:
+            # The named backing file is recreated, so the values must not refer to it
+            values = np.array(values)
+        self.window_only = bool(window_only)
+        self.initialize_storage_window()
+        self.initialize_values(values, copy_initial_array=True)
+
+    def has_current_storage_window(self):
+        window = self.grid.window
+        return not self.window_only or (self.storage_window.x.start, self.storage_window.x.end, self.storage_window.y.start, self.storage_window.y.end) == \
+                                       (window.x.start, window.x.end, window.y.start, window.y.end)
+
+    def get_storage_view_of_array(self, values):
+        '''
+        Returns the part of the given array that corresponds to the stored values, if only the window
+        values are stored and the array covers the whole grid. Otherwise the array is returned as is.
+        '''
+        if self.window_only and isinstance(values, np.ndarray) and values.shape == self.shape and self.shape != self.storage_shape:
+            return self.get_window_view_of_array(values, window=self.storage_window)
+        return values
+
+    def get_full_values(self):
+        '''
+        Returns the values on the whole grid. If only the window values are stored, the padding is
+        materialized in a new array.
+        '''
+        if not self.window_only:
+            return self.values
+        full_values = np.full(self.shape, self.padding_value, dtype=self.dtype)
+        self.get_window_view_of_array(full_values, window=self.storage_window)[:] = self.values
+        return full_values
+
+    def create_field_with_values(self, values, padding_value=None, use_memmap=None, copy_values=False, memmap_name=None):
+        '''
+        Returns a new field of the same type and storage mode with the given (stored) values.
+        '''
+        return self.__class__(*self.create_constructor_argument_list(),
+                              initial_value=values,
+                              use_memmap=(self.use_memmap if use_memmap is None else use_memmap),
+                              copy_initial_array=copy_values,
+                              memmap_name=memmap_name,
+                              window_only=self.window_only,
+                              padding_value=(self.padding_value if padding_value is None else padding_value))
+
+    def compute_padding_value(self, function):
+        '''
+        Returns the result of applying the given elementwise function to the padding value.
+        '''
+        return np.asarray(function(np.full(1, self.padding_value, dtype=self.dtype)))[0].item()
+
+    def is_memmapped(self):
+        return isinstance(self.values, np.memmap)
+
+    def flush(self):
+        '''
+        Writes any modified field values to the backing file if the values are memory mapped.
+        '''
+        memmap_utils.flush(self.values)
+
+    def close(self):
+        '''
+        Flushes the field values and releases this field's reference to them. The mapping of a memory
+        mapped file is closed when no other views of the values remain. The field can not be used
+        after it has been closed.
+        '''
+        self.flush()
+        self.stop_sharing_values()
+        self.values = None
+
+    def __array__(self, dtype=None, copy=None):
+        '''
+        Exposes the values on the whole grid to numpy (and to libraries converting their input with
+        numpy.asarray) without copying them, unless only the window values are stored or a copy is
+        requested. Values shared with other fields are exposed read-only.
+        '''
+        return convert_for_array_protocol(self.get_full_values(), dtype, copy, is_new_array=self.window_only)
+
+    def __buffer__(self, flags):
+        # Buffer protocol support (Python 3.12+)
+        return memoryview(np.ascontiguousarray(self.get_full_values()))
+
+    def share_values_with(self, field):
+        '''
+        Lets the given field, whose values must be a view into the values of this field, share the values
+        with copy-on-write semantics. Returns the given field.
+        '''
+        if self.value_sharers is None:
+            self.value_sharers = weakref.WeakSet([self])
+            self.values = get_read_only_view(self.values)
+        field.values = get_read_only_view(field.values)
+        field.value_sharers = self.value_sharers
+        self.value_sharers.add(field)
+        return field
+
+    def can_share_values(self, use_memmap=None):
+        # Values backed by a named file are not shared, since the file is recreated when the values are reinitialized
+        return self.memmap_name is None and (use_memmap is None or bool(use_memmap) == self.use_memmap)
+
+    def is_sharing_values(self):
+        return self.value_sharers is not None and len(self.value_sharers) > 1
+
+    def stop_sharing_values(self):
+        if self.value_sharers is not None:
+            self.value_sharers.discard(self)
+            self.value_sharers = None
+
+    def prepare_for_modification(self):
+        '''
+        Makes the values of the field writable before they are modified in place. If the values are
+        still shared with other fields, this field gets its own copy of them first.
+        '''
+        if self.value_sharers is None:
+            return
+        if self.is_sharing_values():
+            profiling_utils.increment_counter('fields.copies_on_write')
+            self.initialize_values(self.values, copy_initial_array=True)
+        else:
+            self.stop_sharing_values()
+            try:
+                self.values.flags.writeable = True
+            except ValueError:
+                # The underlying buffer is read-only (for example a memory mapped cache file)
+                self.initialize_values(self.values, copy_initial_array=True)
+
+    def generate_block_indices(self, n_wavelengths_per_block=None, tile_shape=None, only_window=False):
+        '''
+        Yields index tuples dividing the stored values (or the values inside the grid window if
+        only_window=True) into blocks, in the order of the values in memory. For spectral fields, each
+        block covers a chunk of at most n_wavelengths_per_block wavelengths (all by default) and a spatial
+        tile of at most the given shape. By default, the tiles consist of whole rows, with as many rows
+        as fit within block_size bytes.
+        '''
+        shape = self.window_shape if only_window else self.storage_shape
+        n_wavelengths = shape[0] if len(shape) == 3 else 1
+        n_wavelengths_per_block = n_wavelengths if n_wavelengths_per_block is None else max(1, int(n_wavelengths_per_block))
+        size_x, size_y = shape[-2:]
+
+        if tile_shape is None:
+            row_size = min(n_wavelengths_per_block, n_wavelengths)*size_y*self.dtype.itemsize
+            tile_shape = (max(1, self.block_size//max(1, row_size)), size_y)
+        tile_size_x, tile_size_y = max(1, int(tile_shape[0])), max(1, int(tile_shape[1]))
+
+        for wavelength_start_idx in range(0, n_wavelengths, n_wavelengths_per_block):
+            for x_start_idx in range(0, size_x, tile_size_x):
+                for y_start_idx in range(0, size_y, tile_size_y):
+                    tile_indices = (slice(x_start_idx, x_start_idx + tile_size_x), slice(y_start_idx, y_start_idx + tile_size_y))
+                    yield (slice(wavelength_start_idx, wavelength_start_idx + n_wavelengths_per_block), *tile_indices) if len(shape) == 3 else tile_indices
+
+    def generate_blocks(self, n_wavelengths_per_block=None, tile_shape=None, only_window=False):
+        '''
+        Yields (block_indices, block_values) pairs for the blocks given by generate_block_indices, where
+        the block values are views into the stored values (or into the values inside the grid window).
+        Memory mapped fields are thus only paged in one block at a time, and blocks can be processed
+        independently, for example in parallel.
+        '''
+        values = self.get_values_inside_window() if only_window else self.values
+        for block_indices in self.generate_block_indices(n_wavelengths_per_block=n_wavelengths_per_block, tile_shape=tile_shape, only_window=only_window):
+            yield block_indices, values[block_indices]
+
+    def compute_value_range(self, only_window=False):
+        '''
+        Returns the minimum and maximum value of the field (or of the values inside the grid window),
+        computed one block at a time.
+        '''
+        minimum_value = maximum_value = None
+        for _, block_values in self.generate_blocks(only_window=only_window):
+            block_minimum_value = np.min(block_values)
+            block_maximum_value = np.max(block_values)
+            minimum_value = block_minimum_value if minimum_value is None else min(minimum_value, block_minimum_value)
+            maximum_value = block_maximum_value if maximum_value is None else max(maximum_value, block_maximum_value)
+
+        if self.window_only and not only_window:
+            # The padding is also part of the values on the whole grid
+            minimum_value = min(minimum_value, self.padding_value)
+            maximum_value = max(maximum_value, self.padding_value)
+
+        return minimum_value, maximum_value
 
     def set_constant_value(self, constant_value):
+        self.prepare_for_modification()
         self.values[:] = float(constant_value)
+        self.padding_value = float(constant_value)
 
     def set_values(self, values, copy=True):
         assert isinstance(values, np.ndarray)
-        assert values.shape == self.shape
+        assert values.shape == self.shape or values.shape == self.storage_shape
+        values = self.get_storage_view_of_array(values)
         if copy:
             assert values.dtype == self.dtype
+            self.prepare_for_modification()
             self.values[:] = values
         else:
+            self.stop_sharing_values()
             self.values = values
             self.dtype = values.dtype
 
@@ -80,6 +326,7 @@ class Regular2DField:
         assert values.shape == self.shape or values.shape == self.window_shape
         assert values.dtype == self.dtype
 
+        self.prepare_for_modification()
         window_values = self.get_values_inside_window()
 
         if values.shape == self.shape:
@@ -91,7 +338,10 @@ class Regular2DField:
         '''
         Implements the += operator.
         '''
-        self.values += values
+        self.prepare_for_modification()
+        if self.window_only and np.ndim(values) == 0:
+            self.padding_value = self.padding_value + values
+        self.values += self.get_storage_view_of_array(values)
         self.dtype = self.values.dtype
         return self
 
@@ -99,14 +349,20 @@ class Regular2DField:
         '''
         Implements the *= operator.
         '''
-        self.values *= values
+        self.prepare_for_modification()
+        if self.window_only and np.ndim(values) == 0:
+            self.padding_value = self.padding_value*values
+        self.values *= self.get_storage_view_of_array(values)
         self.dtype = self.values.dtype
         return self
 
     def apply_function(self, function):
+        self.prepare_for_modification()
+        if self.window_only:
+            self.padding_value = self.compute_padding_value(function)
         self.values[:] = function(self.values)
         assert isinstance(self.values, np.ndarray) and \
-               self.values.shape == self.shape and \
+               self.values.shape == self.storage_shape and \
                self.values.dtype == self.dtype
 
     def multiply_within_window(self, factors):
@@ -118,6 +374,7 @@ class Regular2DField:
         assert isinstance(factors, np.ndarray)
         assert factors.shape == self.shape or factors.shape == self.window_shape
 
+        self.prepare_for_modification()
         window_values = self.get_values_inside_window()
 
         if factors.shape == self.shape:
@@ -134,6 +391,7 @@ class Regular2DField:
         assert isinstance(offsets, np.ndarray)
         assert offsets.shape == self.shape or offsets.shape == self.window_shape
 
+        self.prepare_for_modification()
         window_values = self.get_values_inside_window()
 
         if offsets.shape == self.shape:
@@ -142,6 +400,7 @@ class Regular2DField:
             window_values[:] += offsets
 
     def apply_function_within_window(self, function):
+        self.prepare_for_modification()
         window_values = self.get_values_inside_window()
         new_window_values = function(window_values)
         assert isinstance(new_window_values, np.ndarray) and \
@@ -149,25 +408,38 @@ class Regular2DField:
                new_window_values.dtype == self.dtype
         window_values[:] = new_window_values
 
-    def copy(self, use_memmap=None):
-        return self.__class__(*self.create_constructor_argument_list(),
-                              initial_value=self.values,
-                              use_memmap=(self.use_memmap if use_memmap is None else use_memmap),
-                              copy_initial_array=True)
+    def copy(self, use_memmap=None, memmap_name=None):
+        '''
+        Returns a field with the same values. The values are shared with copy-on-write semantics unless
+        the copy uses a different kind of storage or a named memory mapped file.
+        '''
+        if memmap_name is None and self.can_share_values(use_memmap):
+            return self.share_values_with(self.create_field_with_values(self.values, copy_values=False))
+        return self.create_field_with_values(self.values, use_memmap=use_memmap, copy_values=True, memmap_name=memmap_name)
 
-    def multiplied(self, factors, use_memmap=None):
+    def multiplied(self, factors, use_memmap=None, lazy=False):
+        '''
+        Returns a new field with the values multiplied by the given factors. If lazy=True, a
+        LazyFieldExpression is returned instead, and the multiplication is deferred.
+        '''
         assert isinstance(factors, (int, float, complex)) or (isinstance(factors, np.ndarray) and factors.shape == self.shape)
-        return self.__class__(*self.create_constructor_argument_list(),
-                              initial_value=self.values*factors,
-                              use_memmap=(self.use_memmap if use_memmap is None else use_memmap),
-                              copy_initial_array=False)
+        if lazy:
+            return LazyFieldExpression(self).multiplied(factors)
+        return self.create_field_with_values(self.values*self.get_storage_view_of_array(factors),
+                                             padding_value=(None if isinstance(factors, np.ndarray) else self.padding_value*factors),
+                                             use_memmap=use_memmap)
 
-    def added(self, offsets, use_memmap=None):
+    def added(self, offsets, use_memmap=None, lazy=False):
+        '''
+        Returns a new field with the given offsets added to the values. If lazy=True, a
+        LazyFieldExpression is returned instead, and the addition is deferred.
+        '''
         assert isinstance(offsets, (int, float, complex)) or (isinstance(offsets, np.ndarray) and offsets.shape == self.shape)
-        return self.__class__(*self.create_constructor_argument_list(),
-                              initial_value=(self.values + offsets),
-                              use_memmap=(self.use_memmap if use_memmap is None else use_memmap),
-                              copy_initial_array=False)
+        if lazy:
+            return LazyFieldExpression(self).added(offsets)
+        return self.create_field_with_values(self.values + self.get_storage_view_of_array(offsets),
+                                             padding_value=(None if isinstance(offsets, np.ndarray) else self.padding_value + offsets),
+                                             use_memmap=use_memmap)
 
     def multiplied_within_window(self, factors, use_memmap=None):
         multiplied_field = self.copy(use_memmap=use_memmap)
@@ -184,11 +456,17 @@ class Regular2DField:
         new_field.apply_function_within_window(function)
         return new_field
 
-    def with_function_applied(self, function, use_memmap=None):
-        return self.__class__(*self.create_constructor_argument_list(),
-                              initial_value=function(self.values),
-                              use_memmap=(self.use_memmap if use_memmap is None else use_memmap),
-                              copy_initial_array=False)
+    def with_function_applied(self, function, use_memmap=None, lazy=False):
+        '''
+        Returns a new field with the given function applied to the values. If lazy=True, a
+        LazyFieldExpression is returned instead, and the function (which must then operate
+        elementwise) is applied when the values are needed.
+        '''
+        if lazy:
+            return LazyFieldExpression(self).with_function_applied(function)
+        return self.create_field_with_values(function(self.values),
+                                             padding_value=(self.compute_padding_value(function) if self.window_only else None),
+                                             use_memmap=use_memmap)
 
     def compute_fourier_transformed_values(self, inverse=False):
         '''
@@ -204,16 +482,10 @@ class Regular2DField:
         '''
         assert isinstance(self.grid, grids.FFTGrid)
 
-        # Make sure the values to transform are not centered
-        uncentered_values = np.fft.ifftshift(self.values, axes=(-2, -1)) if self.grid.is_centered else self.values
-
-        # Perform FFT
-        fourier_coefficients = np.fft.ifft2(uncentered_values, axes=(-2, -1)) if inverse else np.fft.fft2(uncentered_values, axes=(-2, -1))
-
-        # Recenter the Fourier coefficients if necessary
-        recentered_fourier_coefficients = np.fft.fftshift(fourier_coefficients, axes=(-2, -1)) if self.grid.is_centered else fourier_coefficients
-
-        return recentered_fourier_coefficients
+        if self.grid.is_centered:
+            return fft_utils.centered_fft2(self.get_full_values(), inverse=inverse)
+        else:
+            return fft_utils.fft2(self.get_full_values(), inverse=inverse)
 
     def compute_fourier_transformed_window_values(self, inverse=False):
         return self.get_window_view_of_array(self.compute_fourier_transformed_values(inverse=inverse))
@@ -238,20 +510,27 @@ class Regular2DField:
     def create_window_field(self, grid_type=None, use_memmap=None, copy_values=True):
         '''
         Returns a new field corresponding to the part of the current field inside
-        the grid window.
+        the grid window. With copy_values=True, the values are shared with copy-on-write
+        semantics when possible. Otherwise, the new field refers to the values of this field.
         '''
         window_grid = self.grid.create_window_grid(grid_type=grid_type)
-        return self.__class__(*self.create_constructor_argument_list(grid=window_grid),
-                              initial_value=self.get_values_inside_window(),
-                              use_memmap=(self.use_memmap if use_memmap is None else use_memmap),
-                              copy_initial_array=copy_values)
-
-    def get_window_view_of_array(self, values):
+        share_values = copy_values and self.can_share_values(use_memmap)
+        window_field = self.__class__(*self.create_constructor_argument_list(grid=window_grid),
+                                      initial_value=self.get_values_inside_window(),
+                                      use_memmap=(self.use_memmap if use_memmap is None else use_memmap),
+                                      copy_initial_array=(copy_values and not share_values))
+        return self.share_values_with(window_field) if share_values else window_field
+
+    def get_window_view_of_array(self, values, window=None):
         assert values.shape == self.shape
-        window = self.grid.window
+        window = self.grid.window if window is None else window
         return values[window.x.start:window.x.end, window.y.start:window.y.end]
 
     def get_values_inside_window(self):
+        if self.window_only:
+            # The stored window must be moved with set_window_only if the grid window is redefined
+            assert self.has_current_storage_window()
+            return self.values
         return self.get_window_view_of_array(self.values)
 
 
@@ -276,27 +555,60 @@ class SpectralField(Regular2DField):
         Overrides the corresponding Field2D method and adds an additional dimension for wavelength.
         '''
         self.shape = (self.n_wavelengths, *self.grid.shape)
-        self.window_shape = (self.n_wavelengths, *self.grid.window.shape)
+
+    def get_shape_for_window(self, window):
+        return (self.n_wavelengths, *window.shape)
 
     def add_within_window(self, offsets):
         if isinstance(offsets, np.ndarray) and offsets.ndim == 1 and offsets.size == self.n_wavelengths:
+            self.prepare_for_modification()
             window_values = self.get_values_inside_window()
             window_values[:] += offsets[:, np.newaxis, np.newaxis]
         else:
             super().add_within_window(offsets)
 
-    def compute_fourier_transformed_values(self, inverse=False):
+    def compute_fourier_transformed_values(self, inverse=False, output_window=None):
         '''
         Computes the 2D Fourier transform of the field values and returns the result as an array.
         If inverse=True, the inverse inverse Fourier transform is computed instead.
+        If an output window (an IndexRange2D for the grid of the transformed field) is given,
+        only the Fourier coefficients inside the window are returned. Real field values are
+        transformed with a real-input FFT, which does about half the work.
         If n_threads > 1 in parallel_utils, the computations are parallellized over the wavelength axis.
+        If only the window values are stored, the padding is added one wavelength at a time as the
+        values are transformed.
         '''
         assert isinstance(self.grid, grids.FFTGrid)
-        return parallel_utils.parallel_fft2(self.values, centered=self.grid.is_centered, inverse=inverse)
+        values = PaddedWindowValues(self) if self.window_only else self.values
+        return parallel_utils.parallel_fft2(values, centered=self.grid.is_centered, inverse=inverse, output_window=output_window)
 
-    def get_window_view_of_array(self, values):
+    def compute_windowed_fourier_transformed_values(self, output_window, inverse=False, method='auto'):
+        '''
+        Computes the 2D Fourier transform of the field under the assumption that the field is zero outside
+        the grid window, and returns only the Fourier coefficients inside the given output window (an
+        IndexRange2D for the grid of the transformed field). See parallel_utils.parallel_windowed_fft2
+        for the available methods.
+        '''
+        assert isinstance(self.grid, grids.FFTGrid)
+        assert not self.window_only or self.padding_value == 0
+        return parallel_utils.parallel_windowed_fft2(self.get_values_inside_window(), self.grid.shape, self.grid.window, output_window,
+                                                     centered=self.grid.is_centered, inverse=inverse, method=method)
+
+    def get_wavelength_slice_field(self, wavelength_slice):
+        '''
+        Returns a field containing only the given slice of the wavelengths. The values of the
+        new field are a view into the values of this field.
+        '''
+        return SpectralField(self.grid, self.wavelengths[wavelength_slice],
+                             initial_value=self.values[wavelength_slice, :, :],
+                             use_memmap=False,
+                             copy_initial_array=False,
+                             window_only=self.window_only,
+                             padding_value=self.padding_value)
+
+    def get_window_view_of_array(self, values, window=None):
         assert values.shape == self.shape
-        window = self.grid.window
+        window = self.grid.window if window is None else window
         return values[:, window.x.start:window.x.end, window.y.start:window.y.end]
 
 
@@ -321,17 +633,218 @@ class FilteredSpectralField(SpectralField):
                self.filter_labels if not 'filter_labels' in new_args else new_args['filter_labels']
 
     def create_field_for_channel(self, filter_label, use_memmap=None, copy_values=True):
+        '''
+        Returns a 2D field with the values of the given channel. With copy_values=True, the values are
+        shared with copy-on-write semantics when possible. Otherwise, the new field refers to the values
+        of this field.
+        '''
         assert filter_label in self.channels
-        return Regular2DField(self.grid,
-                              initial_value=self.values[self.channels[filter_label], :, :],
-                              use_memmap=(self.use_memmap if use_memmap is None else use_memmap),
-                              copy_initial_array=copy_values)
+        share_values = copy_values and self.can_share_values(use_memmap)
+        channel_field = Regular2DField(self.grid,
+                                       initial_value=self.values[self.channels[filter_label], :, :],
+                                       use_memmap=(self.use_memmap if use_memmap is None else use_memmap),
+                                       copy_initial_array=(copy_values and not share_values),
+                                       window_only=self.window_only,
+                                       padding_value=self.padding_value)
+        return self.share_values_with(channel_field) if share_values else channel_field
+
+
+class UniformSpectralField(SpectralField):
+    '''
+    Spectral field that is constant over the grid for each wavelength. Only one value per wavelength
+    is stored, in an array of shape (n_wavelengths, 1, 1) that broadcasts against the values of
+    ordinary spectral fields. Values on the grid are returned as read-only broadcasted views.
+    '''
+    @property
+    def storage_shape(self):
+        return (self.n_wavelengths, 1, 1)
+
+    def get_values_inside_window(self):
+        return np.broadcast_to(self.values, self.window_shape)
+
+    def get_full_values(self):
+        return np.broadcast_to(self.values, self.shape)
+
+    def get_wavelength_slice_field(self, wavelength_slice):
+        return UniformSpectralField(self.grid, self.wavelengths[wavelength_slice],
+                                    initial_value=self.values[wavelength_slice, :, :],
+                                    use_memmap=False,
+                                    copy_initial_array=False)
+
+
+class LazyFieldExpression:
+    '''
+    Represents the result of a chain of elementwise operations on the values of a field, without
+    computing it. Indexing the expression evaluates the operations for only the indexed part of the
+    values, so consumers that process the values piece by piece (like the parallel FFTs) never need
+    a full-size temporary array. The full result is computed with evaluate or to_field, which go
+    through the values in cache-sized tiles and apply all the operations to each tile in a single
+    fused pass. The values of the field must not be modified while the expression is in use.
+    '''
+    tile_size = 256*1024 # Number of bytes in each tile evaluated at once
+
+    def __init__(self, field, operations=()):
+        assert not field.window_only
+        self.field = field # Field whose values are operated on
+        self.operations = tuple(operations) # Sequence of (operation, operand) pairs, with operation being 'multiply', 'add' or 'function'
+        self.shape = field.shape
+        self.ndim = len(self.shape)
+        self.dtype = self.determine_dtype()
+
+    def determine_dtype(self):
+        dtype = self.field.dtype
+        for operation, operand in self.operations:
+            if operation == 'function':
+                dtype = np.asarray(operand(np.ones(1, dtype=dtype))).dtype
+            else:
+                dtype = np.result_type(dtype, operand)
+        return dtype
+
+    def with_operation(self, operation, operand):
+        return LazyFieldExpression(self.field, operations=(self.operations + ((operation, operand),)))
+
+    def multiplied(self, factors):
+        return self.with_operation('multiply', factors)
+
+    def added(self, offsets):
+        return self.with_operation('add', offsets)
+
+    def with_function_applied(self, function):
+        return self.with_operation('function', function)
+
+    def get_operand_part(self, operand, indices):
+        return np.broadcast_to(operand, self.shape)[indices] if isinstance(operand, np.ndarray) else operand
+
+    def __getitem__(self, indices):
+        '''
+        Evaluates the expression for the given part of the values, returning a new array.
+        '''
+        values = self.field.values[indices]
+        is_new_array = False
+
+        for operation, operand in self.operations:
+            operand_part = self.get_operand_part(operand, indices)
+            if operation == 'function':
+                values = operand(values)
+                is_new_array = True
+            else:
+                ufunc = np.multiply if operation == 'multiply' else np.add
+                if is_new_array and np.result_type(values, operand_part) == values.dtype:
+                    # Reuse the temporary array from the previous operation
+                    ufunc(values, operand_part, out=values)
+                else:
+                    values = ufunc(values, operand_part)
+                    is_new_array = True
+
+        return values if is_new_array else values.copy()
+
+    def __array__(self, dtype=None, copy=None):
+        return convert_for_array_protocol(self.evaluate(), dtype, copy, is_new_array=True)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def generate_tile_indices(self):
+        return memmap_utils.generate_tile_indices(self.shape, self.dtype, tile_size=self.tile_size)
+
+    def evaluate(self, output_values=None):
+        '''
+        Computes the values of the expression tile by tile, storing them in the given output array
+        if one is given.
+        '''
+        if output_values is None:
+            output_values = np.empty(self.shape, dtype=self.dtype)
+        assert output_values.shape == self.shape
+        for tile_indices in self.generate_tile_indices():
+            output_values[tile_indices] = self[tile_indices]
+        return output_values
+
+    def to_field(self, use_memmap=None):
+        '''
+        Evaluates the expression into a new field of the same type as the original field.
+        '''
+        new_field = self.field.__class__(*self.field.create_constructor_argument_list(),
+                                         initial_value=None,
+                                         dtype=self.dtype,
+                                         use_memmap=(self.field.use_memmap if use_memmap is None else use_memmap))
+        self.evaluate(output_values=new_field.values)
+        return new_field
+
+    def compute_fourier_transformed_values(self, inverse=False, output_window=None):
+        '''
+        Computes the 2D Fourier transform of the values of the expression like the corresponding
+        method of the field. For spectral fields, the expression is evaluated one wavelength at a
+        time as it is transformed.
+        '''
+        if self.ndim == 3:
+            assert isinstance(self.field.grid, grids.FFTGrid)
+            return parallel_utils.parallel_fft2(self, centered=self.field.grid.is_centered, inverse=inverse, output_window=output_window)
+        else:
+            fourier_coefficients = self.to_field().compute_fourier_transformed_values(inverse=inverse)
+            return fourier_coefficients if output_window is None else \
+                   fourier_coefficients[output_window.x.start:output_window.x.end, output_window.y.start:output_window.y.end]
+
+
+class PaddedWindowValues:
+    '''
+    Represents the values on the whole grid of a spectral field that only stores its window values,
+    without materializing the padding. Indexing along the wavelength axis returns a new array with
+    the padding added for only the indexed wavelengths, so consumers that process the values one
+    wavelength at a time (like the parallel FFTs) never need the full padded array.
+    '''
+    def __init__(self, field):
+        assert field.window_only
+        self.field = field # Field whose stored window values are padded
+        self.shape = field.shape
+        self.ndim = len(self.shape)
+        self.dtype = field.dtype
+
+    def __getitem__(self, indices):
+        '''
+        Pads the stored values for the wavelengths given by the first index, which must be a slice,
+        and returns the part of the result given by the remaining indices.
+        '''
+        indices = indices if isinstance(indices, tuple) else (indices,)
+        assert isinstance(indices[0], slice)
+        window_values = self.field.values[indices[0]]
+        window = self.field.storage_window
+        padded_values = np.full((window_values.shape[0], *self.shape[1:]), self.field.padding_value, dtype=self.dtype)
+        padded_values[:, window.x.start:window.x.end, window.y.start:window.y.end] = window_values
+        return padded_values if len(indices) == 1 else padded_values[(slice(None), *indices[1:])]
+
+    def __array__(self, dtype=None, copy=None):
+        return convert_for_array_protocol(self.field.get_full_values(), dtype, copy, is_new_array=True)
+
+    def __len__(self):
+        return self.shape[0]
+
+
+def get_read_only_view(values):
+    read_only_values = values.view()
+    read_only_values.flags.writeable = False
+    return read_only_values
+
+
+def convert_for_array_protocol(values, dtype, copy, is_new_array):
+    '''
+    Returns the given values converted to the given dtype as required by the numpy __array__ protocol.
+    With copy=True, the result never shares memory with existing arrays. With copy=False, a ValueError
+    is raised if the values would have to be created or converted. With copy=None, the values are only
+    copied if needed. The is_new_array argument tells whether the values were just created.
+    '''
+    needs_conversion = dtype is not None and np.dtype(dtype) != values.dtype
+    if copy is False and (is_new_array or needs_conversion):
+        raise ValueError('The values can not be exposed as an array without creating a new array')
+    if needs_conversion:
+        return values.astype(dtype)
+    return values.copy() if copy and not is_new_array else values
 
 
 def visualize_field(field, only_window=True, approximate_wavelength=None, filter_label=None, use_autostretch=False, white_point_scale=1, use_log=False, title='', output_path=None):
 
     use_colors = False
     was_stretched = False
+    phases = None
 
     wavelength = None
 
@@ -342,7 +855,7 @@ def visualize_field(field, only_window=True, approximate_wavelength=None, filter
         field_values = field.get_values_inside_window()
         extent = field.grid.get_window_bounds()
     else:
-        field_values = field.values
+        field_values = field.get_full_values()
         extent = field.grid.get_bounds()
 
     if isinstance(field, FilteredSpectralField):
@@ -351,7 +864,8 @@ def visualize_field(field, only_window=True, approximate_wavelength=None, filter
             use_log = False
             field_values = np.moveaxis(field_values, 0, 2)
             if not use_autostretch:
-                field_values = image_utils.perform_histogram_clip(field_values, white_point_scale=white_point_scale)
+                minimum_value, maximum_value = field.compute_value_range(only_window=only_window)
+                field_values = image_utils.perform_liear_stretch(field_values, minimum_value, maximum_value*white_point_scale)
                 was_stretched = True
         else:
             channel_idx = field.channels[filter_label]
@@ -362,7 +876,7 @@ def visualize_field(field, only_window=True, approximate_wavelength=None, filter
         wavelength = field.wavelengths[wavelength_idx]
         field_values = field_values[wavelength_idx, :, :]
 
-    if field.dtype == np.dtype('complex128') and not use_colors:
+    if np.iscomplexobj(field_values) and not use_colors:
         phases = np.angle(field_values)
         field_values = np.abs(field_values)
         phases[field_values == 0] = np.nan
@@ -412,7 +926,7 @@ def visualize_field(field, only_window=True, approximate_wavelength=None, filter
 
     fig = plot_utils.figure()
 
-    if field.dtype == np.dtype('complex128') and not use_colors:
+    if phases is not None:
         left_ax = fig.add_subplot(121)
         plot_utils.plot_image(fig, left_ax, field_values, xlabel=xlabel, ylabel=ylabel, title=title, extent=extent, clabel=clabel)
         right_ax = fig.add_subplot(122)
@@ -33,31 +33,65 @@ class FilterSet:
             self.filters = collections.OrderedDict([(filter_.get_label(), filter_.create_merged_filter(new_filter, filter_.get_label()))
                                                     for filter_ in self.filters.values()])
 
-    def compute_filtered_image_field(self, image_field, convert_to_photon_rates=False, use_memmap=False):
+    def get_integration_filters(self):
         '''
-        Integrates the spectral fluxes of the image field weighted with the filter transmittance
-        to determine the flux passing throught each filter. If convert_to_photon_rates=True,
-        the spectral fluxes will be converted to photon rates before integrating, so that the
-        integrated values correspond to the total rate of photons per area transmitted through
-        the filter.
+        Returns the filters to integrate fluxes through, using a single clear filter if the set is empty.
         '''
+        return collections.OrderedDict([('clear', Filter('clear', 0, np.inf, transmittances=1))]) if self.is_empty() else self.filters
 
-        filters = {'clear': Filter('clear', 0, np.inf, transmittance=1)} if self.is_empty() else self.filters
+    def compute_integration_weights(self, wavelengths, convert_to_photon_rates=False):
+        '''
+        Computes an array with shape (n_filters, n_wavelengths) of weights that give the integrated flux
+        through each filter when multiplied with the spectral fluxes for the given wavelengths and summed
+        over the wavelength axis. If convert_to_photon_rates=True, the weights also convert the spectral
+        fluxes to photon rates.
+        '''
+        integration_weights = np.array([filter_.compute_integration_weights(wavelengths) for filter_ in self.get_integration_filters().values()])
+
+        if convert_to_photon_rates:
+            integration_weights *= physics_utils.compute_photons_per_energy_unit(wavelengths)[np.newaxis, :]
+
+        return integration_weights
+
+    def create_filtered_image_field(self, grid, dtype='float64', use_memmap=False):
+        '''
+        Creates a zero-valued field with one channel for each filter, for accumulating integrated fluxes.
+        '''
+        filters = self.get_integration_filters()
 
         central_wavelengths = [filter_.get_central_wavelength() for filter_ in filters.values()]
         filter_labels = list(filters.keys())
 
-        filtered_image_field = fields.FilteredSpectralField(image_field.grid, central_wavelengths, filter_labels,
-                                                            initial_value=None,
-                                                            use_memmap=use_memmap)
+        return fields.FilteredSpectralField(grid, central_wavelengths, filter_labels,
+                                            initial_value=0,
+                                            dtype=dtype,
+                                            use_memmap=use_memmap)
 
-        if convert_to_photon_rates:
-            photons_per_energy_unit = physics_utils.compute_photons_per_energy_unit(image_field.wavelengths)[:, np.newaxis, np.newaxis]
-
-        for idx, filter_ in enumerate(filters.values()):
-            filtered_image_field.values[idx, :, :] = filter_.compute_integrated_flux(image_field.wavelengths,
-                                                                                     image_field.values*photons_per_energy_unit if convert_to_photon_rates else image_field.values)
+    def add_to_filtered_image_field(self, filtered_image_field, image_field, integration_weights):
+        '''
+        Adds the integrated fluxes of the given image field to the given filtered image field, using the
+        given integration weights for the wavelengths of the image field. Image fields covering separate
+        ranges of wavelengths can thus be integrated one at a time.
+        '''
+        assert integration_weights.shape == (filtered_image_field.n_channels, image_field.n_wavelengths)
+        assert filtered_image_field.values.shape[1:] == image_field.values.shape[1:]
+        integration_weights = integration_weights.astype(image_field.dtype)
+        filtered_image_field.prepare_for_modification()
+        # Integrate one spatial tile (covering all the wavelengths) at a time to bound the size of the temporary arrays
+        for block_indices, image_values in image_field.generate_blocks():
+            filtered_image_field.values[(slice(None), *block_indices[1:])] += np.tensordot(integration_weights, image_values, axes=1)
 
+    def compute_filtered_image_field(self, image_field, convert_to_photon_rates=False, use_memmap=False):
+        '''
+        Integrates the spectral fluxes of the image field weighted with the filter transmittance
+        to determine the flux passing throught each filter. If convert_to_photon_rates=True,
+        the spectral fluxes will be converted to photon rates before integrating, so that the
+        integrated values correspond to the total rate of photons per area transmitted through
+        the filter.
+        '''
+        filtered_image_field = self.create_filtered_image_field(image_field.grid, dtype=image_field.dtype, use_memmap=use_memmap)
+        integration_weights = self.compute_integration_weights(image_field.wavelengths, convert_to_photon_rates=convert_to_photon_rates)
+        self.add_to_filtered_image_field(filtered_image_field, image_field, integration_weights)
         return filtered_image_field
 
     def copy(self):
@@ -150,7 +184,10 @@ class Filter:
         return np.interp(wavelengths, self.wavelengths, self.transmittances, left=0, right=0)
 
     def apply_transmittance_to_image_field(self, image_field):
-        self.apply_transmittance_to_spectral_fluxes(image_field.values, image_field.wavelengths)
+        transmittances = self.compute_transmittances_for_wavelengths(image_field.wavelengths)
+        image_field.prepare_for_modification()
+        for block_indices, spectral_fluxes in image_field.generate_blocks():
+            spectral_fluxes *= transmittances[block_indices[0], np.newaxis, np.newaxis]
 
     def apply_transmittance_to_spectral_fluxes(self, spectral_fluxes, wavelengths):
         assert spectral_fluxes.ndim in (1, 2, 3)
@@ -179,6 +216,29 @@ class Filter:
 
         return integrated_flux
 
+    def compute_integration_weights(self, wavelengths):
+        '''
+        Computes weights that give the same result as compute_integrated_flux when multiplied with the
+        spectral fluxes for the given wavelengths and summed over the wavelength axis.
+        '''
+        integration_weights = np.zeros(wavelengths.size)
+
+        # Find index range covering the filter wavelengths
+        idx_range = np.searchsorted(wavelengths, (self.minimum_wavelength, self.maximum_wavelength))
+        filtered_wavelengths = wavelengths[idx_range[0]:idx_range[1]]
+
+        if filtered_wavelengths.size > 1:
+
+            # Weights of the trapezoidal rule
+            half_intervals = np.diff(filtered_wavelengths)/2
+            filtered_integration_weights = integration_weights[idx_range[0]:idx_range[1]]
+            filtered_integration_weights[:-1] += half_intervals
+            filtered_integration_weights[1:] += half_intervals
+
+            filtered_integration_weights *= self.compute_transmittances_for_wavelengths(filtered_wavelengths)
+
+        return integration_weights
+
     def create_merged_filter(self, other_filter, new_label):
         # Find new wavelenegth range
         new_minimum_wavelength = max(self.minimum_wavelength, other_filter.minimum_wavelength)
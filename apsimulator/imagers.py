@@ -4,6 +4,7 @@
 import numpy as np
 import fields
 import math_utils
+import parallel_utils
 
 
 class FraunhoferImager:
@@ -13,9 +14,10 @@ class FraunhoferImager:
     thus produce a perfectly focused image. Out-of-focus effects, i.e. when the image plane and
     focal plane differ, require Fresnel diffraction.
     '''
-    def __init__(self, aperture_diameter=1, focal_length=1):
+    def __init__(self, aperture_diameter=1, focal_length=1, transform_method='auto'):
         self.set_aperture_diameter(aperture_diameter) # The diameter of the aperture [m]
         self.set_focal_length(focal_length) # The distance from the aperture plane to the focal (and image) plane [m]
+        self.set_transform_method(transform_method) # How to compute the Fourier transform of the aperture field
         self.has_image_field = False
 
     def set_aperture_diameter(self, aperture_diameter):
@@ -24,7 +26,18 @@ class FraunhoferImager:
     def set_focal_length(self, focal_length):
         self.focal_length = float(focal_length)
 
-    def initialize_image_field(self, aperture_grid, wavelengths, field_of_view_x, field_of_view_y, use_memmap=False):
+    def set_transform_method(self, transform_method):
+        '''
+        Sets the method for transforming the aperture field. With 'fft', the full aperture grid is transformed.
+        The other methods only use the aperture window and only compute the image inside the field of view
+        window: 'pruned' skips the FFTs of empty rows and unneeded columns, while 'matrix' uses a matrix
+        Fourier transform, which is faster when the windows are small compared to the grid. With 'auto',
+        the method requiring the fewest operations for the current grids is used.
+        '''
+        assert transform_method in ('fft', 'pruned', 'matrix', 'auto')
+        self.transform_method = transform_method
+
+    def initialize_image_field(self, aperture_grid, wavelengths, field_of_view_x, field_of_view_y, dtype='float64', use_memmap=False, memmap_name=None, window_only=False):
         '''
         Constructs the grid for the image field and initializes the field.
 
@@ -34,6 +47,9 @@ class FraunhoferImager:
         The image field grid is defined in terms of the spatial x- and y-coordinates with
         repect to the optical axis in the image plane, divided by the focal length. The
         coordinates are found by computing the spatial frequencies of the aperture grid.
+
+        Since fluxes are only computed inside the field of view window, the image field can be set
+        to only store the values inside the window.
         '''
         self.wavelengths = wavelengths
         self.image_grid = aperture_grid.to_spatial_frequency_grid(grid_type='image')
@@ -46,38 +62,105 @@ class FraunhoferImager:
 
         # Compute the scale factors required to obtain image fluxes from the squared Fourier coefficients
         # of the aperture field.
-        self.flux_scales = (wavelengths*(aperture_grid.get_cell_area()/self.focal_length))**2
+        self.flux_scales = ((wavelengths*(aperture_grid.get_cell_area()/self.focal_length))**2).astype(dtype)
 
         self.image_field = fields.SpectralField(self.image_grid, self.wavelengths,
                                                 initial_value=0,
-                                                dtype='float64',
-                                                use_memmap=use_memmap)
+                                                dtype=dtype,
+                                                use_memmap=use_memmap,
+                                                memmap_name=memmap_name,
+                                                window_only=window_only)
 
         self.has_image_field = True
 
-    def compute_image_field(self, modulated_aperture_field):
+    def get_parameters(self):
+        '''
+        Returns the parameters determining the image field computed from a given aperture field.
+        '''
+        return (self.focal_length, self.transform_method)
+
+    def compute_image_field(self, modulated_aperture_field, wavelength_slice=None):
         '''
         The Fraunhofed diffracted image field is found by taking the Fourier transform of the
         aperture field, squaring and multiplying with the appropriate scale factors.
+
+        If a wavelength slice is given, the aperture field is assumed to only contain the wavelengths
+        in the slice, and the image field for those wavelengths is returned as a new field instead
+        of being stored in the image field of the imager.
+
+        Unless the transform method is 'fft', the aperture field is assumed to be zero outside
+        the aperture window, which holds as long as the aperture modulators only operate
+        inside the window.
         '''
         assert self.has_image_field
 
-        # Compute the Fourier transform of the modulated aperture field
-        fourier_coefficients = modulated_aperture_field.compute_fourier_transformed_values()
-
-        # Construct complex field of Fourier coefficients on the image grid
-        fourier_transformed_field = fields.SpectralField(self.image_grid, self.wavelengths,
-                                                         initial_value=fourier_coefficients,
-                                                         dtype='complex128',
-                                                         use_memmap=False,
-                                                         copy_initial_array=False)
+        # Compute the Fourier coefficients of the modulated aperture field within the field of view window
+        if self.transform_method == 'fft':
+            fourier_coefficients_inside_window = modulated_aperture_field.compute_fourier_transformed_values(output_window=self.image_grid.window)
+        else:
+            fourier_coefficients_inside_window = modulated_aperture_field.compute_windowed_fourier_transformed_values(self.image_grid.window,
+                                                                                                                     method=self.transform_method)
+
+        if wavelength_slice is None:
+            image_field = self.image_field
+            flux_scales = self.flux_scales
+        else:
+            image_field = fields.SpectralField(self.image_grid, self.wavelengths[wavelength_slice],
+                                               initial_value=0,
+                                               dtype=self.image_field.dtype,
+                                               use_memmap=False,
+                                               window_only=self.image_field.window_only)
+            flux_scales = self.flux_scales[wavelength_slice]
 
         # Convert Fourier coefficients within the field of view window to image fluxes
-        fourier_coefficients_inside_window = fourier_transformed_field.get_values_inside_window()
-        spectral_fluxes_inside_window = self.flux_scales[:, np.newaxis, np.newaxis]*math_utils.abs2(fourier_coefficients_inside_window)
+        spectral_fluxes_inside_window = flux_scales[:, np.newaxis, np.newaxis]*math_utils.abs2(fourier_coefficients_inside_window)
 
         # Assign new fluxes within the field of view window of the image field
-        self.image_field.set_values_inside_window(spectral_fluxes_inside_window)
+        image_field.set_values_inside_window(spectral_fluxes_inside_window)
+
+        return image_field
+
+    def compute_point_spread_functions(self, modulated_point_source_aperture_field):
+        '''
+        Computes the image fluxes over the whole image grid produced by a point source with unit spectral
+        flux in the center of the source grid, given the modulated aperture field of the point source.
+        The image grid has the same shape and cell extents as the source grid.
+        '''
+        assert self.has_image_field
+        fourier_coefficients = modulated_point_source_aperture_field.compute_fourier_transformed_values()
+        return self.flux_scales[:, np.newaxis, np.newaxis]*math_utils.abs2(fourier_coefficients)
+
+    def compute_image_field_from_source_field(self, source_field, kernel_spectra, wavelength_slice=None):
+        '''
+        Computes the image field of the given source field as the sum of the images of the individual
+        source grid cells, by correlating the source fluxes with the point spread functions whose
+        spectra are given (see parallel_utils.parallel_compute_periodic_kernel_spectrum). The source
+        is inverted in the image, hence the correlation rather than the convolution. This treats the
+        sources as mutually incoherent, while compute_image_field adds the light from all the sources
+        coherently, including their interference.
+
+        If a wavelength slice is given, the source field is assumed to only contain the wavelengths in
+        the slice, and the image field for those wavelengths is returned as a new field instead of being
+        stored in the image field of the imager.
+        '''
+        assert self.has_image_field
+        assert source_field.grid.shape == self.image_grid.shape
+
+        if wavelength_slice is None:
+            image_field = self.image_field
+        else:
+            image_field = fields.SpectralField(self.image_grid, self.wavelengths[wavelength_slice],
+                                               initial_value=0,
+                                               dtype=self.image_field.dtype,
+                                               use_memmap=False,
+                                               window_only=self.image_field.window_only)
+            kernel_spectra = kernel_spectra[wavelength_slice]
+
+        spectral_fluxes_inside_window = parallel_utils.parallel_correlate_with_periodic_kernel_spectrum(source_field.get_full_values(), kernel_spectra,
+                                                                                                       output_window=self.image_grid.window)
+        image_field.set_values_inside_window(spectral_fluxes_inside_window.astype(image_field.dtype, copy=False))
+
+        return image_field
 
     def compute_spectral_powers_of_image_field(self, image_field):
         return np.sum(image_field.get_values_inside_window(), axis=(1, 2))*self.focal_length**2*self.image_grid.get_cell_area()
@@ -99,3 +182,6 @@ class FraunhoferImager:
 
     def get_focal_length(self):
         return self.focal_length
+
+    def get_transform_method(self):
+        return self.transform_method
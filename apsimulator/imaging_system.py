@@ -2,12 +2,15 @@
 # This file is part of the APSimulator API.
 # Author: Lars Frogner
 import numpy as np
+import collections
 import math_utils
 import grids
 import fields
 import field_processing
 import filters
-import render
+import profiling_utils
+import parallel_utils
+import plot_utils
 
 
 class ImagingSystem:
@@ -15,13 +18,77 @@ class ImagingSystem:
     This class organizes the image formation pipeline. It is responsible for holding all
     the objects used at various stages of the image generation process and communicating
     intermediate results between them.
+
+    With precision='single', all fields are stored and transformed with float32/complex64 values,
+    which halves the memory use and bandwidth. The relative rounding error of the image fluxes
+    then grows roughly as the single precision machine epsilon (about 6e-8) times the base-2
+    logarithm of the grid sizes, which is typically well below 1e-5 (see
+    estimate_relative_image_flux_error). Phase screens are generated in double precision, but
+    the phases are stored in single precision, giving an additional absolute phase error of
+    about the machine epsilon times the phase magnitude.
+
+    With use_lazy_expressions=True, elementwise operations on full fields are deferred (see
+    fields.LazyFieldExpression) and evaluated piece by piece where the result is consumed: the
+    source amplitudes are computed one wavelength at a time as they are Fourier transformed, and
+    the mean photon counts are computed tile by tile as they are sampled. This avoids full-size
+    temporary fields without changing the results.
+
+    With incremental=True, the processing pipelines keep a snapshot of the field after each stage,
+    and a new propagation only recomputes the stages whose parameters changed, and everything
+    after them. The aperture field and image field are likewise only recomputed when their input
+    has changed. This speeds up repeated propagations where only a few parameters are varied, at
+    the cost of storing a field copy per stage.
+
+    With window_only_storage=True, the aperture and image fields only store their values inside
+    the aperture and field of view windows, where they are nonzero or used, respectively. The zero
+    padding outside the windows is only materialized temporarily when a full FFT requires it.
+
+    With use_point_sources=True and only point sources (see field_processing.PointSourceFieldProcessor)
+    added, the dense source field is never computed. Instead, the plane waves from the point sources
+    are summed directly in the aperture window with a non-uniform DFT, which is much cheaper than
+    the source grid FFT when there are far fewer sources than source grid cells. Point sources from
+    different processors in the same grid cell have their fluxes summed, like when the processors add
+    them to the source field. The source field then remains zero.
+
+    With concurrent_stage_backend='threads' or 'processes', the pipelines generate the process fields
+    of their linear stages (like the sources) concurrently, each into its own buffer, and then apply
+    them in order (see field_processing.FieldProcessingPipeline). The results are unchanged, but scenes
+    with many sources scale with the number of threads in parallel_utils.
+
+    With use_static_psfs=True, the image field is computed by correlating the source field with a point
+    spread function (PSF) for each wavelength, found by propagating a unit point source through the
+    aperture modulators and imager. The PSFs and their Fourier transforms are only recomputed when the
+    parameters of the optics change, so imaging a new source field costs one real FFT and one inverse
+    per wavelength, and the aperture and modulated aperture fields are not computed. The aperture
+    modulators must be multiplicative. This treats the sources as mutually incoherent, so the image is the
+    sum of the images of the individual source grid cells, whereas the full propagation adds the plane
+    waves from all the cells coherently with no initial phase difference. The results agree for a single
+    point source, and approximately when the images of the sources barely overlap. Extended sources then
+    get the smooth incoherent image rather than the interference speckle of coherent light.
     '''
-    def __init__(self, field_of_view_x, field_of_view_y, angular_coarseness, wavelengths, use_memmaps=False):
+    def __init__(self, field_of_view_x, field_of_view_y, angular_coarseness, wavelengths, use_memmaps=False, precision='double', memmap_name_prefix=None, incremental=False, use_lazy_expressions=False, window_only_storage=False, use_point_sources=False, concurrent_stage_backend=None, use_static_psfs=False):
         self.field_of_view_x = float(field_of_view_x) # Field of view in the x-direction [rad]
         self.field_of_view_y = float(field_of_view_y) # Field of view in the y-direction [rad]
         self.angular_coarseness = float(angular_coarseness) # Angle subtended by a pixel in the center of the image plane [rad]
         self.wavelengths = np.asfarray(wavelengths) # Array of wavelengths for the incident light [m]
         self.use_memmaps = bool(use_memmaps) # Whether to conserve memory at the cost of performance by storing fields in memory mapped files
+        self.memmap_name_prefix = None if memmap_name_prefix is None else str(memmap_name_prefix) # If specified, the memory mapped source, aperture and image fields are
+                                                                                                  # kept in named files in the memmap_utils storage directory, so that
+                                                                                                  # they can be reopened later or by other processes
+        self.precision = str(precision) # Floating point precision of the fields ('double' or 'single')
+        self.real_dtype, self.complex_dtype = math_utils.get_dtypes_for_precision(self.precision)
+        self.incremental = bool(incremental) # Whether to only recompute the parts of the propagation affected by changed parameters
+        self.use_lazy_expressions = bool(use_lazy_expressions) # Whether to evaluate elementwise field operations where their results are consumed
+        self.window_only_storage = bool(window_only_storage) # Whether the aperture and image fields only store the values inside their grid windows
+        self.use_point_sources = bool(use_point_sources) # Whether to compute the aperture field directly from the sources when they are all point sources
+        self.concurrent_stage_backend = concurrent_stage_backend # Backend for generating the process fields of linear stages concurrently (None means sequential processing)
+        self.use_static_psfs = bool(use_static_psfs) # Whether to compute the image field by correlating the source field with precomputed point spread functions
+
+        self.aperture_field_fingerprint = None # Fingerprint of the source field that the aperture field was computed from
+        self.image_field_fingerprint = None # Fingerprint of the modulated aperture field (or source field and PSFs) and imager that the image field was computed from
+        self.point_spread_function_fingerprint = None # Fingerprint of the aperture modulators and imager that the point spread functions were computed for
+        self.point_spread_functions = None # Image fluxes of a centered point source with unit spectral flux, for each wavelength
+        self.kernel_spectra = None # Fourier transforms of the point spread functions
 
         assert(self.wavelengths.ndim == 1)
         self.n_wavelengths = self.wavelengths.size
@@ -56,6 +123,49 @@ class ImagingSystem:
         assert self.has_imager
         self.image_postprocessing_pipeline.add_field_processor(label, image_postprocessor)
 
+    def get_memmap_name(self, field_label):
+        '''
+        Returns the name of the backing file for the memory mapped field with the given label,
+        or None if the file should be anonymous.
+        '''
+        return None if (self.memmap_name_prefix is None or not self.use_memmaps) else '{}_{}'.format(self.memmap_name_prefix, field_label)
+
+    def flush_memmapped_fields(self):
+        '''
+        Writes any modified values of the memory mapped source, aperture and image fields to their backing files.
+        '''
+        self.get_source_field().flush()
+        self.get_aperture_field().flush()
+        if self.has_imager:
+            self.imager.get_image_field().flush()
+
+    def set_incremental(self, incremental):
+        self.incremental = bool(incremental)
+        self.aperture_field_fingerprint = None
+        self.image_field_fingerprint = None
+        for pipeline in self.get_pipelines():
+            pipeline.set_incremental(self.incremental)
+
+    def get_pipelines(self):
+        pipelines = [self.source_pipeline, self.aperture_modulation_pipeline]
+        if self.has_imager:
+            pipelines.append(self.image_postprocessing_pipeline)
+        return pipelines
+
+    def compute_stage_parameter_fingerprints(self):
+        '''
+        Returns an ordered dictionary with a fingerprint of the parameters of each stage of the
+        propagation, in the order the stages are applied. The fingerprint is None for stages whose
+        parameters are unknown. The camera is not included, since its signal field is always recomputed.
+        '''
+        stage_fingerprints = collections.OrderedDict()
+        stage_fingerprints.update(self.source_pipeline.compute_stage_parameter_fingerprints())
+        stage_fingerprints.update(self.aperture_modulation_pipeline.compute_stage_parameter_fingerprints())
+        if self.has_imager:
+            stage_fingerprints['imager'] = field_processing.compute_fingerprint(self.imager.get_parameters())
+            stage_fingerprints.update(self.image_postprocessing_pipeline.compute_stage_parameter_fingerprints())
+        return stage_fingerprints
+
     def initialize_fields(self):
         self.initialize_source_field()
         self.initialize_aperture_field()
@@ -93,12 +203,18 @@ class ImagingSystem:
                                        (-half_field_of_view_extent_y, half_field_of_view_extent_y))
 
         source_field = fields.SpectralField(self.source_grid, self.wavelengths,
-                                            dtype='float64',
+                                            dtype=self.real_dtype,
                                             initial_value=0,
                                             use_memmap=self.use_memmaps)
 
         # Initialize the pipeline object for adding source fluxes to the source field
-        self.source_pipeline = field_processing.FieldProcessingPipeline(source_field)
+        self.source_pipeline = field_processing.FieldProcessingPipeline(source_field, label='sources',
+                                                                        processed_memmap_name=self.get_memmap_name('source'),
+                                                                        incremental=self.incremental,
+                                                                        concurrent_backend=self.concurrent_stage_backend)
+
+        # The initial source field is never modified, so its fingerprint is constant
+        self.source_pipeline.set_original_field_fingerprint(field_processing.compute_fingerprint(('initial source field', 0)))
 
     def initialize_aperture_field(self):
         '''
@@ -119,11 +235,14 @@ class ImagingSystem:
 
         self.aperture_field = fields.SpectralField(self.aperture_grid, self.wavelengths,
                                                    initial_value=0,
-                                                   dtype='complex128',
-                                                   use_memmap=self.use_memmaps)
+                                                   dtype=self.complex_dtype,
+                                                   use_memmap=self.use_memmaps,
+                                                   memmap_name=self.get_memmap_name('aperture'))
 
         # Initialize the pipeline object for modulating the aperture field
-        self.aperture_modulation_pipeline = field_processing.FieldProcessingPipeline(self.aperture_field)
+        self.aperture_modulation_pipeline = field_processing.FieldProcessingPipeline(self.aperture_field, label='aperture_modulators',
+                                                                                     incremental=self.incremental,
+                                                                                     concurrent_backend=self.concurrent_stage_backend)
 
     def initialize_aperture_grid_window(self):
         assert self.has_imager
@@ -132,30 +251,176 @@ class ImagingSystem:
         self.aperture_grid.define_window((-max_normalized_aperture_radius, max_normalized_aperture_radius),
                                          (-max_normalized_aperture_radius, max_normalized_aperture_radius))
 
+        # The aperture field is zero outside the window, so only the window values need to be stored
+        if self.window_only_storage:
+            self.aperture_field.set_window_only(True)
+            self.aperture_field_fingerprint = None
+
     def initialize_image_field(self):
         assert self.has_imager
 
         self.imager.initialize_image_field(self.aperture_grid, self.wavelengths,
                                            self.field_of_view_x, self.field_of_view_y,
-                                           use_memmap=self.use_memmaps)
-
-        self.image_postprocessing_pipeline = field_processing.FieldProcessingPipeline(self.imager.get_image_field().create_window_field(copy_values=False))
+                                           dtype=self.real_dtype,
+                                           use_memmap=self.use_memmaps,
+                                           memmap_name=self.get_memmap_name('image'),
+                                           window_only=self.window_only_storage)
+
+        self.image_postprocessing_pipeline = field_processing.FieldProcessingPipeline(self.imager.get_image_field().create_window_field(copy_values=False),
+                                                                                    label='image_postprocessors',
+                                                                                    incremental=self.incremental,
+                                                                                    concurrent_backend=self.concurrent_stage_backend)
+        self.image_field_fingerprint = None
+        self.point_spread_function_fingerprint = None
 
     def run_full_propagation(self):
-        self.compute_source_field()
-        self.compute_aperture_field()
-        self.compute_modulated_aperture_field()
-        self.compute_image_field()
-        self.compute_postprocessed_image_field()
-        self.compute_camera_signal_field()
+        with profiling_utils.timed('imaging_system.run_full_propagation'):
+            self.compute_source_field()
+            if not self.use_static_psfs:
+                self.compute_aperture_field()
+                self.compute_modulated_aperture_field()
+            self.compute_image_field()
+            self.compute_postprocessed_image_field()
+            if self.has_camera:
+                self.compute_camera_signal_field()
+
+    def run_chunked_propagation(self, n_wavelengths_per_chunk):
+        '''
+        Computes the camera signal field like run_full_propagation, but pushes the wavelengths
+        through the source, aperture, image and postprocessing stages in chunks of the given size.
+        Each postprocessed chunk is integrated directly into the filter channels of the camera, so
+        only fields for a single chunk of wavelengths are held in memory at a time. The intermediate
+        fields returned by the getters only contain the last chunk. Process fields of linear stages
+        are only used if they are already stored or cached, and are not created for the chunks. With
+        static PSFs, the point spread functions are computed for all the wavelengths before the chunks
+        are propagated.
+        '''
+        assert self.has_imager
+        assert self.has_camera
+        n_wavelengths_per_chunk = int(n_wavelengths_per_chunk)
+        assert n_wavelengths_per_chunk > 0
+
+        with profiling_utils.timed('imaging_system.run_chunked_propagation'):
+            if self.use_static_psfs:
+                self.update_point_spread_functions()
+
+            pipelines = (self.source_pipeline, self.aperture_modulation_pipeline, self.image_postprocessing_pipeline)
+
+            for pipeline in pipelines:
+                pipeline.begin_wavelength_chunks()
+
+            for start_idx in range(0, self.n_wavelengths, n_wavelengths_per_chunk):
+                wavelength_slice = slice(start_idx, min(start_idx + n_wavelengths_per_chunk, self.n_wavelengths))
+                self.propagate_wavelength_chunk(wavelength_slice)
+
+            for pipeline in pipelines:
+                pipeline.end_wavelength_chunks()
+
+            self.camera.set_pixel_extents(*self.imager.get_physical_image_grid_cell_extents())
+
+    def propagate_wavelength_chunk(self, wavelength_slice):
+        '''
+        Propagates the given slice of the wavelengths from the sources to the camera signal field.
+        '''
+        with profiling_utils.timed('imaging_system.propagate_wavelength_chunk'):
+            if not self.uses_point_sources():
+                self.source_pipeline.compute_processed_wavelength_chunk(wavelength_slice)
+
+            if self.use_static_psfs:
+                image_field = self.imager.compute_image_field_from_source_field(self.get_source_field(), self.kernel_spectra, wavelength_slice=wavelength_slice)
+            else:
+                aperture_field = fields.SpectralField(self.aperture_grid, self.wavelengths[wavelength_slice],
+                                                      initial_value=0,
+                                                      dtype=self.complex_dtype,
+                                                      use_memmap=False,
+                                                      window_only=self.window_only_storage)
+                self.compute_aperture_field(aperture_field=aperture_field, wavelength_slice=wavelength_slice)
+
+                self.aperture_modulation_pipeline.compute_processed_wavelength_chunk(wavelength_slice, input_field=aperture_field)
+
+                image_field = self.imager.compute_image_field(self.get_modulated_aperture_field(), wavelength_slice=wavelength_slice)
+
+            self.image_postprocessing_pipeline.compute_processed_wavelength_chunk(wavelength_slice,
+                                                                                 input_field=image_field.create_window_field(copy_values=False))
+
+            postprocessed_image_field = self.get_postprocessed_image_field()
+
+            if wavelength_slice.start == 0:
+                self.camera.initialize_signal_field(postprocessed_image_field.grid, self.wavelengths,
+                                                    dtype=self.real_dtype,
+                                                    use_memmap=self.use_memmaps)
+
+            self.camera.add_to_signal_field(postprocessed_image_field, wavelength_slice)
+
+    def run_frame_sequence(self, phase_screen_labels, n_frames, time_step, frame_consumer, exposure_time=None):
+        '''
+        Simulates a sequence of short exposure frames while the given moving phase screens (aperture
+        modulators with a move_phase_screen method, like turbulence.MovingKolmogorovPhaseScreen) are
+        advanced by the given time step [s] between frames. The source and aperture fields are only
+        computed once, and each frame only recomputes the stages from the aperture modulation onwards
+        (if the system is incremental, only from the first moving phase screen onwards). With static PSFs,
+        the point spread functions are recomputed for each frame and correlated with the source field.
+
+        Each frame is handed to frame_consumer(frame_idx, frame_time, frame_field) and is not stored, so
+        arbitrarily long sequences can be simulated with constant memory. The frame field is the captured
+        camera signal field if an exposure time is given, the camera signal field if the system has a
+        camera, and the postprocessed image field otherwise. The field may be replaced or modified when
+        the next frame is computed, so consumers must copy anything they want to keep (see FrameAccumulator).
+        '''
+        assert self.has_imager
+        phase_screen_labels = [phase_screen_labels] if isinstance(phase_screen_labels, str) else list(phase_screen_labels)
+        phase_screens = [self.get_aperture_modulator(label) for label in phase_screen_labels]
+        assert exposure_time is None or self.has_camera
+
+        with profiling_utils.timed('imaging_system.run_frame_sequence'):
+            self.compute_source_field()
+            if not self.use_static_psfs:
+                self.compute_aperture_field()
+
+            for frame_idx in range(int(n_frames)):
+                if frame_idx > 0:
+                    for phase_screen in phase_screens:
+                        phase_screen.move_phase_screen(time_step)
+
+                with profiling_utils.timed('imaging_system.compute_frame'):
+                    if not self.use_static_psfs:
+                        self.compute_modulated_aperture_field()
+                    self.compute_image_field()
+                    self.compute_postprocessed_image_field()
+
+                    if exposure_time is not None:
+                        self.compute_camera_signal_field()
+                        self.capture_exposure(exposure_time)
+                        frame_field = self.camera.get_captured_signal_field()
+                    elif self.has_camera:
+                        self.compute_camera_signal_field()
+                        frame_field = self.get_camera_signal_field()
+                    else:
+                        frame_field = self.get_postprocessed_image_field()
+
+                profiling_utils.increment_counter('imaging_system.frames')
+                frame_consumer(frame_idx, frame_idx*time_step, frame_field)
 
     def capture_exposure(self, exposure_time):
-        self.camera.compute_captured_signal_field(exposure_time, use_memmap=self.use_memmaps)
+        with profiling_utils.timed('imaging_system.capture_exposure'):
+            self.camera.compute_captured_signal_field(exposure_time, use_memmap=self.use_memmaps, use_lazy_expression=self.use_lazy_expressions)
+
+    def uses_point_sources(self):
+        '''
+        Whether the aperture field is computed directly from point sources, skipping the source field.
+        This is never the case with static PSFs, which are applied to the source field.
+        '''
+        processors = self.source_pipeline.get_processors()
+        return self.use_point_sources and not self.use_static_psfs and len(processors) > 0 and \
+               all(isinstance(processor, field_processing.PointSourceFieldProcessor) for processor in processors)
 
     def compute_source_field(self):
-        self.source_pipeline.compute_processed_field()
+        if self.uses_point_sources():
+            return
+        with profiling_utils.timed('imaging_system.compute_source_field'):
+            self.source_pipeline.compute_processed_field()
 
-    def compute_aperture_field(self):
+    def compute_aperture_field(self, aperture_field=None, wavelength_slice=None):
         '''
         Computes the aperture field by taking the Fourier transform of the square root
         of the source field. This corresponds to summing up the plane waves incident on
@@ -163,12 +428,64 @@ class ImagingSystem:
         assumed to have no initial phase difference, and the high-frequency temporal phase
         shifts due to the oscillations of the electromagnetic field are neglected (since
         these will average out over a very short time).
+
+        Since the source amplitudes are real, only the Fourier coefficients inside the
+        aperture window are computed, using a real-input FFT.
+
+        The result is stored in the given aperture field, or in the aperture field of the
+        imaging system if none is given. In the latter case, the computation is skipped if the
+        system is incremental and the source field is unchanged since the last computation.
+        If a wavelength slice is given, the given aperture field only contains those wavelengths.
+        '''
+        with profiling_utils.timed('imaging_system.compute_aperture_field'):
+            is_system_aperture_field = aperture_field is None
+
+            if is_system_aperture_field:
+                if self.uses_point_sources():
+                    # The source field is skipped, so the fingerprint is found from the sources directly
+                    source_field_fingerprint = self.source_pipeline.compute_stage_output_fingerprints()[-1] if self.incremental else None
+                else:
+                    source_field_fingerprint = self.source_pipeline.get_processed_field_fingerprint()
+                if source_field_fingerprint is not None and source_field_fingerprint == self.aperture_field_fingerprint:
+                    profiling_utils.increment_counter('imaging_system.reused_aperture_fields')
+                    return
+                aperture_field = self.aperture_field
+
+            if self.uses_point_sources():
+                aperture_field.set_values_inside_window(self.compute_point_source_aperture_values(wavelength_slice))
+            else:
+                total_source_amplitude_field = self.get_source_field().with_function_applied(np.sqrt, lazy=self.use_lazy_expressions)
+                aperture_field.set_values_inside_window(total_source_amplitude_field.compute_fourier_transformed_values(output_window=self.aperture_grid.window))
+
+            if is_system_aperture_field:
+                self.aperture_field_fingerprint = source_field_fingerprint
+                self.aperture_modulation_pipeline.set_original_field_fingerprint(self.aperture_field_fingerprint,
+                                                                                 is_deterministic=self.source_pipeline.has_deterministic_output())
+
+    def compute_point_source_aperture_values(self, wavelength_slice=None):
         '''
-        total_source_amplitude_field = self.get_source_field().with_function_applied(np.sqrt)
-        self.aperture_field.set_values_inside_window(total_source_amplitude_field.compute_fourier_transformed_values())
+        Computes the aperture field values inside the aperture window by summing the plane waves from each
+        point source, which gives the same result as transforming the square root of the source field.
+        '''
+        point_sources = []
+        for processor in self.source_pipeline.get_processors():
+            processor.set_wavelength_slice(wavelength_slice)
+            point_sources.append(processor.compute_point_sources())
+
+        x_indices = np.concatenate([x_indices for x_indices, _, _ in point_sources])
+        y_indices = np.concatenate([y_indices for _, y_indices, _ in point_sources])
+        spectral_fluxes = np.concatenate([spectral_fluxes for _, _, spectral_fluxes in point_sources], axis=1)
+
+        # Fluxes from different processors in the same cell add up before the square root is taken, as in the source field
+        x_indices, y_indices, spectral_fluxes = field_processing.combine_overlapping_point_sources(self.source_grid, x_indices, y_indices, spectral_fluxes)
+
+        return parallel_utils.parallel_point_source_fourier_transform(x_indices, y_indices, np.sqrt(spectral_fluxes),
+                                                                      self.source_grid.shape, self.aperture_grid.window,
+                                                                      centered=self.source_grid.is_centered)
 
     def compute_modulated_aperture_field(self):
-        self.aperture_modulation_pipeline.compute_processed_field()
+        with profiling_utils.timed('imaging_system.compute_modulated_aperture_field'):
+            self.aperture_modulation_pipeline.compute_processed_field()
 
     def compute_transmitted_aperture_field(self):
         assert self.has_aperture
@@ -178,22 +495,103 @@ class ImagingSystem:
         return transmitted_aperture_field
 
     def compute_image_field(self):
+        '''
+        Computes the image field from the modulated aperture field, or with static PSFs, from the source
+        field and the point spread functions. The computation is skipped if the system is incremental and
+        neither the input fields nor the imager have changed since the last computation.
+        '''
         assert self.has_imager
-        self.imager.compute_image_field(self.get_modulated_aperture_field())
+        with profiling_utils.timed('imaging_system.compute_image_field'):
+            if self.use_static_psfs:
+                self.update_point_spread_functions()
+                input_fingerprints = (self.source_pipeline.get_processed_field_fingerprint(), self.point_spread_function_fingerprint)
+                is_deterministic = self.source_pipeline.has_deterministic_output() and self.aperture_modulation_pipeline.has_deterministic_stages()
+            else:
+                input_fingerprints = (self.aperture_modulation_pipeline.get_processed_field_fingerprint(),)
+                is_deterministic = self.aperture_modulation_pipeline.has_deterministic_output()
+
+            image_field_fingerprint = None if None in input_fingerprints else \
+                field_processing.compute_fingerprint((*input_fingerprints, self.imager.get_parameters()))
+
+            if image_field_fingerprint is not None and image_field_fingerprint == self.image_field_fingerprint:
+                profiling_utils.increment_counter('imaging_system.reused_image_fields')
+                return
+
+            if self.use_static_psfs:
+                self.imager.compute_image_field_from_source_field(self.get_source_field(), self.kernel_spectra)
+            else:
+                self.imager.compute_image_field(self.get_modulated_aperture_field())
+
+            self.image_field_fingerprint = image_field_fingerprint
+            self.image_postprocessing_pipeline.set_original_field_fingerprint(self.image_field_fingerprint, is_deterministic=is_deterministic)
+
+    def compute_point_spread_function_fingerprint(self):
+        '''
+        Returns a fingerprint of the parameters determining the point spread functions, or None if
+        some aperture modulator does not report its parameters.
+        '''
+        stage_fingerprints = list(self.aperture_modulation_pipeline.compute_stage_parameter_fingerprints().values())
+        if None in stage_fingerprints:
+            return None
+        return field_processing.compute_fingerprint(('point spread functions', stage_fingerprints, self.imager.get_parameters()))
+
+    def update_point_spread_functions(self):
+        '''
+        Computes the point spread function for each wavelength, by propagating a point source with unit
+        spectral flux in the center of the source grid through the aperture modulators and imager, along
+        with the Fourier transforms used for correlating them with source fields. The computation is
+        skipped if the parameters of the aperture modulators and imager are unchanged.
+        '''
+        assert self.has_imager
+        point_spread_function_fingerprint = self.compute_point_spread_function_fingerprint()
+
+        if point_spread_function_fingerprint is not None and point_spread_function_fingerprint == self.point_spread_function_fingerprint:
+            profiling_utils.increment_counter('imaging_system.reused_point_spread_functions')
+            return
+
+        assert all(isinstance(processor, field_processing.MultiplicativeFieldProcessor) for processor in self.aperture_modulation_pipeline.get_processors())
+
+        with profiling_utils.timed('imaging_system.update_point_spread_functions'):
+            # The Fourier transform of the square root of a centered unit point source is one everywhere,
+            # and the aperture field is only computed inside the aperture window
+            point_source_aperture_field = fields.SpectralField(self.aperture_grid, self.wavelengths,
+                                                               initial_value=0,
+                                                               dtype=self.complex_dtype,
+                                                               window_only=self.window_only_storage)
+            point_source_aperture_field.set_values_inside_window(np.ones(point_source_aperture_field.window_shape, dtype=self.complex_dtype))
+
+            self.aperture_modulation_pipeline.apply_stages_to_field(point_source_aperture_field)
+
+            self.point_spread_functions = self.imager.compute_point_spread_functions(point_source_aperture_field)
+            self.kernel_spectra = parallel_utils.parallel_compute_periodic_kernel_spectrum(self.point_spread_functions)
+
+        self.point_spread_function_fingerprint = point_spread_function_fingerprint
 
     def compute_postprocessed_image_field(self):
         assert self.has_imager
-        self.image_postprocessing_pipeline.compute_processed_field()
+        with profiling_utils.timed('imaging_system.compute_postprocessed_image_field'):
+            self.image_postprocessing_pipeline.compute_processed_field()
 
     def compute_camera_signal_field(self):
         assert self.has_camera
-        self.camera.compute_signal_field(self.get_postprocessed_image_field(), use_memmap=self.use_memmaps)
-        self.camera.set_pixel_extents(*self.imager.get_physical_image_grid_cell_extents())
+        with profiling_utils.timed('imaging_system.compute_camera_signal_field'):
+            self.camera.compute_signal_field(self.get_postprocessed_image_field(), use_memmap=self.use_memmaps)
+            self.camera.set_pixel_extents(*self.imager.get_physical_image_grid_cell_extents())
 
     def compute_rayleigh_limit(self, wavelength):
         assert self.has_imager
         return 1.22*wavelength/self.imager.get_aperture_diameter()
 
+    def estimate_relative_image_flux_error(self):
+        '''
+        Estimates an upper bound for the relative RMS rounding error of the image fluxes due to the
+        floating point precision. The error is dominated by the two 2D FFTs (source to aperture and
+        aperture to image), and doubles when the Fourier coefficients are squared to obtain fluxes.
+        '''
+        assert self.has_imager
+        return 2*(math_utils.estimate_relative_fft_error(self.source_grid.get_total_size(), self.real_dtype) +
+                  math_utils.estimate_relative_fft_error(self.aperture_grid.get_total_size(), self.real_dtype))
+
     def compute_source_spectral_powers(self):
         raise NotImplementedError
         return np.sum(self.get_source_field().get_values_inside_window(), axis=(1,2))*self.get_aperture().get_area()
@@ -210,6 +608,9 @@ class ImagingSystem:
     def compute_modulated_spectral_powers(self):
         return self.compute_spectral_powers_of_aperture_field(self.get_modulated_aperture_field())
 
+    def get_precision(self):
+        return self.precision
+
     def get_source_field(self):
         return self.source_pipeline.get_processed_field()
 
@@ -223,6 +624,10 @@ class ImagingSystem:
         assert self.has_imager
         return self.imager.get_image_field()
 
+    def get_point_spread_functions(self):
+        assert self.point_spread_functions is not None
+        return self.point_spread_functions
+
     def get_postprocessed_image_field(self):
         assert self.has_imager
         return self.image_postprocessing_pipeline.get_processed_field()
@@ -307,3 +712,42 @@ class ImagingSystem:
     def visualize_captured_camera_signal_field(self, **plot_kwargs):
         fields.visualize_field(self.camera.get_captured_signal_field(), **plot_kwargs)
 
+
+class FrameAccumulator:
+    '''
+    Frame consumer for ImagingSystem.run_frame_sequence that sums the frames block by block, optionally
+    only the frames accepted by frame_selector(frame_field), for example frames with a sharpness metric
+    above a threshold for lucky imaging. Only the running sum is stored.
+    '''
+    def __init__(self, frame_selector=None):
+        self.frame_selector = frame_selector # Function returning whether to include a given frame field (all frames are included if None)
+        self.summed_field = None
+        self.n_frames = 0
+        self.n_accepted_frames = 0
+
+    def __call__(self, frame_idx, frame_time, frame_field):
+        self.n_frames += 1
+        if self.frame_selector is not None and not self.frame_selector(frame_field):
+            return
+
+        if self.summed_field is None:
+            self.summed_field = frame_field.create_field_with_values(np.zeros(frame_field.storage_shape, dtype='float64'), use_memmap=False)
+
+        self.summed_field.prepare_for_modification()
+        for block_indices, block_values in frame_field.generate_blocks():
+            self.summed_field.values[block_indices] += block_values
+
+        self.n_accepted_frames += 1
+
+    def get_summed_field(self):
+        assert self.summed_field is not None
+        return self.summed_field
+
+    def get_mean_field(self):
+        return self.get_summed_field().multiplied(1/self.n_accepted_frames)
+
+    def get_number_of_frames(self):
+        return self.n_frames
+
+    def get_number_of_accepted_frames(self):
+        return self.n_accepted_frames
@@ -3,13 +3,51 @@
 # Author: Lars Frogner
 import numpy as np
 import numba
+import fft_utils
 
 
-@numba.vectorize([numba.float64(numba.complex128),numba.float32(numba.complex64)])
+# The single precision signature must come first, since numpy picks the first loop the input can be cast to
+@numba.vectorize([numba.float32(numba.complex64), numba.float64(numba.complex128)])
 def abs2(x):
     return x.real**2 + x.imag**2
 
 
+precision_dtypes = {'double': (np.dtype('float64'), np.dtype('complex128')),
+                    'single': (np.dtype('float32'), np.dtype('complex64'))}
+
+
+def get_dtypes_for_precision(precision):
+    '''
+    Returns the real and complex data types to use for the given floating point precision ('double' or 'single').
+    '''
+    assert precision in precision_dtypes
+    return precision_dtypes[precision]
+
+
+def get_real_dtype(dtype):
+    '''
+    Returns the real data type with the same precision as the given real or complex data type.
+    '''
+    return np.finfo(np.dtype(dtype)).dtype
+
+
+def get_complex_dtype(dtype):
+    '''
+    Returns the complex data type with the same precision as the given real or complex data type.
+    '''
+    return np.result_type(get_real_dtype(dtype), np.complex64)
+
+
+def estimate_relative_fft_error(size, dtype):
+    '''
+    Estimates an upper bound for the relative RMS rounding error of an FFT of an array with the given
+    total size, computed with the precision of the given data type. The error of the Cooley-Tukey
+    algorithm grows on average as eps*sqrt(log2(size)) and at worst as eps*log2(size), where
+    eps is the machine epsilon. The worst case is returned.
+    '''
+    return np.finfo(np.dtype(dtype)).eps*np.log2(max(size, 2))
+
+
 @numba.jit
 def is_sorted(array):
     for i in range(len(array)-1):
@@ -196,3 +234,17 @@ def direction_vector_from_angular_coordinates(angular_x_coordinate, angular_y_co
     direction_vector_x = angular_x_coordinate*scale
     direction_vector_y = angular_y_coordinate*scale
     return direction_vector_x, direction_vector_y
+
+
+def load_pyfftw_wisdom(wisdom_path=None):
+    '''
+    Imports previously saved FFTW wisdom, so that FFT plans for known shapes can be created without measuring.
+    '''
+    return fft_utils.load_pyfftw_wisdom(wisdom_path=wisdom_path)
+
+
+def save_pyfftw_wisdom(wisdom_path=None):
+    '''
+    Saves the FFTW wisdom accumulated in the current run, so that later runs can skip planning.
+    '''
+    fft_utils.save_pyfftw_wisdom(wisdom_path=wisdom_path)
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+# This file is part of the APSimulator API.
+# Author: Lars Frogner
+import numpy as np
+import os
+import json
+import mmap
+import tempfile
+
+
+storage_directory = None # Directory holding the files backing memory mapped arrays (None means the system temporary directory)
+tile_size = None # Preferred number of bytes to read or write at once (None means the block size of the storage device)
+page_size = mmap.ALLOCATIONGRANULARITY # Memory mapped tiles start on multiples of this number of bytes
+
+backing_file_extension = '.dat'
+header_file_extension = '.json'
+
+
+def set_storage_directory(directory):
+    '''
+    Sets the directory where the files backing memory mapped arrays are placed, for example a
+    fast local scratch disk. The directory is created if it does not exist. Passing None reverts
+    to the system temporary directory.
+    '''
+    global storage_directory
+    if directory is None:
+        storage_directory = None
+    else:
+        storage_directory = os.path.abspath(os.path.expanduser(str(directory)))
+        os.makedirs(storage_directory, exist_ok=True)
+
+
+def get_storage_directory():
+    return tempfile.gettempdir() if storage_directory is None else storage_directory
+
+
+def set_tile_size(n_bytes):
+    '''
+    Sets the preferred number of bytes per tile when memory mapped arrays are filled or copied
+    tile by tile. The size is rounded up to a whole number of pages. Passing None makes the
+    tile size follow the block size of the device holding the storage directory.
+    '''
+    global tile_size
+    if n_bytes is None:
+        tile_size = None
+    else:
+        assert int(n_bytes) > 0
+        tile_size = round_up_to_page_size(int(n_bytes))
+
+
+def get_tile_size():
+    if tile_size is not None:
+        return tile_size
+    try:
+        device_block_size = os.statvfs(get_storage_directory()).f_bsize
+    except (AttributeError, OSError):
+        device_block_size = page_size
+    # Use reasonably large tiles even on devices with small blocks, to limit the per-tile overhead
+    return round_up_to_page_size(max(device_block_size, 1024*page_size))
+
+
+def round_up_to_page_size(n_bytes):
+    return ((n_bytes + page_size - 1)//page_size)*page_size
+
+
+def get_backing_file_path(name):
+    return os.path.join(get_storage_directory(), str(name) + backing_file_extension)
+
+
+def get_header_file_path(name):
+    return os.path.join(get_storage_directory(), str(name) + header_file_extension)
+
+
+def create_memmap(shape, dtype, name=None):
+    '''
+    Creates a memory mapped array in the storage directory. If no name is given, the backing file
+    is anonymous and is deleted when the array is garbage collected. Otherwise the backing file is
+    kept under the given name, together with a small header file describing the array, so that
+    it can be reopened later (also by other processes) with open_memmap.
+    The array data starts at the beginning of the backing file, so tiles aligned to page
+    boundaries in the array are also aligned to pages in the file.
+    '''
+    dtype = np.dtype(dtype)
+    if name is None:
+        # The file is unlinked when the with block exits, but the mapping keeps the data accessible
+        # until the memmap object goes out of scope.
+        with tempfile.NamedTemporaryFile(dir=get_storage_directory()) as temporary_file:
+            return np.memmap(temporary_file, shape=shape, dtype=dtype, mode='w+')
+    else:
+        values = np.memmap(get_backing_file_path(name), shape=shape, dtype=dtype, mode='w+')
+        with open(get_header_file_path(name), 'w') as f:
+            json.dump({'shape': list(values.shape), 'dtype': dtype.str}, f)
+        return values
+
+
+def open_memmap(name, mode='r+'):
+    '''
+    Reopens the named memory mapped array created with create_memmap. Use mode='r' for read-only
+    access and mode='c' for copy-on-write access, where changes are not written to the file.
+    '''
+    assert mode in ('r', 'r+', 'c')
+    assert memmap_exists(name)
+    with open(get_header_file_path(name), 'r') as f:
+        header = json.load(f)
+    return np.memmap(get_backing_file_path(name), shape=tuple(header['shape']), dtype=np.dtype(header['dtype']), mode=mode)
+
+
+def memmap_exists(name):
+    return os.path.isfile(get_backing_file_path(name)) and os.path.isfile(get_header_file_path(name))
+
+
+def delete_memmap(name):
+    '''
+    Removes the files of the named memory mapped array. Existing mappings of the array remain valid
+    until they are closed.
+    '''
+    for path in (get_backing_file_path(name), get_header_file_path(name)):
+        if os.path.isfile(path):
+            os.remove(path)
+
+
+def compute_tile_length(shape, dtype, tile_size=None):
+    '''
+    Returns the number of elements along the first axis of the given array shape to include in each
+    tile. Tiles cover whole subarrays along the first axis, and span a whole number of pages whenever
+    a subarray is not itself a whole number of pages. If no tile size (in bytes) is given, the one
+    returned by get_tile_size is used.
+    '''
+    if len(shape) == 0 or shape[0] == 0:
+        return 1
+    subarray_bytes = int(np.prod(shape[1:], dtype='int64'))*np.dtype(dtype).itemsize
+    if subarray_bytes == 0:
+        return shape[0]
+    # Smallest number of subarrays that spans a whole number of pages
+    aligned_length = page_size//np.gcd(subarray_bytes, page_size)
+    n_aligned_groups = max(1, (get_tile_size() if tile_size is None else tile_size)//(aligned_length*subarray_bytes))
+    return min(shape[0], n_aligned_groups*aligned_length)
+
+
+def generate_tile_indices(shape, dtype, tile_size=None):
+    '''
+    Yields index tuples dividing an array with the given shape and data type into tiles. The tiles
+    are taken along the outermost axis for which a single subarray fits within the tile size
+    (in bytes, by default the one returned by get_tile_size).
+    '''
+    tile_size = get_tile_size() if tile_size is None else int(tile_size)
+    itemsize = np.dtype(dtype).itemsize
+    tiled_axis = 0
+    while tiled_axis < len(shape) - 1 and int(np.prod(shape[tiled_axis+1:], dtype='int64'))*itemsize > tile_size:
+        tiled_axis += 1
+
+    if len(shape) == 0:
+        yield ()
+        return
+
+    tile_length = compute_tile_length(shape[tiled_axis:], dtype, tile_size=tile_size)
+    for outer_indices in np.ndindex(*shape[:tiled_axis]):
+        for start_idx in range(0, shape[tiled_axis], tile_length):
+            yield outer_indices + (slice(start_idx, start_idx + tile_length),)
+
+
+def fill_by_tiles(values, new_values):
+    '''
+    Assigns the given constant or array (which must be broadcastable to the shape of the given array)
+    to the given array one tile at a time, so that a memory mapped array is written in page-aligned
+    pieces and only one tile of a temporary array needs to be resident at once.
+    '''
+    if isinstance(new_values, np.ndarray):
+        new_values = np.broadcast_to(new_values, values.shape)
+        for tile_indices in generate_tile_indices(values.shape, values.dtype):
+            values[tile_indices] = new_values[tile_indices]
+    else:
+        for tile_indices in generate_tile_indices(values.shape, values.dtype):
+            values[tile_indices] = new_values
+
+
+def flush(values):
+    '''
+    Writes any modified pages of the given memory mapped array to its backing file.
+    Does nothing for regular arrays.
+    '''
+    if isinstance(values, np.memmap):
+        values.flush()
@@ -2,13 +2,26 @@
 # This file is part of the APSimulator API.
 # Author: Lars Frogner
 import numpy as np
-import scipy.signal
-import joblib
 import multiprocessing as mp
-import time
+import concurrent.futures
+import threading
+import atexit
+import weakref
+import functools
+from multiprocessing import shared_memory
+import fft_utils
+import math_utils
+import grids
+import profiling_utils
 
 
 n_threads = 1
+thread_pool = None # Persistent pool of worker threads shared by all parallel jobs
+worker_thread_state = threading.local()
+process_pool = None # Persistent pool of worker processes used by jobs run with the process backend
+process_start_method = 'spawn' # How worker processes are started (see the multiprocessing documentation)
+shared_memory_blocks = {} # Shared memory blocks backing the shared arrays that are still in use, keyed by name
+released_shared_memory_blocks = [] # Unlinked blocks whose arrays have been garbage collected, waiting to be closed
 
 
 def set_number_of_threads(n_threads_argument):
@@ -16,16 +29,229 @@ def set_number_of_threads(n_threads_argument):
     Determines a valid number of threads based on the given argument and assigns
     to the global n_threads variable. If n_threads='auto', the number of threads
     will correspond to the total number of logical cpu cores of the machine.
+    The thread pool used by all parallel jobs is created here, and replaced only
+    if the number of threads changes.
     '''
     global n_threads
     max_threads = mp.cpu_count()
-    n_threads = max_threads if n_threads_argument == 'auto' else min(max_threads, max(1, int(n_threads_argument)))
+    new_n_threads = max_threads if n_threads_argument == 'auto' else min(max_threads, max(1, int(n_threads_argument)))
+    if new_n_threads != n_threads:
+        shutdown_thread_pool()
+        shutdown_process_pool()
+        n_threads = new_n_threads
+    get_thread_pool()
 
 
 def get_number_of_threads():
     return n_threads
 
 
+def mark_as_worker_thread():
+    worker_thread_state.is_worker = True
+
+
+def is_worker_thread():
+    return getattr(worker_thread_state, 'is_worker', False)
+
+
+def get_thread_pool():
+    '''
+    Returns the persistent thread pool, creating it if it does not exist. No pool is used
+    when only one thread is requested.
+    '''
+    global thread_pool
+    if thread_pool is None and n_threads > 1:
+        thread_pool = concurrent.futures.ThreadPoolExecutor(max_workers=n_threads,
+                                                            thread_name_prefix='apsimulator',
+                                                            initializer=mark_as_worker_thread)
+    return thread_pool
+
+
+def shutdown_thread_pool():
+    '''
+    Waits for any running jobs to finish and terminates the worker threads. A new pool will be
+    created the next time a parallel job is run with more than one thread.
+    '''
+    global thread_pool
+    if thread_pool is not None:
+        thread_pool.shutdown(wait=True)
+        thread_pool = None
+
+
+atexit.register(shutdown_thread_pool)
+
+
+def set_process_start_method(start_method):
+    '''
+    Sets the method used for starting worker processes ('spawn', 'fork' or 'forkserver').
+    Forking is faster, but is unsafe when other threads are running.
+    '''
+    global process_start_method
+    assert start_method in mp.get_all_start_methods()
+    if start_method != process_start_method:
+        shutdown_process_pool()
+        process_start_method = start_method
+
+
+def get_process_pool():
+    '''
+    Returns the persistent process pool with n_threads worker processes, creating it if it does
+    not exist. No pool is used when only one worker is requested.
+    '''
+    global process_pool
+    if process_pool is None and n_threads > 1:
+        process_pool = concurrent.futures.ProcessPoolExecutor(max_workers=n_threads,
+                                                              mp_context=mp.get_context(process_start_method))
+    return process_pool
+
+
+def shutdown_process_pool():
+    global process_pool
+    if process_pool is not None:
+        process_pool.shutdown(wait=True)
+        process_pool = None
+
+
+atexit.register(shutdown_process_pool)
+
+
+class SharedMemoryArray(np.ndarray):
+    '''
+    Array subclass used for the arrays owning a shared memory block. Views of the owner are
+    ordinary arrays, but keep the owner alive since their base is the owner.
+    '''
+    pass
+
+
+def create_shared_array(shape, dtype):
+    '''
+    Returns an uninitialized array with the given shape and dtype, stored in a shared memory
+    block. Such arrays (and views of them) are passed to worker processes by reference rather
+    than by copying. The block is released when the array and all views of it are gone.
+    '''
+    close_released_shared_memory_blocks()
+    dtype = np.dtype(dtype)
+    block = shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(shape))*dtype.itemsize))
+    owner = np.ndarray.__new__(SharedMemoryArray, shape, dtype=dtype, buffer=block.buf)
+    owner.block_name = block.name
+    shared_memory_blocks[block.name] = block
+    weakref.finalize(owner, release_shared_memory_block, block.name)
+    return np.asarray(owner)
+
+
+def release_shared_memory_block(block_name):
+    '''
+    Unlinks the shared memory block with the given name. The block can only be closed after
+    the owner array has been completely deallocated, so closing is deferred.
+    '''
+    block = shared_memory_blocks.pop(block_name)
+    block.unlink()
+    released_shared_memory_blocks.append(block)
+
+
+def close_released_shared_memory_blocks():
+    while len(released_shared_memory_blocks) > 0:
+        released_shared_memory_blocks.pop().close()
+
+
+def find_shared_memory_owner(values):
+    '''
+    Returns the owner of the shared memory block that the given array is a view into, or None if
+    the array is not stored in shared memory.
+    '''
+    base = values
+    while isinstance(base, np.ndarray):
+        if isinstance(base, SharedMemoryArray):
+            return base
+        base = base.base
+    return None
+
+
+class SharedArrayReference:
+    '''
+    Picklable description of an array stored in a shared memory block, which a worker process
+    can use to attach to the same memory.
+    '''
+    def __init__(self, values, owner):
+        self.block_name = owner.block_name
+        self.shape = values.shape
+        self.dtype = values.dtype
+        self.strides = values.strides
+        self.offset = values.__array_interface__['data'][0] - owner.__array_interface__['data'][0]
+
+    def attach(self, attached_blocks):
+        block = shared_memory.SharedMemory(name=self.block_name)
+        attached_blocks.append(block)
+        return np.ndarray(self.shape, dtype=self.dtype, buffer=block.buf, offset=self.offset, strides=self.strides)
+
+
+def share_input_values(input_values, temporary_arrays):
+    '''
+    Replaces the arrays in the given input values (an array or a possibly nested tuple or list) with
+    references to shared memory. Arrays that are not already in shared memory are copied into new
+    shared arrays, which are appended to the given list so that they are kept alive during the job.
+    '''
+    if isinstance(input_values, np.ndarray):
+        owner = find_shared_memory_owner(input_values)
+        if owner is None:
+            shared_values = create_shared_array(input_values.shape, input_values.dtype)
+            shared_values[...] = input_values
+            temporary_arrays.append(shared_values)
+            input_values = shared_values
+            owner = find_shared_memory_owner(shared_values)
+        return SharedArrayReference(input_values, owner)
+    elif isinstance(input_values, (tuple, list)):
+        return type(input_values)(share_input_values(values, temporary_arrays) for values in input_values)
+    else:
+        return input_values
+
+
+def attach_input_values(input_values, attached_blocks):
+    if isinstance(input_values, SharedArrayReference):
+        return input_values.attach(attached_blocks)
+    elif isinstance(input_values, (tuple, list)):
+        return type(input_values)(attach_input_values(values, attached_blocks) for values in input_values)
+    else:
+        return input_values
+
+
+def run_shared_memory_job(parallel_job, output_reference, input_references, start_idx, end_idx):
+    '''
+    Runs the given job in a worker process on arrays attached from shared memory.
+    '''
+    attached_blocks = []
+    output_values = output_reference.attach(attached_blocks)
+    input_values = attach_input_values(input_references, attached_blocks)
+
+    parallel_job(output_values, input_values, start_idx, end_idx)
+
+    # The arrays must be gone before the blocks can be closed
+    del output_values, input_values
+    for block in attached_blocks:
+        block.close()
+
+
+class ThreadPool:
+    '''
+    Context manager for running a block of code with the given number of threads. The thread
+    pool is shut down and the previous number of threads restored when the block is exited.
+    '''
+    def __init__(self, n_threads_argument='auto'):
+        self.n_threads_argument = n_threads_argument
+
+    def __enter__(self):
+        self.previous_n_threads = n_threads
+        set_number_of_threads(self.n_threads_argument)
+        return self
+
+    def __exit__(self, *exception_info):
+        global n_threads
+        shutdown_thread_pool()
+        shutdown_process_pool()
+        n_threads = self.previous_n_threads
+        return False
+
+
 def subranges(n_elements):
     '''
     Iterator that returns n_threads consecutive subranges in the total range [0, n_elements].
@@ -40,65 +266,329 @@ def subranges(n_elements):
         yield remaining + i*chunk_size, remaining + (i+1)*chunk_size
 
 
-def parallelize_over_axis(input_values, shape, axis, output_dtype, parallel_job, timing=True):
+def parallelize_over_axis(input_values, shape, axis, output_dtype, parallel_job, timing=True, backend='threads'):
     '''
     Runs the given job concurrently with the given number of threads, parallelizing over the given
     axis of one or more input arrays of the given shape and returning an output array of the given
     shape and dtype. The input_values argument is passed directly to the job function and can be
-    of any form that the job function accepts.
+    of any form that the job function accepts. The job chunks are submitted to the persistent thread
+    pool. Jobs started from inside a worker thread are run serially to avoid exhausting the pool.
+    If timing=True, the job is timed under its name when profiling is enabled (see profiling_utils).
+
+    With backend='processes', the chunks are instead run in the persistent pool of worker processes,
+    which is useful for jobs that hold the global interpreter lock. The output array is then stored
+    in shared memory, and the arrays in the input values (an array or a tuple or list) are passed
+    to the workers through shared memory, copying them only if they are not already stored there
+    (see create_shared_array). The job must be a module-level function, and the other input
+    values must be picklable.
     '''
+    assert backend in ('threads', 'processes')
 
-    output_values = np.empty(shape, dtype=output_dtype)
+    if is_worker_thread():
+        pool = None
+    else:
+        pool = get_thread_pool() if backend == 'threads' else get_process_pool()
 
-    if timing:
-        print('Parallel job started with {:d} threads'.format(n_threads))
-        start_time = time.time()
+    with (profiling_utils.timed('parallel_utils.{}'.format(parallel_job.__name__)) if timing else profiling_utils.null_timer):
+        if pool is None:
+            output_values = np.empty(shape, dtype=output_dtype)
+            parallel_job(output_values, input_values, 0, shape[axis])
+            profiling_utils.increment_counter('parallel_utils.serial_jobs')
+        elif backend == 'threads':
+            output_values = np.empty(shape, dtype=output_dtype)
+            futures = [pool.submit(parallel_job, output_values, input_values, start_idx, end_idx)
+                       for start_idx, end_idx in subranges(shape[axis]) if end_idx > start_idx]
+            for future in futures:
+                future.result()
+            profiling_utils.increment_counter('parallel_utils.parallel_jobs')
+            profiling_utils.increment_counter('parallel_utils.job_chunks', len(futures))
+        else:
+            output_values = create_shared_array(shape, output_dtype)
+            temporary_arrays = []
+            output_reference = SharedArrayReference(output_values, find_shared_memory_owner(output_values))
+            input_references = share_input_values(input_values, temporary_arrays)
+            futures = [pool.submit(run_shared_memory_job, parallel_job, output_reference, input_references, start_idx, end_idx)
+                       for start_idx, end_idx in subranges(shape[axis]) if end_idx > start_idx]
+            for future in futures:
+                future.result()
+            profiling_utils.increment_counter('parallel_utils.process_jobs')
+            profiling_utils.increment_counter('parallel_utils.job_chunks', len(futures))
 
-    joblib.Parallel(n_jobs=n_threads, prefer='threads', require='sharedmem')(
-        joblib.delayed(parallel_job)(output_values, input_values, start_idx, end_idx) for start_idx, end_idx in subranges(shape[axis]))
+    return output_values
 
-    if timing:
-        end_time = time.time()
-        print('Parallel job ended after time {:g} s'.format(end_time - start_time))
 
-    return output_values
+def run_tasks_concurrently(task, task_arguments, backend='threads'):
+    '''
+    Calls the given task function once for each tuple of arguments in the given list, running the
+    calls concurrently in the persistent thread or process pool, and returns a list of the results
+    in the same order. Parallel jobs started by the tasks run serially inside worker threads. With
+    backend='processes', the task must be a module-level function, and the arguments and results
+    must be picklable. The calls are run serially when only one thread is used.
+    '''
+    assert backend in ('threads', 'processes')
+    task_arguments = list(task_arguments)
 
+    if is_worker_thread():
+        pool = None
+    else:
+        pool = get_thread_pool() if backend == 'threads' else get_process_pool()
+
+    with profiling_utils.timed('parallel_utils.{}'.format(task.__name__)):
+        if pool is None:
+            results = [task(*arguments) for arguments in task_arguments]
+            profiling_utils.increment_counter('parallel_utils.serial_tasks', len(task_arguments))
+        else:
+            futures = [pool.submit(task, *arguments) for arguments in task_arguments]
+            results = [future.result() for future in futures]
+            profiling_utils.increment_counter('parallel_utils.concurrent_tasks', len(task_arguments))
+
+    return results
+
+
+def parallel_fft2_job(output_values, input_values, start_idx, end_idx, threads=1):
+    fft_utils.fft2(input_values[start_idx:end_idx, :, :], output_values=output_values[start_idx:end_idx, :, :], threads=threads)
 
-def parallel_fft2_job(output_values, input_values, start_idx, end_idx):
-    output_values[start_idx:end_idx, :, :] = np.fft.fft2(input_values[start_idx:end_idx, :, :], axes=(1, 2))
 
+def parallel_centered_fft2_job(output_values, input_values, start_idx, end_idx, threads=1):
+    fft_utils.centered_fft2(input_values[start_idx:end_idx, :, :], output_values=output_values[start_idx:end_idx, :, :], threads=threads)
 
-def parallel_centered_fft2_job(output_values, input_values, start_idx, end_idx):
-    shifted_values = np.fft.ifftshift(input_values[start_idx:end_idx, :, :], axes=(1, 2))
-    fourier_coefficients = np.fft.fft2(shifted_values, axes=(1, 2))
-    output_values[start_idx:end_idx, :, :] = np.fft.fftshift(fourier_coefficients, axes=(1, 2))
 
+def parallel_ifft2_job(output_values, input_values, start_idx, end_idx, threads=1):
+    fft_utils.fft2(input_values[start_idx:end_idx, :, :], inverse=True, output_values=output_values[start_idx:end_idx, :, :], threads=threads)
 
-def parallel_ifft2_job(output_values, input_values, start_idx, end_idx):
-    output_values[start_idx:end_idx, :, :] = np.fft.ifft2(input_values[start_idx:end_idx, :, :], axes=(1, 2))
 
+def parallel_centered_ifft2_job(output_values, input_values, start_idx, end_idx, threads=1):
+    fft_utils.centered_fft2(input_values[start_idx:end_idx, :, :], inverse=True, output_values=output_values[start_idx:end_idx, :, :], threads=threads)
 
-def parallel_centered_ifft2_job(output_values, input_values, start_idx, end_idx):
-    shifted_values = np.fft.ifftshift(input_values[start_idx:end_idx, :, :], axes=(1, 2))
-    fourier_coefficients = np.fft.ifft2(shifted_values, axes=(1, 2))
-    output_values[start_idx:end_idx, :, :] = np.fft.fftshift(fourier_coefficients, axes=(1, 2))
+
+def run_fft_job(input_values, shape, output_dtype, parallel_job, max_chunk_length=None):
+    '''
+    Runs the given FFT job over the first axis. If the FFT backend can multithread a single
+    transform call by itself, the job is given all the threads in one call. Otherwise it is
+    parallelized over the first axis. If max_chunk_length is specified, each call is split into
+    consecutive calls for chunks of at most max_chunk_length elements along the first axis.
+    '''
+    if max_chunk_length is not None:
+        parallel_job = create_chunked_job(parallel_job, max_chunk_length)
+
+    if fft_utils.has_native_threading():
+        output_values = np.empty(shape, dtype=output_dtype)
+        with profiling_utils.timed('parallel_utils.{}'.format(parallel_job.__name__)):
+            parallel_job(output_values, input_values, 0, shape[0], threads=n_threads)
+        profiling_utils.increment_counter('parallel_utils.native_threaded_jobs')
+        return output_values
+    else:
+        return parallelize_over_axis(input_values, shape, 0, output_dtype, parallel_job)
 
 
-def parallel_fft2(values, centered=True, inverse=False):
+def create_chunked_job(parallel_job, max_chunk_length):
+    '''
+    Wraps the given job so that the range of elements it is given is processed in consecutive
+    chunks of at most max_chunk_length elements. This limits how much of lazily evaluated input
+    values is evaluated at once, also when each thread is given a large range.
+    '''
+    chunk_length = max(1, int(max_chunk_length))
+
+    @functools.wraps(parallel_job)
+    def chunked_job(output_values, input_values, start_idx, end_idx, threads=1):
+        for chunk_start_idx in range(start_idx, end_idx, chunk_length):
+            parallel_job(output_values, input_values, chunk_start_idx, min(chunk_start_idx + chunk_length, end_idx), threads=threads)
+
+    return chunked_job
+
+
+def compute_hermitian_window_indices(shape, output_window, centered):
+    '''
+    Finds where each Fourier coefficient inside the given output window of a full 2D spectrum of the
+    given shape can be found in the half spectrum produced by a real-input FFT. Coefficients in the
+    missing half are the complex conjugates of the coefficients at the negated frequencies.
+    Returns the x- and y-indices into the half spectrum, along with a mask for the window columns
+    that must be conjugated.
+    '''
+    size_x, size_y = shape
+    shift_x = size_x//2 if centered else 0
+    shift_y = size_y//2 if centered else 0
+
+    frequency_indices_x = (np.arange(output_window.x.start, output_window.x.end) - shift_x) % size_x
+    frequency_indices_y = (np.arange(output_window.y.start, output_window.y.end) - shift_y) % size_y
+
+    is_reflected = frequency_indices_y > size_y//2
+
+    x_indices = np.where(is_reflected[np.newaxis, :],
+                         ((-frequency_indices_x) % size_x)[:, np.newaxis],
+                         frequency_indices_x[:, np.newaxis])
+    y_indices = np.where(is_reflected, size_y - frequency_indices_y, frequency_indices_y)[np.newaxis, :]
+
+    return x_indices, y_indices, is_reflected
+
+
+def parallel_real_fft2_window_job(output_values, input_values, start_idx, end_idx, threads=1):
+    values, output_window, (x_indices, y_indices, is_reflected), centering, inverse = input_values
+    chunk_values = values[start_idx:end_idx, :, :]
+
+    if centering == 'checkerboard':
+        input_checkerboard, output_checkerboard = fft_utils.get_centering_checkerboards(chunk_values.shape, chunk_values.dtype)
+        if is_lazily_evaluated(values):
+            # The evaluated chunk is a new array, so it can be modified in place
+            chunk_values *= input_checkerboard
+        else:
+            chunk_values = chunk_values*input_checkerboard
+        half_fourier_coefficients = fft_utils.rfft2(chunk_values, threads=threads)
+    elif centering == 'shift':
+        half_fourier_coefficients = fft_utils.rfft2(np.fft.ifftshift(chunk_values, axes=(1, 2)), threads=threads)
+    else:
+        half_fourier_coefficients = fft_utils.rfft2(chunk_values, threads=threads)
+
+    window_fourier_coefficients = output_values[start_idx:end_idx, :, :]
+    window_fourier_coefficients[:] = half_fourier_coefficients[:, x_indices, y_indices]
+    window_fourier_coefficients[:, :, is_reflected] = np.conjugate(window_fourier_coefficients[:, :, is_reflected])
+
+    if centering == 'checkerboard':
+        window_fourier_coefficients *= output_checkerboard[output_window.x.start:output_window.x.end, output_window.y.start:output_window.y.end]
+
+    if inverse:
+        # For real input, the inverse transform is the complex conjugate of the forward transform divided by the size
+        np.conjugate(window_fourier_coefficients, out=window_fourier_coefficients)
+        window_fourier_coefficients /= chunk_values.shape[1]*chunk_values.shape[2]
+
+
+def is_lazily_evaluated(values):
+    '''
+    Whether the given values are an object evaluated on indexing (like fields.LazyFieldExpression)
+    rather than an array.
+    '''
+    return not isinstance(values, np.ndarray)
+
+
+def parallel_real_fft2(values, output_window=None, centered=True, inverse=False):
+    '''
+    Computes the 2D FFT of the given real 3D array of values in parallel over the first axis, returning
+    only the Fourier coefficients inside the given output window (an IndexRange2D into the full spectrum).
+    A real-input FFT is used, which only computes the non-redundant half of the spectrum. The window
+    coefficients in the other half are reconstructed from Hermitian symmetry. The values may also be
+    a lazily evaluated expression, which is then evaluated one slice at a time when the FFTs are
+    threaded natively.
+    '''
+    assert np.isrealobj(values)
+    if output_window is None:
+        output_window = grids.IndexRange2D(0, values.shape[1], 0, values.shape[2])
+
+    # Centering is done with sign checkerboards when possible, in which case the spectrum is indexed as uncentered
+    if centered:
+        centering = 'checkerboard' if fft_utils.has_even_size(values.shape) else 'shift'
+    else:
+        centering = None
+
+    hermitian_window_indices = compute_hermitian_window_indices(values.shape[1:], output_window, centering == 'shift')
+
+    return run_fft_job((values, output_window, hermitian_window_indices, centering, inverse), (values.shape[0], *output_window.shape),
+                       math_utils.get_complex_dtype(values.dtype), parallel_real_fft2_window_job,
+                       max_chunk_length=(1 if is_lazily_evaluated(values) else None))
+
+
+def parallel_fft2(values, centered=True, inverse=False, output_window=None):
     '''
     Computes the 2D FFT of the given 3D array of values in parallel over the first axis.
+    If an output window is given, only the Fourier coefficients inside it are returned.
+    Real input is transformed with the cheaper real-input FFT. The values may also be a
+    lazily evaluated expression.
     '''
+    if np.isrealobj(values):
+        return parallel_real_fft2(values, output_window=output_window, centered=centered, inverse=inverse)
+
     if centered:
         parallel_job = parallel_centered_ifft2_job if inverse else parallel_centered_fft2_job
     else:
         parallel_job = parallel_ifft2_job if inverse else parallel_fft2_job
-    return parallelize_over_axis(values, values.shape, 0, 'complex128', parallel_job)
+    fourier_coefficients = run_fft_job(values, values.shape, values.dtype, parallel_job,
+                                       max_chunk_length=(1 if is_lazily_evaluated(values) else None))
+
+    if output_window is None:
+        return fourier_coefficients
+    else:
+        return fourier_coefficients[:, output_window.x.start:output_window.x.end, output_window.y.start:output_window.y.end]
+
+
+def parallel_pruned_fft2_job(output_values, input_values, start_idx, end_idx, threads=1):
+    window_values, shape, input_window, output_window, centered, inverse = input_values
+    output_values[start_idx:end_idx, :, :] = fft_utils.pruned_fft2(window_values[start_idx:end_idx, :, :], shape, input_window, output_window,
+                                                                   centered=centered, inverse=inverse, threads=threads)
+
+
+def parallel_matrix_fourier_transform_job(output_values, input_values, start_idx, end_idx):
+    window_values, shape, input_window, output_window, centered, inverse = input_values
+    output_values[start_idx:end_idx, :, :] = fft_utils.matrix_fourier_transform(window_values[start_idx:end_idx, :, :], shape, input_window, output_window,
+                                                                                centered=centered, inverse=inverse)
+
 
+def parallel_windowed_fft2(window_values, shape, input_window, output_window, centered=True, inverse=False, method='auto'):
+    '''
+    Computes the Fourier coefficients inside the given output window of the 2D FFTs of a 3D array whose
+    last two dimensions have the given shape and which is zero outside the given input window. Only
+    the values inside the input window are given. The transform is computed in parallel over the first
+    axis, using either a full FFT ('fft'), a pruned FFT that skips the zero rows and unneeded columns
+    ('pruned') or a matrix Fourier transform ('matrix'). With method='auto', the method estimated
+    to require the fewest operations is used.
+    '''
+    assert window_values.shape[1:] == input_window.shape
+    if method == 'auto':
+        method = fft_utils.select_windowed_transform_method(shape, input_window, output_window)
+    assert method in ('fft', 'pruned', 'matrix')
+
+    output_shape = (window_values.shape[0], *output_window.shape)
+    output_dtype = math_utils.get_complex_dtype(window_values.dtype)
+
+    if method == 'fft':
+        padded_values = np.zeros((window_values.shape[0], *shape), dtype=output_dtype)
+        padded_values[:, input_window.x.start:input_window.x.end, input_window.y.start:input_window.y.end] = window_values
+        return parallel_fft2(padded_values, centered=centered, inverse=inverse, output_window=output_window)
+    elif method == 'pruned':
+        return run_fft_job((window_values, shape, input_window, output_window, centered, inverse), output_shape,
+                           output_dtype, parallel_pruned_fft2_job)
+    else:
+        return parallelize_over_axis((window_values, shape, input_window, output_window, centered, inverse), output_shape, 0,
+                                     output_dtype, parallel_matrix_fourier_transform_job)
+
+
+def parallel_point_source_fourier_transform_job(output_values, input_values, start_idx, end_idx):
+    x_positions, y_positions, amplitudes, shape, output_window, centered, inverse = input_values
+    output_values[start_idx:end_idx, :, :] = fft_utils.point_source_fourier_transform(x_positions, y_positions, amplitudes[start_idx:end_idx, :], shape, output_window,
+                                                                                      centered=centered, inverse=inverse)
+
+
+def parallel_point_source_fourier_transform(x_positions, y_positions, amplitudes, shape, output_window, centered=True, inverse=False):
+    '''
+    Computes the Fourier coefficients inside the given output window of the 2D DFTs of an array of the
+    given shape that is zero except at the given points (see fft_utils.point_source_fourier_transform),
+    in parallel over the first axis of the (n_slices, n_points) array of point amplitudes.
+    '''
+    assert amplitudes.ndim == 2 and amplitudes.shape[1] == len(x_positions) == len(y_positions)
+    return parallelize_over_axis((x_positions, y_positions, amplitudes, shape, output_window, centered, inverse), (amplitudes.shape[0], *output_window.shape), 0,
+                                 math_utils.get_complex_dtype(amplitudes.dtype), parallel_point_source_fourier_transform_job)
 
-def parallel_fftconvolve_job(output_values, input_values, start_idx, end_idx):
-    output_values[start_idx:end_idx, :, :] = scipy.signal.fftconvolve(input_values[0][start_idx:end_idx, :, :],
-                                                                      input_values[1][start_idx:end_idx, :, :],
-                                                                      mode='same', axes=(1, 2))
+
+def parallel_poisson_job(output_values, input_values, start_idx, end_idx):
+    mean_values, seeds = input_values
+    for idx in range(start_idx, end_idx):
+        output_values[idx] = np.random.RandomState(seed=seeds[idx]).poisson(lam=mean_values[idx])
+
+
+def parallel_poisson(mean_values, seeds, backend='threads'):
+    '''
+    Draws Poisson distributed values with the given array of mean values in parallel over the first
+    axis. Each index along the first axis is sampled with its own random generator, seeded with the
+    corresponding entry in the given array of seeds, so the result is independent of the number of
+    workers. Sampling holds the global interpreter lock, so backend='processes' is required for a
+    speedup with more than one worker.
+    '''
+    assert len(seeds) == mean_values.shape[0]
+    return parallelize_over_axis((mean_values, np.asarray(seeds)), mean_values.shape, 0, 'int64', parallel_poisson_job, backend=backend)
+
+
+def parallel_fftconvolve_job(output_values, input_values, start_idx, end_idx, threads=1):
+    output_values[start_idx:end_idx, :, :] = fft_utils.fftconvolve(input_values[0][start_idx:end_idx, :, :],
+                                                                   input_values[1][start_idx:end_idx, :, :],
+                                                                   threads=threads)
 
 
 def parallel_fftconvolve(values, kernel):
@@ -107,4 +597,75 @@ def parallel_fftconvolve(values, kernel):
     in parallel over the first axis. The first axis must be the same size for values and
     kernel but the shapes of the remaining two axes can differ.
     '''
-    return parallelize_over_axis((values, kernel), values.shape, 0, values.dtype, parallel_fftconvolve_job)
+    return run_fft_job((values, kernel), values.shape, values.dtype, parallel_fftconvolve_job)
+
+
+def parallel_kernel_spectrum_job(output_values, input_values, start_idx, end_idx, threads=1):
+    kernel, convolution_shape = input_values
+    output_values[start_idx:end_idx, :, :] = fft_utils.compute_kernel_spectrum(kernel[start_idx:end_idx, :, :], convolution_shape,
+                                                                               threads=threads)
+
+
+def parallel_compute_kernel_spectrum(kernel, values_shape):
+    '''
+    Computes the Fourier transform of the given real 3D kernel zero padded for convolution with
+    arrays with the given (last two) shape. The result can be reused for any number of calls to
+    parallel_fftconvolve_with_kernel_spectrum with arrays of that shape.
+    '''
+    convolution_shape = fft_utils.compute_convolution_shape(values_shape, kernel.shape)
+    spectrum_shape = (kernel.shape[0], convolution_shape[0], convolution_shape[1]//2 + 1)
+    spectrum_dtype = math_utils.get_complex_dtype(kernel.dtype)
+    return run_fft_job((kernel, convolution_shape), spectrum_shape, spectrum_dtype, parallel_kernel_spectrum_job)
+
+
+def parallel_fftconvolve_with_kernel_spectrum_job(output_values, input_values, start_idx, end_idx, threads=1):
+    values, kernel_spectrum, kernel_shape, convolution_shape = input_values
+    output_values[start_idx:end_idx, :, :] = fft_utils.convolve_with_kernel_spectrum(values[start_idx:end_idx, :, :],
+                                                                                     kernel_spectrum[start_idx:end_idx, :, :],
+                                                                                     kernel_shape, convolution_shape,
+                                                                                     threads=threads)
+
+
+def parallel_fftconvolve_with_kernel_spectrum(values, kernel_spectrum, kernel_shape):
+    '''
+    Like parallel_fftconvolve, but uses a kernel spectrum precomputed with parallel_compute_kernel_spectrum
+    for the kernel with the given shape, so that only the values have to be transformed.
+    '''
+    convolution_shape = fft_utils.compute_convolution_shape(values.shape, kernel_shape)
+    assert kernel_spectrum.shape == (values.shape[0], convolution_shape[0], convolution_shape[1]//2 + 1)
+    return run_fft_job((values, kernel_spectrum, kernel_shape, convolution_shape), values.shape, values.dtype,
+                       parallel_fftconvolve_with_kernel_spectrum_job)
+
+
+def parallel_periodic_kernel_spectrum_job(output_values, input_values, start_idx, end_idx, threads=1):
+    output_values[start_idx:end_idx, :, :] = fft_utils.compute_periodic_kernel_spectrum(input_values[start_idx:end_idx, :, :], threads=threads)
+
+
+def parallel_compute_periodic_kernel_spectrum(kernel):
+    '''
+    Computes the Fourier transform of the given real 3D periodic kernel, with its origin in the center
+    of the last two axes, in parallel over the first axis. The result can be reused for any number of
+    calls to parallel_correlate_with_periodic_kernel_spectrum.
+    '''
+    spectrum_shape = (kernel.shape[0], kernel.shape[1], kernel.shape[2]//2 + 1)
+    return run_fft_job(kernel, spectrum_shape, math_utils.get_complex_dtype(kernel.dtype), parallel_periodic_kernel_spectrum_job)
+
+
+def parallel_periodic_correlation_job(output_values, input_values, start_idx, end_idx, threads=1):
+    values, kernel_spectrum, output_window = input_values
+    correlated_values = fft_utils.correlate_with_periodic_kernel_spectrum(values[start_idx:end_idx, :, :], kernel_spectrum[start_idx:end_idx, :, :],
+                                                                          threads=threads)
+    output_values[start_idx:end_idx, :, :] = correlated_values[:, output_window.x.start:output_window.x.end, output_window.y.start:output_window.y.end]
+
+
+def parallel_correlate_with_periodic_kernel_spectrum(values, kernel_spectrum, output_window=None):
+    '''
+    Computes the periodic cross-correlation of the given real 3D array of values with the periodic
+    kernel whose spectrum was computed with parallel_compute_periodic_kernel_spectrum, in parallel
+    over the first axis. If an output window is given, only the values inside it are returned.
+    '''
+    assert kernel_spectrum.shape == (values.shape[0], values.shape[1], values.shape[2]//2 + 1)
+    if output_window is None:
+        output_window = grids.IndexRange2D(0, values.shape[1], 0, values.shape[2])
+    return run_fft_job((values, kernel_spectrum, output_window), (values.shape[0], *output_window.shape), values.dtype,
+                       parallel_periodic_correlation_job)
@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+# This file is part of the APSimulator API.
+# Author: Lars Frogner
+import numpy as np
+import os
+import time
+import itertools
+import collections
+import parallel_utils
+import profiling_utils
+import field_io
+
+
+class ParameterSweep:
+    '''
+    Runs an imaging system for every combination in a grid of parameter values, reusing the results of
+    the propagation stages that are unaffected by the parameters changing between consecutive runs.
+
+    Parameters with a setter are applied to an existing system by calling setter(system, value). The first
+    stage of the propagation affected by each such parameter is found by comparing the parameter fingerprints
+    of the stages (see ImagingSystem.compute_stage_parameter_fingerprints) for the different values, and the
+    runs are ordered so that the parameters affecting later stages vary fastest. Since the systems are
+    incremental, consecutive runs then only recompute the stages from the first affected one and onwards.
+    Parameters not affecting any of the fingerprinted stages (for example camera settings) only affect the
+    camera signal field, which is always recomputed.
+
+    Parameters without a setter are structural, like the aperture diameter, which determines the aperture
+    grid window that the processors are initialized for. They are passed as keyword arguments to the
+    system creator, and a new system is created whenever one of them changes. Every propagation is
+    captured with all the exposure times, which thus vary fastest of all.
+
+    The ordered runs are split into contiguous groups, one for each worker, and the groups are run
+    concurrently with parallel_utils.run_tasks_concurrently, each with its own system. With
+    backend='processes', the system creator, setters, metric functions and field getters must be
+    module-level functions.
+    '''
+    def __init__(self, system_creator):
+        self.system_creator = system_creator # Function returning a new ImagingSystem with all components added, given the structural parameters as keyword arguments
+        self.parameters = collections.OrderedDict() # Values and setter (None for structural parameters) of each parameter
+        self.exposure_times = [] # Exposure times to capture after each propagation (no exposures are captured if empty)
+        self.metrics = collections.OrderedDict() # Function computing each metric from the system after each run
+        self.output_fields = collections.OrderedDict() # Function returning each field to write to the output directory after each run
+        self.output_directory = None # Directory for the output fields
+
+    def add_parameter(self, name, values, setter=None):
+        '''
+        Adds a parameter taking each of the given values. If a setter is given, the parameter is applied
+        with setter(system, value). Otherwise it is passed to the system creator.
+        '''
+        assert name not in self.parameters and name != 'exposure_time'
+        values = list(values)
+        assert len(values) > 0
+        self.parameters[name] = (values, setter)
+
+    def set_exposure_times(self, exposure_times):
+        self.exposure_times = [float(exposure_time) for exposure_time in exposure_times]
+
+    def add_metric(self, name, metric_function):
+        '''
+        Adds a metric computed with metric_function(system) after each run (and exposure). The values
+        must be picklable if the sweep is run with processes.
+        '''
+        assert name not in self.metrics
+        self.metrics[name] = metric_function
+
+    def add_output_field(self, name, field_getter):
+        '''
+        Adds a field, obtained with field_getter(system), that is written with field_io after each run
+        (and exposure) to the output directory.
+        '''
+        assert name not in self.output_fields
+        self.output_fields[name] = field_getter
+
+    def set_output_directory(self, directory):
+        self.output_directory = os.path.abspath(os.path.expanduser(str(directory)))
+        os.makedirs(self.output_directory, exist_ok=True)
+
+    def get_structural_parameter_names(self):
+        return [name for name, (_, setter) in self.parameters.items() if setter is None]
+
+    def get_set_parameter_names(self):
+        return [name for name, (_, setter) in self.parameters.items() if setter is not None]
+
+    def create_system(self, structural_values):
+        system = self.system_creator(**structural_values)
+        if not system.incremental:
+            system.set_incremental(True)
+        return system
+
+    def find_affected_stage_indices(self):
+        '''
+        Returns a dictionary with the index of the first propagation stage affected by each parameter
+        with a setter, found by applying every value to a probe system. Parameters not affecting any of
+        the fingerprinted stages get the number of stages as index.
+        '''
+        structural_values = {name: self.parameters[name][0][0] for name in self.get_structural_parameter_names()}
+        system = self.create_system(structural_values)
+
+        affected_stage_indices = {}
+        for name in self.get_set_parameter_names():
+            values, setter = self.parameters[name]
+            stage_fingerprints = []
+            for value in values:
+                setter(system, value)
+                stage_fingerprints.append(list(system.compute_stage_parameter_fingerprints().values()))
+            setter(system, values[0])
+
+            n_stages = len(stage_fingerprints[0])
+            affected_stage_idx = 0
+            while affected_stage_idx < n_stages and all(fingerprints[affected_stage_idx] == stage_fingerprints[0][affected_stage_idx] for fingerprints in stage_fingerprints):
+                affected_stage_idx += 1
+            affected_stage_indices[name] = affected_stage_idx
+
+        return affected_stage_indices
+
+    def create_runs(self):
+        '''
+        Returns a list of (run index, parameter values) pairs for all combinations of the parameter values,
+        ordered so that structural parameters vary slowest and parameters affecting later stages vary
+        faster. The run index is the position of the combination in the grid with the parameters in the
+        order they were added. The parameter values are ordered dictionaries in that order as well.
+        '''
+        affected_stage_indices = self.find_affected_stage_indices()
+        set_parameter_names = sorted(self.get_set_parameter_names(), key=lambda name: affected_stage_indices[name])
+        ordered_names = self.get_structural_parameter_names() + set_parameter_names
+
+        names = list(self.parameters.keys())
+        n_values = [len(self.parameters[name][0]) for name in names]
+
+        runs = []
+        for ordered_value_indices in itertools.product(*[range(len(self.parameters[name][0])) for name in ordered_names]):
+            value_indices = dict(zip(ordered_names, ordered_value_indices))
+            run_idx = int(np.ravel_multi_index([value_indices[name] for name in names], n_values)) if len(names) > 0 else 0
+            parameter_values = collections.OrderedDict([(name, self.parameters[name][0][value_indices[name]]) for name in names])
+            runs.append((run_idx, parameter_values))
+
+        return runs
+
+    def run(self, n_workers=None, backend='threads'):
+        '''
+        Runs all the parameter combinations, split between the given number of workers (by default the
+        number of threads in parallel_utils), and returns a list of results in the order of the parameter
+        grid, with the exposure times varying fastest. Each result is an ordered dictionary with the
+        parameter values (including any exposure time), the metric values, the paths of the written
+        output fields and the wall time of the propagation.
+        '''
+        n_workers = parallel_utils.get_number_of_threads() if n_workers is None else max(1, int(n_workers))
+
+        with profiling_utils.timed('parameter_sweeps.run'):
+            runs = self.create_runs()
+            run_groups = [[runs[idx] for idx in group_indices] for group_indices in np.array_split(np.arange(len(runs)), min(n_workers, len(runs)))]
+            group_results = parallel_utils.run_tasks_concurrently(run_sweep_group, [(self, run_group) for run_group in run_groups], backend=backend)
+
+        return [result for _, result in sorted(itertools.chain.from_iterable(group_results), key=lambda indexed_result: indexed_result[0])]
+
+    def run_group(self, runs):
+        '''
+        Runs the given (run index, parameter values) pairs in order with a single system, and returns
+        a list of (result index, result) pairs. Setters are only called for parameters whose value
+        differs from the previous run.
+        '''
+        n_exposures = max(1, len(self.exposure_times))
+        structural_names = self.get_structural_parameter_names()
+        set_names = self.get_set_parameter_names()
+
+        system = None
+        current_values = {}
+        indexed_results = []
+
+        for run_idx, parameter_values in runs:
+            structural_values = {name: parameter_values[name] for name in structural_names}
+            if system is None or any(structural_values[name] != current_values[name] for name in structural_names):
+                system = self.create_system(structural_values)
+                current_values = dict(structural_values)
+
+            for name in set_names:
+                if name not in current_values or parameter_values[name] != current_values[name]:
+                    self.parameters[name][1](system, parameter_values[name])
+                    current_values[name] = parameter_values[name]
+
+            start_time = time.perf_counter()
+            with profiling_utils.timed('parameter_sweeps.run_full_propagation'):
+                system.run_full_propagation()
+            propagation_time = time.perf_counter() - start_time
+
+            for exposure_idx, exposure_time in enumerate(self.exposure_times if len(self.exposure_times) > 0 else [None]):
+                result_idx = run_idx*n_exposures + exposure_idx
+                result_parameters = collections.OrderedDict(parameter_values)
+
+                if exposure_time is not None:
+                    camera = system.get_camera()
+                    # Reseeding makes the sampled counts independent of the runs preceding this one on the same worker
+                    if camera.seed is not None:
+                        camera.set_seed(camera.seed)
+                    system.capture_exposure(exposure_time)
+                    result_parameters['exposure_time'] = exposure_time
+
+                indexed_results.append((result_idx, collections.OrderedDict([('parameters', result_parameters),
+                                                                             ('metrics', collections.OrderedDict([(name, metric_function(system)) for name, metric_function in self.metrics.items()])),
+                                                                             ('output_paths', self.write_output_fields(system, result_idx)),
+                                                                             ('propagation_time', propagation_time)])))
+
+        return indexed_results
+
+    def write_output_fields(self, system, result_idx):
+        output_paths = collections.OrderedDict()
+        if len(self.output_fields) > 0:
+            assert self.output_directory is not None
+            for name, field_getter in self.output_fields.items():
+                output_paths[name] = os.path.join(self.output_directory, '{}_{:05d}.npz'.format(name, result_idx))
+                field_io.write_field(field_getter(system), output_paths[name])
+        return output_paths
+
+
+def run_sweep_group(sweep, runs):
+    return sweep.run_group(runs)
@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+# This file is part of the APSimulator API.
+# Author: Lars Frogner
+import os
+import json
+import time
+import threading
+import tracemalloc
+import collections
+
+
+is_enabled = False # Whether timers and counters are currently being recorded
+is_tracking_memory = False # Whether peak allocated bytes are measured (with tracemalloc) for each timed stage
+has_started_tracemalloc = False # Whether tracemalloc was started by this module (and should thus be stopped by it)
+
+timer_statistics = collections.OrderedDict() # Accumulated statistics for each named timer
+counters = collections.OrderedDict() # Accumulated value of each named counter
+max_trace_events = 100000 # Largest number of trace events kept (the oldest are discarded first)
+trace_events = collections.deque(maxlen=max_trace_events) # Most recent completed timer intervals in the Chrome trace event format
+
+reference_time = time.perf_counter() # Time that trace event time stamps are measured relative to
+registry_lock = threading.Lock()
+thread_state = threading.local() # Holds the stack of active timers for each thread
+memory_timers = set() # Active timers measuring allocated bytes, in any thread
+
+
+def enable_profiling(track_memory=False):
+    '''
+    Starts recording timers and counters. If track_memory=True, the peak number of bytes allocated
+    during each timed stage is also measured, using tracemalloc. Memory tracking slows down
+    allocations, so it is off by default. Since tracemalloc only measures allocations for the whole
+    process, no memory is recorded for timers that overlap in time with timers in other threads.
+    '''
+    global is_enabled, is_tracking_memory, has_started_tracemalloc
+    is_tracking_memory = bool(track_memory)
+    if is_tracking_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        has_started_tracemalloc = True
+    is_enabled = True
+
+
+def disable_profiling():
+    '''
+    Stops recording timers and counters. Recorded values are kept until reset_profiling is called.
+    '''
+    global is_enabled, is_tracking_memory, has_started_tracemalloc
+    is_enabled = False
+    is_tracking_memory = False
+    if has_started_tracemalloc:
+        tracemalloc.stop()
+        has_started_tracemalloc = False
+
+
+def reset_profiling():
+    '''
+    Discards all recorded timers, counters and trace events.
+    '''
+    global reference_time
+    with registry_lock:
+        timer_statistics.clear()
+        counters.clear()
+        trace_events.clear()
+        reference_time = time.perf_counter()
+
+
+def profiling_is_enabled():
+    return is_enabled
+
+
+def set_max_trace_events(max_number_of_events):
+    '''
+    Sets the largest number of trace events to keep, so that long runs use bounded memory. When the
+    limit is reached, the oldest events are discarded. With None, all events are kept.
+    '''
+    global max_trace_events, trace_events
+    with registry_lock:
+        max_trace_events = None if max_number_of_events is None else int(max_number_of_events)
+        assert max_trace_events is None or max_trace_events > 0
+        trace_events = collections.deque(trace_events, maxlen=max_trace_events)
+
+
+def get_max_trace_events():
+    return max_trace_events
+
+
+class TimerStatistics:
+    '''
+    Accumulated measurements for a named timer.
+    '''
+    def __init__(self):
+        self.calls = 0
+        self.wall_time = 0 # Total elapsed time [s]
+        self.cpu_time = 0 # Total processor time used by all threads in the process [s]
+        self.peak_allocated_bytes = None # Largest number of bytes allocated at once during a single call
+        self.concurrent_calls = 0 # Number of calls for which allocated bytes were not measured due to timers in other threads
+
+    def add_measurement(self, wall_time, cpu_time, peak_allocated_bytes, is_concurrent=False):
+        self.calls += 1
+        self.concurrent_calls += int(is_concurrent)
+        self.wall_time += wall_time
+        self.cpu_time += cpu_time
+        if peak_allocated_bytes is not None:
+            self.peak_allocated_bytes = peak_allocated_bytes if self.peak_allocated_bytes is None else max(self.peak_allocated_bytes, peak_allocated_bytes)
+
+    def to_dict(self):
+        return collections.OrderedDict([('calls', self.calls),
+                                        ('wall_time', self.wall_time),
+                                        ('cpu_time', self.cpu_time),
+                                        ('peak_allocated_bytes', self.peak_allocated_bytes),
+                                        ('concurrent_calls', self.concurrent_calls)])
+
+
+class Timer:
+    '''
+    Context manager measuring the wall time, CPU time and (optionally) peak allocated bytes of the
+    enclosed code, and adding the measurements to the timer with the given name. Timers can be nested.
+    The tracemalloc peak is shared by all threads, so timers active in different threads at the same
+    time would corrupt each other's peaks. Such timers are marked as concurrent and record no
+    allocated bytes.
+    '''
+    def __init__(self, name):
+        self.name = str(name)
+
+    def __enter__(self):
+        stack = get_timer_stack()
+
+        if is_tracking_memory:
+            self.thread_ident = threading.get_ident()
+            with registry_lock:
+                concurrent_timers = [timer for timer in memory_timers if timer.thread_ident != self.thread_ident]
+                self.is_concurrent = len(concurrent_timers) > 0
+                if self.is_concurrent:
+                    # The peak is left alone, since neither this nor the other active timers can be measured
+                    for timer in memory_timers:
+                        timer.is_concurrent = True
+                else:
+                    current_bytes, peak_bytes = tracemalloc.get_traced_memory()
+                    # Peak allocations so far belong to the enclosing timer, since the peak is reset below
+                    if len(stack) > 0 and hasattr(stack[-1], 'max_traced_bytes'):
+                        stack[-1].max_traced_bytes = max(stack[-1].max_traced_bytes, peak_bytes)
+                    tracemalloc.reset_peak()
+                    self.start_traced_bytes = current_bytes
+                    self.max_traced_bytes = current_bytes
+                memory_timers.add(self)
+
+        stack.append(self)
+        self.start_cpu_time = time.process_time()
+        self.start_wall_time = time.perf_counter()
+        return self
+
+    def __exit__(self, *exception_info):
+        end_wall_time = time.perf_counter()
+        end_cpu_time = time.process_time()
+
+        stack = get_timer_stack()
+        stack.pop()
+
+        peak_allocated_bytes = None
+        is_concurrent = False
+        if hasattr(self, 'thread_ident'):
+            with registry_lock:
+                memory_timers.discard(self)
+                is_concurrent = self.is_concurrent
+                if not is_concurrent and is_tracking_memory:
+                    self.max_traced_bytes = max(self.max_traced_bytes, tracemalloc.get_traced_memory()[1])
+                    peak_allocated_bytes = self.max_traced_bytes - self.start_traced_bytes
+                    if len(stack) > 0 and hasattr(stack[-1], 'max_traced_bytes') and not stack[-1].is_concurrent:
+                        stack[-1].max_traced_bytes = max(stack[-1].max_traced_bytes, self.max_traced_bytes)
+
+        wall_time = end_wall_time - self.start_wall_time
+        cpu_time = end_cpu_time - self.start_cpu_time
+
+        with registry_lock:
+            if self.name not in timer_statistics:
+                timer_statistics[self.name] = TimerStatistics()
+            timer_statistics[self.name].add_measurement(wall_time, cpu_time, peak_allocated_bytes, is_concurrent=is_concurrent)
+
+            event_args = {'cpu_time': cpu_time}
+            if peak_allocated_bytes is not None:
+                event_args['peak_allocated_bytes'] = peak_allocated_bytes
+            if is_concurrent:
+                event_args['concurrent'] = True
+            trace_events.append({'name': self.name,
+                                 'cat': self.name.split('.')[0],
+                                 'ph': 'X',
+                                 'ts': (self.start_wall_time - reference_time)*1e6,
+                                 'dur': wall_time*1e6,
+                                 'pid': os.getpid(),
+                                 'tid': threading.get_ident(),
+                                 'args': event_args})
+
+        return False
+
+
+class NullTimer:
+    '''
+    Context manager that does nothing, used in place of a Timer when profiling is disabled.
+    '''
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception_info):
+        return False
+
+
+null_timer = NullTimer()
+
+
+def get_timer_stack():
+    if not hasattr(thread_state, 'timer_stack'):
+        thread_state.timer_stack = []
+    return thread_state.timer_stack
+
+
+def timed(name):
+    '''
+    Returns a context manager timing the enclosed code under the given name if profiling is enabled.
+    '''
+    return Timer(name) if is_enabled else null_timer
+
+
+def increment_counter(name, amount=1):
+    '''
+    Adds the given amount to the counter with the given name if profiling is enabled.
+    '''
+    if is_enabled:
+        with registry_lock:
+            counters[name] = counters.get(name, 0) + amount
+
+
+def get_timer_statistics(name):
+    return timer_statistics[name]
+
+
+def get_counter(name):
+    return counters.get(name, 0)
+
+
+def get_profile():
+    '''
+    Returns a dictionary with the statistics for all timers and the values of all counters.
+    '''
+    with registry_lock:
+        return collections.OrderedDict([('timers', collections.OrderedDict([(name, statistics.to_dict()) for name, statistics in timer_statistics.items()])),
+                                        ('counters', collections.OrderedDict(counters))])
+
+
+def export_json(output_path):
+    '''
+    Writes the timer statistics and counters to the given path as JSON.
+    '''
+    with open(output_path, 'w') as f:
+        json.dump(get_profile(), f, indent=2)
+
+
+def export_chrome_trace(output_path):
+    '''
+    Writes the recorded timer intervals and counter values to the given path in the Chrome trace event
+    format, which can be viewed in chrome://tracing or Perfetto. Only the most recent timer intervals
+    are included if more than max_trace_events were recorded.
+    '''
+    with registry_lock:
+        events = list(trace_events)
+        end_time_stamp = (time.perf_counter() - reference_time)*1e6
+        events += [{'name': name, 'ph': 'C', 'ts': end_time_stamp, 'pid': os.getpid(), 'args': {'value': value}}
+                   for name, value in counters.items()]
+
+    with open(output_path, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
@@ -1,75 +1,179 @@
+# -*- coding: utf-8 -*-
+# This file is part of the APSimulator API.
+# Author: Lars Frogner
 import numpy as np
-import math_utils
-import physics_utils
-import imaging_system
-import sources
-import imagers
-import apertures
-import turbulence
-import filters
-import cameras
+import os
+import sys
+import time
+import json
+import argparse
+import traceback
+import collections
 import parallel_utils
+import profiling_utils
+import field_io
+import imaging_system
+import run_configuration
+
+
+class OutputWriter:
+    '''
+    Writes output fields to the output directory with field_io and records them for the run summary.
+    '''
+    def __init__(self, output_directory, file_format='npz'):
+        self.output_directory = os.path.abspath(os.path.expanduser(str(output_directory))) # Directory for the output files
+        self.file_format = str(file_format) # File format for the output fields ('npz' or 'hdf5')
+        self.file_extension = '.h5' if self.file_format == 'hdf5' else '.npz'
+        self.written_fields = collections.OrderedDict() # Description of each recorded output field
+        os.makedirs(self.output_directory, exist_ok=True)
+
+    def write_field(self, name, field, record=True):
+        '''
+        Writes the given field to a file named after the given name, which may include subdirectories,
+        and returns the path. If record=True, the field is included in the run summary.
+        '''
+        path = os.path.join(self.output_directory, name + self.file_extension)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        field_io.write_field(field, path, file_format=self.file_format)
+        if record:
+            self.written_fields[name] = describe_output_field(field, path)
+        return path
+
+    def get_written_fields(self):
+        return self.written_fields
+
+
+def describe_output_field(field, path):
+    '''
+    Returns a JSON serializable description of the given output field written to the given path.
+    '''
+    description = collections.OrderedDict([('path', path), ('shape', list(field.shape)), ('dtype', field.dtype.str)])
+    if not np.iscomplexobj(field.values):
+        minimum_value, maximum_value = field.compute_value_range()
+        description['minimum'] = float(minimum_value)
+        description['maximum'] = float(maximum_value)
+    return description
+
+
+def run(configuration, output_writer):
+    '''
+    Runs the propagation (or frame sequence) described by the given configuration dictionary (see
+    run_configuration.create_imaging_system), writes the output fields with the given output writer,
+    and returns an ordered dictionary with a summary of the run.
+    '''
+    summary = collections.OrderedDict()
 
-def test():
-    field_of_view_x = math_utils.radian_from_arcsec(300)
-    field_of_view_y = math_utils.radian_from_arcsec(300)
-    angular_coarseness = math_utils.radian_from_arcsec(0.2)
-    wavelengths = np.linspace(400, 700, 30)*1e-9
-    aperture_diameter = 0.15
-    secondary_diameter = 0.03
-    spider_wane_width = 0.006
-    focal_length = 0.75
-
-    system = imaging_system.ImagingSystem(field_of_view_x, field_of_view_y, angular_coarseness, wavelengths)
-    print(system.source_grid.shape, system.source_grid.window.shape)
-    star_field = sources.UniformStarField(stellar_density=math_utils.inverse_cubic_meters_from_inverse_cubic_parsecs(0.14),
-                                          near_distance=math_utils.meters_from_parsecs(2),
-                                          far_distance=math_utils.meters_from_parsecs(15000),
-                                          seed=42)
-    skyglow = sources.UniformBlackbodySkyglow(bortle_class=7, color_temperature=2800)
-    imager = imagers.FraunhoferImager(aperture_diameter=aperture_diameter, focal_length=focal_length)
-    aperture = apertures.CircularAperture(diameter=aperture_diameter)#, inner_diameter=secondary_diameter, spider_wane_width=spider_wane_width)
-    seeing = turbulence.AveragedKolmogorovTurbulence(reference_fried_parameter=0.08, minimum_psf_extent=30)
-    filter_set = filters.FilterSet(filters.Filter('red', 595e-9, 680e-9),
-                                   filters.Filter('green', 500e-9, 575e-9),
-                                   filters.Filter('blue', 420e-9, 505e-9))
-    camera = cameras.Camera(filter_set=filter_set)
-
-    system.set_imager(imager)
-    system.set_aperture(aperture)
-    system.set_camera(camera)
-    system.add_source('star_field', star_field, store_field=True)
-    system.add_source('skyglow', skyglow, store_field=True)
-    system.add_image_postprocessor('seeing', seeing)
-
-    print('Seeing FWHM: {:g} focal lengths'.format(np.sin(seeing.compute_approximate_time_averaged_FWHM(wavelengths[20]))))
-    print('Rayleigh limit: {:g} focal lengths'.format(np.sin(system.compute_rayleigh_limit(wavelengths[20]))))
-
-    parallel_utils.set_number_of_threads('auto')
-
-    system.run_full_propagation()
-    #system.visualize_energy_conservation()
-
-    #star_field.plot_HR_diagram(absolute=0)
-
-    #system.visualize_energy_conservation()
-
-    #system.visualize_aperture_modulation_field('seeing', only_window=0)
-    #system.visualize_total_aperture_modulation_field(only_window=1)
-    #system.visualize_source_field('star_field')
-    #system.visualize_source_field('skyglow')
-    #system.visualize_total_source_field(use_autostretch=1, only_window=0)
-    #system.visualize_aperture_field(use_autostretch=1, only_window=0)
-    #system.visualize_modulated_aperture_field(use_autostretch=1, only_window=0)
-    #system.visualize_image_field(use_autostretch=0)
-    #system.visualize_postprocessed_image_field(use_autostretch=0)
-    system.visualize_camera_signal_field(use_autostretch=1)#, filter_label='green'#, white_point_scale=0.01)
-
-    for exposure_time in [1, 10, 100]:
+    system = run_configuration.create_imaging_system(configuration)
+    summary['source_grid_shape'] = list(system.source_grid.shape)
+    summary['n_wavelengths'] = system.n_wavelengths
+
+    default_outputs = ['camera_signal', 'captured_signal'] if system.has_camera else ['postprocessed_image']
+    output_names = configuration.get('outputs', default_outputs)
+
+    if 'frames' in configuration:
+        summary['frames'] = run_frame_sequence(system, configuration['frames'], output_writer)
+    else:
+        start_time = time.perf_counter()
+        system.run_full_propagation()
+        summary['propagation_time'] = time.perf_counter() - start_time
+
+    for name in output_names:
+        if name != 'captured_signal':
+            output_writer.write_field(name, run_configuration.output_field_getters[name](system))
+
+    exposure_times = [float(exposure_time) for exposure_time in configuration.get('exposure_times', [])]
+    for exposure_time in exposure_times:
         system.capture_exposure(exposure_time)
-        system.visualize_captured_camera_signal_field(use_autostretch=1)#, filter_label='green'#, white_point_scale=0.01)
+        if 'captured_signal' in output_names:
+            output_writer.write_field('captured_signal_{:g}s'.format(exposure_time), system.get_camera().get_captured_signal_field())
+    summary['exposure_times'] = exposure_times
+
+    summary['outputs'] = output_writer.get_written_fields()
+
+    return summary
+
+
+def run_frame_sequence(system, frame_configuration, output_writer):
+    '''
+    Simulates the frame sequence described by the given frames configuration, writing each frame to the
+    frames subdirectory and the mean frame to the output directory. Returns a summary of the sequence.
+    '''
+    accumulator = imaging_system.FrameAccumulator()
+
+    def consume_frame(frame_idx, frame_time, frame_field):
+        output_writer.write_field(os.path.join('frames', 'frame_{:05d}'.format(frame_idx)), frame_field, record=False)
+        accumulator(frame_idx, frame_time, frame_field)
+
+    start_time = time.perf_counter()
+    system.run_frame_sequence(frame_configuration['phase_screens'], int(frame_configuration['n_frames']), float(frame_configuration['time_step']),
+                              consume_frame, exposure_time=frame_configuration.get('exposure_time'))
+    propagation_time = time.perf_counter() - start_time
+
+    if accumulator.get_number_of_frames() > 0:
+        output_writer.write_field('mean_frame', accumulator.get_mean_field())
+
+    return collections.OrderedDict([('n_frames', accumulator.get_number_of_frames()),
+                                    ('directory', os.path.join(output_writer.output_directory, 'frames')),
+                                    ('propagation_time', propagation_time)])
+
+
+def create_argument_parser():
+    parser = argparse.ArgumentParser(description='Simulates the images of a scene captured by the instrument described in a run configuration file, '
+                                                 'writes the resulting fields to files and prints a JSON summary of the run. '
+                                                 'The exit status is nonzero if the run failed.')
+    parser.add_argument('configuration_path', help='JSON, TOML or YAML file describing the scene and instrument (see run_configuration.create_imaging_system)')
+    parser.add_argument('-o', '--output-directory', default='.', help='directory for the output fields (default: current directory)')
+    parser.add_argument('-f', '--output-format', choices=('npz', 'hdf5'), default=None, help='file format for the output fields (overrides the configuration, default: npz)')
+    parser.add_argument('-t', '--threads', default=None, help="number of threads, or 'auto' (overrides the configuration)")
+    parser.add_argument('-s', '--summary-path', default=None, help='file to also write the JSON summary to')
+    parser.add_argument('-p', '--profile', action='store_true', help='include timer and counter statistics in the summary')
+    return parser
+
+
+def main(argv=None):
+    '''
+    Command line entry point. Returns the exit status (0 if the run succeeded and 1 otherwise).
+    '''
+    arguments = create_argument_parser().parse_args(argv)
+
+    start_time = time.perf_counter()
+    summary = collections.OrderedDict([('status', 'failed'), ('configuration_path', os.path.abspath(arguments.configuration_path))])
+
+    try:
+        configuration = run_configuration.read_configuration(arguments.configuration_path)
+
+        n_threads = configuration.get('threads') if arguments.threads is None else arguments.threads
+        if n_threads is not None:
+            parallel_utils.set_number_of_threads(n_threads)
+        summary['n_threads'] = parallel_utils.get_number_of_threads()
+
+        if arguments.profile:
+            profiling_utils.enable_profiling()
+
+        output_format = configuration.get('output_format', 'npz') if arguments.output_format is None else arguments.output_format
+        output_writer = OutputWriter(arguments.output_directory, file_format=field_io.determine_file_format('', file_format=output_format))
+
+        summary.update(run(configuration, output_writer))
+        summary['status'] = 'succeeded'
+
+    except Exception as error:
+        summary['error'] = '{}: {}'.format(error.__class__.__name__, error)
+        traceback.print_exc(file=sys.stderr)
+
+    summary['wall_time'] = time.perf_counter() - start_time
+
+    if arguments.profile:
+        summary['profile'] = profiling_utils.get_profile()
+
+    summary_text = json.dumps(summary, indent=2)
+    print(summary_text)
+
+    if arguments.summary_path is not None:
+        with open(arguments.summary_path, 'w') as f:
+            f.write(summary_text + '\n')
+
+    return 0 if summary['status'] == 'succeeded' else 1
 
-    #math_utils.save_pyfftw_wisdom()
 
 if __name__ == '__main__':
-    test()
+    sys.exit(main())
@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+# This file is part of the APSimulator API.
+# Author: Lars Frogner
+import numpy as np
+import os
+import json
+import math_utils
+import imaging_system
+import sources
+import imagers
+import apertures
+import turbulence
+import filters
+import cameras
+
+try:
+    import tomllib
+except ImportError:
+    tomllib = None
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+
+file_extensions = {'.json': 'json', '.toml': 'toml', '.yaml': 'yaml', '.yml': 'yaml'}
+
+source_classes = {source_class.__name__: source_class for source_class in (sources.UniformStarField,
+                                                                           sources.UniformEmissionLineSkyglow,
+                                                                           sources.UniformBlackbodySkyglow,
+                                                                           sources.MoonSkyglow)}
+
+# Turbulence modulating the aperture field, and turbulence applied to the image field
+aperture_turbulence_classes = {turbulence_class.__name__: turbulence_class for turbulence_class in (turbulence.KolmogorovPhaseScreen,
+                                                                                                    turbulence.MovingKolmogorovPhaseScreen)}
+image_turbulence_classes = {turbulence_class.__name__: turbulence_class for turbulence_class in (turbulence.AveragedKolmogorovTurbulence,)}
+
+configuration_sections = ('grid', 'wavelengths', 'system', 'threads', 'imager', 'aperture', 'sources', 'turbulence',
+                          'filters', 'camera', 'exposure_times', 'frames', 'outputs', 'output_format')
+
+# Fields that can be written after a propagation, with the functions obtaining them from the system
+output_field_getters = {'source': imaging_system.ImagingSystem.get_source_field,
+                        'aperture': imaging_system.ImagingSystem.get_aperture_field,
+                        'modulated_aperture': imaging_system.ImagingSystem.get_modulated_aperture_field,
+                        'image': imaging_system.ImagingSystem.get_image_field,
+                        'postprocessed_image': imaging_system.ImagingSystem.get_postprocessed_image_field,
+                        'camera_signal': imaging_system.ImagingSystem.get_camera_signal_field}
+
+
+def determine_configuration_format(path):
+    configuration_format = file_extensions.get(os.path.splitext(str(path))[1].lower())
+    if configuration_format is None:
+        raise ValueError('Unknown configuration file extension for {} (use one of {})'.format(path, ', '.join(sorted(file_extensions))))
+    if configuration_format == 'toml' and tomllib is None:
+        raise ImportError('Reading TOML configurations requires Python 3.11 or newer')
+    if configuration_format == 'yaml' and yaml is None:
+        raise ImportError('Reading YAML configurations requires PyYAML')
+    return configuration_format
+
+
+def read_configuration(path):
+    '''
+    Reads the run configuration in the given JSON, TOML or YAML file (determined by the file extension)
+    and returns it as a validated dictionary.
+    '''
+    configuration_format = determine_configuration_format(path)
+
+    if configuration_format == 'json':
+        with open(path, 'r') as f:
+            configuration = json.load(f)
+    elif configuration_format == 'toml':
+        with open(path, 'rb') as f:
+            configuration = tomllib.load(f)
+    else:
+        with open(path, 'r') as f:
+            configuration = yaml.safe_load(f)
+
+    validate_configuration(configuration)
+    return configuration
+
+
+def validate_configuration(configuration):
+    '''
+    Checks the overall structure of the given configuration dictionary, raising a ValueError
+    describing the first problem found. The parameters of the components are checked when the
+    components are created.
+    '''
+    if not isinstance(configuration, dict):
+        raise ValueError('The configuration must be a mapping of sections')
+
+    unknown_sections = [name for name in configuration if name not in configuration_sections]
+    if len(unknown_sections) > 0:
+        raise ValueError('Unknown configuration sections: {}'.format(', '.join(unknown_sections)))
+
+    for name in ('grid', 'wavelengths', 'imager'):
+        if name not in configuration:
+            raise ValueError('Missing configuration section: {}'.format(name))
+
+    for name in ('grid', 'system', 'imager', 'aperture', 'camera', 'frames'):
+        if name in configuration and not isinstance(configuration[name], dict):
+            raise ValueError('Configuration section {} must be a mapping'.format(name))
+
+    for name in ('sources', 'turbulence', 'filters', 'exposure_times', 'outputs'):
+        if name in configuration and not isinstance(configuration[name], list):
+            raise ValueError('Configuration section {} must be a list'.format(name))
+
+    for name in ('sources', 'turbulence', 'filters'):
+        for entry in configuration.get(name, []):
+            if not isinstance(entry, dict) or 'label' not in entry:
+                raise ValueError('Every entry in configuration section {} must be a mapping with a label'.format(name))
+
+    for name in configuration.get('outputs', []):
+        if name not in output_field_getters and name != 'captured_signal':
+            raise ValueError('Unknown output field {} (use one of {})'.format(name, ', '.join(sorted([*output_field_getters, 'captured_signal']))))
+
+    if configuration.get('exposure_times') and 'camera' not in configuration:
+        raise ValueError('Capturing exposures requires a camera section')
+
+    if 'frames' in configuration:
+        for name in ('phase_screens', 'n_frames', 'time_step'):
+            if name not in configuration['frames']:
+                raise ValueError('Missing frames parameter: {}'.format(name))
+        if configuration.get('exposure_times'):
+            raise ValueError('Frame sequences are captured with the exposure_time frames parameter, not exposure_times')
+        if configuration['frames'].get('exposure_time') is not None and 'camera' not in configuration:
+            raise ValueError('Capturing frame exposures requires a camera section')
+
+
+def create_wavelengths(wavelength_configuration):
+    '''
+    Returns the array of wavelengths [m] given either as a list, or as a mapping with the minimum
+    and maximum wavelength and the number of evenly spaced wavelengths.
+    '''
+    if isinstance(wavelength_configuration, dict):
+        return np.linspace(float(wavelength_configuration['minimum']), float(wavelength_configuration['maximum']), int(wavelength_configuration['count']))
+    else:
+        return np.asfarray(wavelength_configuration)
+
+
+def create_component(entry, component_classes, section_name):
+    '''
+    Creates the component of the type given in the configuration entry, passing the remaining entries
+    (except for the label and store_field) as keyword arguments to the constructor.
+    '''
+    type_name = entry.get('type')
+    if type_name not in component_classes:
+        raise ValueError('Unknown type {} for {} in configuration section {} (use one of {})'.format(type_name, entry['label'], section_name,
+                                                                                                     ', '.join(sorted(component_classes))))
+    parameters = {name: value for name, value in entry.items() if name not in ('type', 'label', 'store_field')}
+    return component_classes[type_name](**parameters)
+
+
+def create_imaging_system(configuration):
+    '''
+    Creates an imaging system with all the components described in the given configuration dictionary,
+    which has the following sections:
+
+    grid: Mapping with field_of_view_x, field_of_view_y and angular_coarseness [arcsec].
+    wavelengths: List of wavelengths [m], or mapping with minimum, maximum [m] and count.
+    system: Optional mapping with additional keyword arguments for ImagingSystem (like precision,
+        incremental or use_static_psfs).
+    threads: Optional number of threads, or 'auto' (used by the command line interface in run.py).
+    imager: Keyword arguments for imagers.FraunhoferImager.
+    aperture: Optional keyword arguments for apertures.CircularAperture.
+    sources: List of sources, each a mapping with a label, the type (a class name in source_classes),
+        an optional store_field flag and keyword arguments for the class.
+    turbulence: List of turbulence components like the sources, with classes in
+        aperture_turbulence_classes (added as aperture modulators) or image_turbulence_classes (added
+        as image postprocessors).
+    filters: List of keyword arguments for filters.Filter, used by the camera.
+    camera: Optional keyword arguments for cameras.Camera (excluding the filter set).
+    exposure_times: Optional list of exposure times [s] to capture after the propagation.
+    frames: Optional mapping with phase_screens (labels of moving phase screens), n_frames, time_step [s]
+        and optionally exposure_time [s]. If present, a frame sequence is simulated instead of a
+        single propagation (see ImagingSystem.run_frame_sequence).
+    outputs: Optional list of fields to write after the propagation: source, aperture, modulated_aperture,
+        image, postprocessed_image, camera_signal or captured_signal (one field per exposure time).
+    output_format: Optional file format for the written fields ('npz' or 'hdf5', see field_io).
+    '''
+    grid_configuration = configuration['grid']
+    system = imaging_system.ImagingSystem(math_utils.radian_from_arcsec(float(grid_configuration['field_of_view_x'])),
+                                          math_utils.radian_from_arcsec(float(grid_configuration['field_of_view_y'])),
+                                          math_utils.radian_from_arcsec(float(grid_configuration['angular_coarseness'])),
+                                          create_wavelengths(configuration['wavelengths']),
+                                          **configuration.get('system', {}))
+
+    system.set_imager(imagers.FraunhoferImager(**configuration['imager']))
+
+    if 'aperture' in configuration:
+        system.set_aperture(apertures.CircularAperture(**configuration['aperture']))
+
+    for entry in configuration.get('sources', []):
+        system.add_source(entry['label'], create_component(entry, source_classes, 'sources'), store_field=bool(entry.get('store_field', False)))
+
+    for entry in configuration.get('turbulence', []):
+        if entry.get('type') in image_turbulence_classes:
+            system.add_image_postprocessor(entry['label'], create_component(entry, image_turbulence_classes, 'turbulence'))
+        else:
+            system.add_aperture_modulator(entry['label'], create_component(entry, aperture_turbulence_classes, 'turbulence'),
+                                          store_field=bool(entry.get('store_field', False)))
+
+    if 'camera' in configuration:
+        filter_set = filters.FilterSet(*[filters.Filter(**filter_parameters) for filter_parameters in configuration.get('filters', [])])
+        system.set_camera(cameras.Camera(filter_set=filter_set, **configuration['camera']))
+
+    return system
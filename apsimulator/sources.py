@@ -10,13 +10,13 @@ import physics_utils
 import plot_utils
 
 
-class UniformStarField(field_processing.AdditiveFieldProcessor):
+class UniformStarField(field_processing.PointSourceFieldProcessor):
 
     def __init__(self, stellar_density=0.14, near_distance=2, far_distance=15000,
                        red_giant_fraction=0.01, red_supergiant_fraction=0.001,
                        temperature_variance_scale=0.1, luminosity_variance_scale=0.1,
                        combine_overlapping_stars=False,
-                       seed=None):
+                       seed=None, fixed_realization=False):
         self.set_stellar_density(stellar_density) # Average number of stars per volume [1/pc^3]
         self.set_near_distance(near_distance) # Distance to where the uniform star field begins [pc]
         self.set_far_distance(far_distance) # Distance to where the uniform star field ends [pc]
@@ -25,6 +25,8 @@ class UniformStarField(field_processing.AdditiveFieldProcessor):
         self.set_variance_scales(temperature_variance_scale, luminosity_variance_scale)
         self.set_seed(seed)
         self.set_combine_overlapping_stars(combine_overlapping_stars) # Whether to sum the fluxes of stars generated at the same position
+        self.set_fixed_realization(fixed_realization) # Whether every realization drawn with a seed is the first one for that seed
+        self.star_realization = None # Occupied grid cells and their spectral fluxes shared by all wavelength slices when processing in wavelength chunks
 
     def initialize_star_population(self):
         self.star_population = physics_utils.StarPopulation()
@@ -53,11 +55,39 @@ class UniformStarField(field_processing.AdditiveFieldProcessor):
     def set_combine_overlapping_stars(self, combine_overlapping_stars):
         self.combine_overlapping_stars = bool(combine_overlapping_stars)
 
+    def set_fixed_realization(self, fixed_realization):
+        '''
+        With fixed_realization=True and a seed, the random generators are reseeded before each
+        realization is drawn, so every draw gives the same stars. Otherwise, each draw continues the
+        random sequence from the seed, like the camera noise.
+        '''
+        self.fixed_realization = bool(fixed_realization)
+
     def set_seed(self, seed):
         self.seed = None if seed is None else int(seed)
         self.random_generator = np.random.RandomState(seed=self.seed)
         self.star_population.set_seed(None if self.seed is None else self.seed + 1)
 
+    def get_parameters(self):
+        '''
+        Implements the FieldProcessor method for reporting the parameters determining the star field.
+        Unless the realization is fixed, a new realization is drawn every time, so the process must
+        always be reapplied.
+        '''
+        if self.seed is None or not self.fixed_realization:
+            return None
+        star_population = self.star_population
+        return (self.stellar_density, self.near_distance, self.far_distance,
+                star_population.red_giant_fraction, star_population.red_supergiant_fraction,
+                star_population.temperature_variance_scale, star_population.luminosity_variance_scale,
+                self.combine_overlapping_stars, self.seed, self.fixed_realization)
+
+    def is_deterministic(self):
+        '''
+        Only a fixed realization is the same every time it is drawn, so only then can the star field be cached.
+        '''
+        return self.seed is not None and self.fixed_realization
+
     def compute_visible_star_field_volume(self, field_of_view_x, field_of_view_y):
         return (3/4)*np.tan(field_of_view_x/2)*np.tan(field_of_view_y/2)*(self.far_distance_cubed - self.near_distance_cubed)
 
@@ -98,30 +128,84 @@ class UniformStarField(field_processing.AdditiveFieldProcessor):
         stars = physics_utils.BlackbodyStars(self.wavelengths, distances, temperatures, luminosities)
         return stars
 
-    def generate_star_field(self):
+    def generate_star_realization(self):
+        '''
+        Draws the positions and properties of the stars in the field of view.
+        '''
+        if self.fixed_realization and self.seed is not None:
+            self.set_seed(self.seed)
 
         number_of_stars = self.generate_star_count()
 
-        total_number_of_grid_cells = self.grid.get_total_window_size()
-
         # Generate 1D index into the image array for each star, using a uniform distribution
-        star_indices = self.random_generator.randint(low=0, high=total_number_of_grid_cells, size=number_of_stars)
+        star_indices = self.random_generator.randint(low=0, high=self.grid.get_total_window_size(), size=number_of_stars)
 
         stars = self.generate_stars(number_of_stars)
 
-        # Compute flux spectrum recieved from each star
+        return star_indices, stars
+
+    def compute_star_fluxes(self, star_indices, stars):
+        '''
+        Computes the spectral fluxes recieved from the stars of a realization for all the wavelengths,
+        and returns the indices and spectral fluxes of the occupied grid cells. Multiple stars in the
+        same grid cell are summed if overlapping stars are combined, and otherwise only the last of
+        them is kept, like when assigning the fluxes to the cells in order.
+        '''
         spectral_fluxes = stars.compute_recieved_spectral_fluxes()
 
         if self.combine_overlapping_stars:
-            # Handle multiple stars in the same grid cells by summing the spectral fluxes with the same indices
-            star_indices, spectral_fluxes = self.sum_overlapping_values(star_indices, spectral_fluxes)
+            return self.sum_overlapping_values(star_indices, spectral_fluxes)
+        else:
+            return self.select_last_overlapping_values(star_indices, spectral_fluxes)
+
+    def compute_star_field(self, star_indices, spectral_fluxes):
+        '''
+        Computes the star field for the wavelengths in the current wavelength slice, given the indices
+        and spectral fluxes for all the wavelengths of the occupied grid cells (see compute_star_fluxes).
+        '''
+        spectral_fluxes = spectral_fluxes[self.wavelength_slice, :]
+
+        n_wavelengths = spectral_fluxes.shape[0]
 
-        star_field = np.zeros((self.n_wavelengths, total_number_of_grid_cells), dtype=self.dtype)
+        star_field = np.zeros((n_wavelengths, self.grid.get_total_window_size()), dtype=self.dtype)
         star_field[:, star_indices] = spectral_fluxes
-        star_field = star_field.reshape((self.n_wavelengths, *self.grid.window.shape))
+        star_field = star_field.reshape((n_wavelengths, *self.grid.window.shape))
 
         return star_field
 
+    def generate_star_field(self):
+        return self.compute_star_field(*self.compute_star_fluxes(*self.generate_star_realization()))
+
+    def compute_point_sources(self):
+        '''
+        Implements the PointSourceFieldProcessor method for obtaining the positions and spectral
+        fluxes of the stars for the wavelengths in the current wavelength slice. Overlapping stars are
+        handled like when adding the star field to a field.
+        '''
+        if self.star_realization is None:
+            star_indices, spectral_fluxes = self.compute_star_fluxes(*self.generate_star_realization())
+        else:
+            star_indices, spectral_fluxes = self.star_realization
+
+        spectral_fluxes = spectral_fluxes[self.wavelength_slice, :].astype(self.dtype)
+
+        # Convert the 1D indices into the window to 2D indices into the full grid
+        window = self.grid.window
+        x_indices, y_indices = np.unravel_index(star_indices, window.shape)
+
+        return x_indices + window.x.start, y_indices + window.y.start, spectral_fluxes
+
+    def begin_wavelength_chunks(self):
+        '''
+        Implements the FieldProcessor method by drawing a single star realization to use for all wavelength
+        slices. The spectral fluxes of the stars are computed once for all the wavelengths and sliced for each chunk.
+        '''
+        self.star_realization = self.compute_star_fluxes(*self.generate_star_realization())
+
+    def end_wavelength_chunks(self):
+        self.star_realization = None
+        super().end_wavelength_chunks()
+
     def sum_overlapping_values(self, positions, values):
         assert positions.ndim == 1
         assert values.ndim == 2
@@ -130,21 +214,35 @@ class UniformStarField(field_processing.AdditiveFieldProcessor):
         indices_of_positions_when_sorted = np.argsort(positions)
         sorted_positions = positions[indices_of_positions_when_sorted]
         unique_positions, start_indices_of_unique_positions = np.unique(sorted_positions, return_index=True)
-        indices_of_all_occurances_of_each_position = np.split(indices_of_positions_when_sorted, start_indices_of_unique_positions[1:])
 
-        summed_values = np.empty((values.shape[0], unique_positions.size))
+        if unique_positions.size == 0:
+            return unique_positions, np.empty((values.shape[0], 0))
 
-        for i in range(unique_positions.size):
-            summed_values[:, i] = np.sum(values[:, indices_of_all_occurances_of_each_position[i]], axis=1)
+        # Sum the values for each run of equal sorted positions
+        summed_values = np.add.reduceat(values[:, indices_of_positions_when_sorted], start_indices_of_unique_positions, axis=1)
 
         return unique_positions, summed_values
 
+    def select_last_overlapping_values(self, positions, values):
+        assert positions.ndim == 1
+        assert values.ndim == 2
+        assert values.shape[1] == positions.size
+
+        # Find the first occurrence of each position in the reversed positions, which is the last one in the original order
+        unique_positions, reversed_indices_of_unique_positions = np.unique(positions[::-1], return_index=True)
+
+        return unique_positions, values[:, positions.size - 1 - reversed_indices_of_unique_positions]
+
     def process(self, field):
         '''
         Implements the FieldProcessor method for adding the star field source field
         to the given field.
         '''
-        field.add_within_window(self.generate_star_field())
+        if self.star_realization is None:
+            star_field = self.generate_star_field()
+        else:
+            star_field = self.compute_star_field(*self.star_realization)
+        field.add_within_window(star_field)
 
     def plot_HR_diagram(self, absolute=False, output_path=False):
 
@@ -217,6 +315,9 @@ class UniformEmissionLineSkyglow(field_processing.AdditiveFieldProcessor):
         self.relative_emission_strengths = np.asfarray(relative_emission_strengths)
         assert self.relative_emission_strengths.ndim == 1
 
+    def get_parameters(self):
+        return (self.bortle_class, self.emission_wavelengths, self.relative_emission_strengths)
+
     def generate_skyglow(self):
 
         included_emission_mask = np.logical_and(self.emission_wavelengths >= self.wavelengths[0], self.emission_wavelengths <= self.wavelengths[-1])
@@ -252,12 +353,15 @@ class UniformEmissionLineSkyglow(field_processing.AdditiveFieldProcessor):
 
         return spectral_fluxes
 
+    def is_spatially_uniform(self):
+        return True
+
     def process(self, field):
         '''
         Implements the FieldProcessor method for adding the skyglow source field
         to the given field.
         '''
-        field += self.generate_skyglow()[:, np.newaxis, np.newaxis]
+        field += self.generate_skyglow()[self.wavelength_slice, np.newaxis, np.newaxis]
 
     def apply_process_field(self, field, process_field):
         field += process_field.values
@@ -284,6 +388,9 @@ class UniformBlackbodySkyglow(field_processing.AdditiveFieldProcessor):
     def set_color_temperature(self, color_temperature):
         self.color_temperature = float(color_temperature)
 
+    def get_parameters(self):
+        return (self.bortle_class, self.color_temperature)
+
     def generate_skyglow(self):
 
         # Estimate the solid angle of the field of view
@@ -312,12 +419,15 @@ class UniformBlackbodySkyglow(field_processing.AdditiveFieldProcessor):
 
         return spectral_fluxes
 
+    def is_spatially_uniform(self):
+        return True
+
     def process(self, field):
         '''
         Implements the FieldProcessor method for adding the skyglow source field
         to the given field.
         '''
-        field += self.generate_skyglow()[:, np.newaxis, np.newaxis]
+        field += self.generate_skyglow()[self.wavelength_slice, np.newaxis, np.newaxis]
 
     def apply_process_field(self, field, process_field):
         field += process_field.values
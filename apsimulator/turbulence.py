@@ -2,12 +2,13 @@
 # This file is part of the APSimulator API.
 # Author: Lars Frogner
 import numpy as np
-import scipy.signal
+import uuid
 import field_processing
 import grids
 import fields
 import math_utils
 import parallel_utils
+import fft_utils
 
 
 def compute_scaled_fried_parameter(reference_value, reference_wavelength, reference_zenith_angle, wavelength, zenith_angle):
@@ -51,6 +52,9 @@ class KolmogorovTurbulence:
         self.fried_parameter_at_zenith_angle = compute_zenith_angle_scaled_fried_parameter(self.reference_fried_parameter,
                                                                                            self.reference_zenith_angle, self.zenith_angle)
 
+    def get_turbulence_parameters(self):
+        return (self.reference_fried_parameter, self.reference_wavelength, self.reference_zenith_angle, self.zenith_angle)
+
     def compute_fried_parameter(self, wavelength):
         return compute_wavelength_scaled_fried_parameter(self.fried_parameter_at_zenith_angle, self.reference_wavelength, wavelength)
 
@@ -111,9 +115,38 @@ class AveragedKolmogorovTurbulence(KolmogorovTurbulence, field_processing.FieldP
 
         self.set_minimum_psf_extent(minimum_psf_extent)
 
+        self.kernel_spectrum_parameters = None # Parameters that the cached PSF and kernel spectrum were computed for
+        self.point_spread_function = None
+        self.kernel_spectrum = None
+
     def set_minimum_psf_extent(self, minimum_psf_extent):
         self.minimum_psf_extent = None if minimum_psf_extent is None else float(minimum_psf_extent)
 
+    def get_parameters(self):
+        return (*self.get_turbulence_parameters(), self.minimum_psf_extent)
+
+    def get_kernel_spectrum_parameters(self, window_shape):
+        '''
+        Returns the quantities determining the point spread function and its padded Fourier transform
+        when convolving values with the given window shape. They are only computed for the wavelengths in
+        the current slice, so that streaming in wavelength chunks never holds them for all the wavelengths.
+        '''
+        return (self.fried_parameter_at_zenith_angle, self.reference_wavelength,
+                self.get_wavelengths_in_slice().tobytes(), self.grid.shape, self.grid.cell_extent_x, self.grid.cell_extent_y,
+                self.minimum_psf_extent, tuple(window_shape), self.dtype.str)
+
+    def update_kernel_spectrum(self, window_shape):
+        '''
+        Computes the point spread function and its padded Fourier transform, unless they have already been
+        computed for the current parameters.
+        '''
+        kernel_spectrum_parameters = self.get_kernel_spectrum_parameters(window_shape)
+
+        if kernel_spectrum_parameters != self.kernel_spectrum_parameters:
+            self.point_spread_function = self.compute_point_spread_function()
+            self.kernel_spectrum = parallel_utils.parallel_compute_kernel_spectrum(self.point_spread_function, window_shape)
+            self.kernel_spectrum_parameters = kernel_spectrum_parameters
+
     def determine_optimal_psf_size(self):
         minimum_angular_width = self.minimum_psf_extent*np.max(self.compute_approximate_time_averaged_FWHM(self.wavelengths))
         minimum_width = 2*np.sin(minimum_angular_width/2)
@@ -127,7 +160,7 @@ class AveragedKolmogorovTurbulence(KolmogorovTurbulence, field_processing.FieldP
         angular_distances = math_utils.polar_angle_from_direction_vector(*self.grid.get_coordinate_meshes())
 
         # Approximate the long-exposure Kolmogorov PSF as the sum of two Moffat functions
-        point_spread_function = self.compute_dual_moffat_PSF_fit(self.wavelengths, angular_distances)
+        point_spread_function = self.compute_dual_moffat_PSF_fit(self.get_wavelengths_in_slice(), angular_distances)
 
         # Normalize to ensure energy conservation
         point_spread_function /= np.sum(point_spread_function, axis=(1,2))[:, np.newaxis, np.newaxis]
@@ -139,15 +172,19 @@ class AveragedKolmogorovTurbulence(KolmogorovTurbulence, field_processing.FieldP
             y_index_range = (self.grid.size_y//2 - psf_size//2, self.grid.size_y//2 + psf_size//2)
             point_spread_function = point_spread_function[:, x_index_range[0]:x_index_range[1], y_index_range[0]:y_index_range[1]]
 
-        return point_spread_function
+        return point_spread_function.astype(self.dtype)
 
     def process(self, field):
         '''
         Implements the FieldProcessor method for convolving the given field with the
-        time-averaged turbulence point spread function.
-        '''
-        point_spread_function = self.compute_point_spread_function()
-        convolved_field = parallel_utils.parallel_fftconvolve(field.get_values_inside_window(), point_spread_function)
+        time-averaged turbulence point spread function. The Fourier transform of the point spread
+        function is cached and only recomputed when the parameters it depends on, including the
+        wavelengths in the current slice, change.
+        '''
+        values_inside_window = field.get_values_inside_window()
+        self.update_kernel_spectrum(values_inside_window.shape[-2:])
+        convolved_field = parallel_utils.parallel_fftconvolve_with_kernel_spectrum(values_inside_window, self.kernel_spectrum,
+                                                                                   self.point_spread_function.shape)
         field.set_values_inside_window(convolved_field)
 
 
@@ -158,7 +195,7 @@ class KolmogorovPhaseScreen(KolmogorovTurbulence, field_processing.Multiplicativ
     '''
     def __init__(self, reference_fried_parameter=0.1,
                  reference_wavelength=500e-9, reference_zenith_angle=0, zenith_angle=0,
-                 n_subharmonic_levels=0, outer_scale=np.inf):
+                 n_subharmonic_levels=0, outer_scale=np.inf, seed=None):
 
         super().__init__(reference_fried_parameter=reference_fried_parameter,
                          reference_wavelength=reference_wavelength,
@@ -167,6 +204,7 @@ class KolmogorovPhaseScreen(KolmogorovTurbulence, field_processing.Multiplicativ
 
         self.set_n_subharmonic_levels(n_subharmonic_levels) # Number of subharmonic grids to use for improving large-scale accuracy
         self.set_outer_scale(outer_scale) # Largest size of the turbulent eddies [m]
+        self.set_seed(seed) # Seed for the phase screen realization (if None, numpy's global random generator is used)
 
     def set_n_subharmonic_levels(self, n_subharmonic_levels):
         self.n_subharmonic_levels = int(n_subharmonic_levels)
@@ -174,14 +212,40 @@ class KolmogorovPhaseScreen(KolmogorovTurbulence, field_processing.Multiplicativ
     def set_outer_scale(self, outer_scale):
         self.outer_scale = float(outer_scale)
 
+    def set_seed(self, seed):
+        '''
+        Sets the seed for the phase screen realization. It takes effect when the phase screen is
+        next initialized.
+        '''
+        self.seed = None if seed is None else int(seed)
+
     def precompute_processing_quantities(self):
         '''
         Implements the FieldProcessor method called after recieveing the properties of the aperture field.
         '''
         self.initialize_phase_screen()
 
+    def get_parameters(self):
+        '''
+        Implements the FieldProcessor method for reporting the parameters determining the modulation.
+        The phase screen realization is drawn when processing is initialized and reused for every field.
+        '''
+        return (*self.get_turbulence_parameters(), self.n_subharmonic_levels, self.outer_scale,
+                self.realization_identifier, self.aperture_shift)
+
+    def is_deterministic(self):
+        '''
+        An unseeded realization can never be drawn again, so its modulation is not cached.
+        '''
+        return self.seed is not None
+
     def initialize_phase_screen(self,  height_doublings=0):
 
+        # A seeded realization is fully determined by the seed. An unseeded realization is
+        # drawn from the global generator and identified by a unique random identifier.
+        self.random_generator = np.random if self.seed is None else np.random.RandomState(seed=self.seed)
+        self.realization_identifier = uuid.uuid4().hex if self.seed is None else self.seed
+
         self.setup_phase_screen_grid(height_doublings)
 
         # Precompute constant quantities for use with the filter functions
@@ -300,8 +364,8 @@ class KolmogorovPhaseScreen(KolmogorovTurbulence, field_processing.Multiplicativ
 
     def generate_white_noise(self, size):
         std_dev = 1/np.sqrt(2)
-        return    np.random.normal(loc=0, scale=std_dev, size=size) + \
-               1j*np.random.normal(loc=0, scale=std_dev, size=size)
+        return    self.random_generator.normal(loc=0, scale=std_dev, size=size) + \
+               1j*self.random_generator.normal(loc=0, scale=std_dev, size=size)
 
     def generate_high_frequency_phase_perturbations(self):
         '''
@@ -309,9 +373,9 @@ class KolmogorovPhaseScreen(KolmogorovTurbulence, field_processing.Multiplicativ
         function and taking the inverse Fourier transform.
         '''
         noise = self.generate_white_noise((self.screen_grid.size_x, self.screen_grid.size_y))
-        return self.screen_grid.get_total_size()*np.fft.ifft2(np.fft.ifftshift(noise[np.newaxis, :, :]*self.filter_functions,
-                                                                               axes=(1, 2)),
-                                                              axes=(1, 2)).real
+        return self.screen_grid.get_total_size()*fft_utils.fft2(np.fft.ifftshift(noise[np.newaxis, :, :]*self.filter_functions,
+                                                                                 axes=(1, 2)),
+                                                                inverse=True, overwrite_input=True).real
 
     def generate_low_frequency_phase_perturbations(self):
         '''
@@ -332,13 +396,15 @@ class KolmogorovPhaseScreen(KolmogorovTurbulence, field_processing.Multiplicativ
             phase_perturbations = self.generate_high_frequency_phase_perturbations()
             if self.n_subharmonic_levels > 0:
                 phase_perturbations += self.generate_low_frequency_phase_perturbations()
-            yield phase_perturbations
+            # The screen is generated in double precision and stored with the precision of the field
+            yield phase_perturbations.astype(math_utils.get_real_dtype(self.dtype), copy=False)
 
     def get_phase_screen_covering_aperture(self):
         '''
-        Returns a view into the part of the phase screen canvas currently covering the aperture window.
+        Returns a view into the part of the phase screen canvas currently covering the aperture window,
+        for the wavelengths in the current wavelength slice.
         '''
-        return self.phase_screen_canvas[:, :self.grid.window.size_x, self.aperture_shift:self.aperture_shift+self.grid.window.size_y]
+        return self.phase_screen_canvas[self.wavelength_slice, :self.grid.window.size_x, self.aperture_shift:self.aperture_shift+self.grid.window.size_y]
 
     def get_monochromatic_phase_screen_covering_aperture(self, wavelength_idx):
         '''
@@ -358,9 +424,9 @@ class KolmogorovPhaseScreen(KolmogorovTurbulence, field_processing.Multiplicativ
         Computes the analytical autocorrelation function for the part of the model without any subharmonic
         components.
         '''
-        return self.screen_grid.get_total_size()*np.fft.ifft2(np.fft.ifftshift(self.filter_functions**2,
-                                                                               axes=(1, 2)),
-                                                              axes=(1, 2)).real
+        return self.screen_grid.get_total_size()*fft_utils.fft2(np.fft.ifftshift(self.filter_functions**2,
+                                                                                 axes=(1, 2)),
+                                                                inverse=True, overwrite_input=True).real
 
     def compute_low_frequency_autocorrelation(self):
         '''
@@ -396,23 +462,45 @@ class MovingKolmogorovPhaseScreen(KolmogorovPhaseScreen):
 
     def __init__(self, reference_fried_parameter=0.1, wind_speed=10,
                  reference_wavelength=500e-9, reference_zenith_angle=0, zenith_angle=0,
-                 n_subharmonic_levels=0, outer_scale=np.inf):
+                 n_subharmonic_levels=0, outer_scale=np.inf, seed=None):
 
         super().__init__(reference_fried_parameter=reference_fried_parameter,
                          reference_wavelength=reference_wavelength,
                          reference_zenith_angle=reference_zenith_angle,
-                         zenith_angle=zenith_angle)
+                         zenith_angle=zenith_angle,
+                         n_subharmonic_levels=n_subharmonic_levels,
+                         outer_scale=outer_scale,
+                         seed=seed)
 
         self.set_wind_speed(wind_speed) # Speed at which the phase screen moves across the aperture [m/s]
 
     def set_wind_speed(self, wind_speed):
+        '''
+        Sets the wind speed and, if processing has been initialized, updates the quantities derived from
+        it. The phase screen keeps its current position, so the new speed applies from the next move.
+        '''
         self.wind_speed = float(wind_speed)
+        if hasattr(self, 'grid'):
+            self.compute_temporal_quantities()
+
+    def get_parameters(self):
+        '''
+        The total number of grid cells moved identifies the current state of the canvas for the realization.
+        '''
+        return (*super().get_parameters(), self.wind_speed, self.total_aperture_shift)
 
     def precompute_processing_quantities(self):
         '''
         Implements the FieldProcessor method called after recieveing the properties of the aperture field.
         '''
         self.initialize_phase_screen(height_doublings=1)
+        self.compute_temporal_quantities()
+
+        # Elapsed time [s]
+        self.time = 0
+
+        # Number of grid cells the phase screen has moved in total
+        self.total_aperture_shift = 0
 
     def compute_temporal_quantities(self):
 
@@ -431,9 +519,6 @@ class MovingKolmogorovPhaseScreen(KolmogorovPhaseScreen):
         # Time for a point on the normalized grid to traverse the aperture [s]
         self.aperture_crossing_duration = self.grid.window.size_y*self.grid.cell_extent_y/self.normalized_wind_speed
 
-        # Elapsed time [s]
-        self.time = 0
-
     def compute_tapering_function(self):
         '''
         Computes sine function that can be used to taper the edges of phase screens in the y-direction.
@@ -448,8 +533,10 @@ class MovingKolmogorovPhaseScreen(KolmogorovPhaseScreen):
         for adding a new phase screen with overlap.
         '''
 
+        self.tapering_function = self.compute_tapering_function()
+
         # Create canvas that fits 1.5 phase screens in height
-        self.phase_screen_canvas = np.zeros((self.n_wavelengths, self.n_screen_grid_cells_x, self.screen_grid.shift_y*3))
+        self.phase_screen_canvas = np.zeros((self.n_wavelengths, self.screen_grid.size_x, self.screen_grid.shift_y*3), dtype=math_utils.get_real_dtype(self.dtype))
 
         # Insert the first phase screen into the lower two thirds of the canvas
         self.phase_screen_canvas[:, :, :self.screen_grid.size_y] = next(self.phase_screen_generator)
@@ -477,13 +564,14 @@ class MovingKolmogorovPhaseScreen(KolmogorovPhaseScreen):
 
         # Update current shift
         self.aperture_shift += grid_cell_offset
+        self.total_aperture_shift += grid_cell_offset
         self.time += time_step
 
         # Handle shifting past the middle of the canvas
         if self.aperture_shift + self.grid.window.size_y >= 2*self.screen_grid.shift_y:
 
             # Generate an empty canvas
-            new_phase_screen_canvas = np.zeros(self.phase_screen_canvas.shape)
+            new_phase_screen_canvas = np.zeros(self.phase_screen_canvas.shape, dtype=self.phase_screen_canvas.dtype)
 
             # Insert the phase screen occupying the upper two thirds of the old canvas into the lower two thirds of the new canvas
             new_phase_screen_canvas[:, :, :self.screen_grid.shift_y*2] = self.phase_screen_canvas[:, :, self.screen_grid.shift_y:]
@@ -501,5 +589,8 @@ class MovingKolmogorovPhaseScreen(KolmogorovPhaseScreen):
     def get_coherence_time(self):
         return self.coherence_time
 
+    def get_time(self):
+        return self.time
+
     def get_wind_speed(self):
         return self.wind_speed
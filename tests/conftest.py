@@ -0,0 +1,8 @@
+# -*- coding: utf-8 -*-
+# This file is part of the APSimulator API.
+# Author: Lars Frogner
+import os
+import sys
+
+# The API modules import each other by bare name, so the package directory must be on the path.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'apsimulator'))
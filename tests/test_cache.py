@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+# This file is part of the APSimulator API.
+# Author: Lars Frogner
+import numpy as np
+import pytest
+import math_utils
+import imaging_system
+import imagers
+import apertures
+import sources
+import cache_utils
+import field_processing
+import profiling_utils
+
+
+@pytest.fixture
+def cache_directory(tmp_path):
+    cache_utils.enable_cache(str(tmp_path))
+    profiling_utils.enable_profiling()
+    profiling_utils.reset_profiling()
+    yield tmp_path
+    profiling_utils.disable_profiling()
+    profiling_utils.reset_profiling()
+    cache_utils.disable_cache()
+
+
+def create_imaging_system(fixed_realization):
+    system = imaging_system.ImagingSystem(math_utils.radian_from_arcsec(20),
+                                          math_utils.radian_from_arcsec(20),
+                                          math_utils.radian_from_arcsec(1),
+                                          np.linspace(400, 700, 3)*1e-9)
+    system.set_imager(imagers.FraunhoferImager(aperture_diameter=0.15, focal_length=0.75))
+    system.set_aperture(apertures.CircularAperture(diameter=0.15))
+    system.add_source('stars', sources.UniformStarField(stellar_density=1, near_distance=2, far_distance=5000, seed=3,
+                                                       fixed_realization=fixed_realization))
+    return system
+
+
+def compute_source_fields(system, n_runs):
+    source_fields = []
+    for _ in range(n_runs):
+        system.run_full_propagation()
+        source_fields.append(system.get_source_field().values.copy())
+    return source_fields
+
+
+def test_seeded_source_without_fixed_realization_is_never_cached(cache_directory):
+    cache_utils.disable_cache()
+    uncached_source_fields = compute_source_fields(create_imaging_system(False), 2)
+    assert not np.array_equal(uncached_source_fields[0], uncached_source_fields[1])
+
+    cache_utils.enable_cache(str(cache_directory))
+    for _ in range(2):
+        system = create_imaging_system(False)
+        cached_source_fields = compute_source_fields(system, 2)
+        for cached_source_field, uncached_source_field in zip(cached_source_fields, uncached_source_fields):
+            assert np.array_equal(cached_source_field, uncached_source_field)
+
+    stage = system.source_pipeline.stages['stars']
+    assert stage.get_cache_fingerprint() is None
+    parameter_fingerprint = stage.get_parameter_fingerprint()
+    if parameter_fingerprint is not None:
+        assert cache_utils.load_array(field_processing.compute_fingerprint(('process field', parameter_fingerprint))) is None
+
+
+def test_fixed_realization_is_loaded_from_cache(cache_directory):
+    first_source_fields = compute_source_fields(create_imaging_system(True), 2)
+    second_source_fields = compute_source_fields(create_imaging_system(True), 1)
+    assert np.array_equal(first_source_fields[0], first_source_fields[1])
+    assert np.array_equal(first_source_fields[0], second_source_fields[0])
+    assert profiling_utils.get_counter('cache_utils.hits') > 0
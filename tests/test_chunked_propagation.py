@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+# This file is part of the APSimulator API.
+# Author: Lars Frogner
+import numpy as np
+import tracemalloc
+import math_utils
+import imaging_system
+import imagers
+import apertures
+import sources
+import turbulence
+import filters
+import cameras
+
+
+def create_imaging_system(n_wavelengths):
+    system = imaging_system.ImagingSystem(math_utils.radian_from_arcsec(60),
+                                          math_utils.radian_from_arcsec(60),
+                                          math_utils.radian_from_arcsec(0.5),
+                                          np.linspace(400, 700, n_wavelengths)*1e-9)
+    system.set_imager(imagers.FraunhoferImager(aperture_diameter=0.15, focal_length=0.75))
+    system.set_aperture(apertures.CircularAperture(diameter=0.15, inner_diameter=0.03))
+    system.set_camera(cameras.Camera(filter_set=filters.FilterSet(filters.Filter('visual', 400e-9, 700e-9)), seed=3))
+    system.add_source('stars', sources.UniformStarField(seed=42, fixed_realization=True), store_field=True)
+    system.add_aperture_modulator('phase_screen', turbulence.KolmogorovPhaseScreen(reference_fried_parameter=0.08, seed=1), store_field=True)
+    system.add_image_postprocessor('seeing', turbulence.AveragedKolmogorovTurbulence(reference_fried_parameter=0.08))
+    return system
+
+
+def measure_peak_chunked_propagation_bytes(system, n_wavelengths_per_chunk):
+    tracemalloc.start()
+    try:
+        initial_bytes = tracemalloc.get_traced_memory()[0]
+        system.run_chunked_propagation(n_wavelengths_per_chunk)
+        return tracemalloc.get_traced_memory()[1] - initial_bytes
+    finally:
+        tracemalloc.stop()
+
+
+def test_chunked_propagation_matches_full_propagation():
+    full_system = create_imaging_system(6)
+    full_system.run_full_propagation()
+    chunked_system = create_imaging_system(6)
+    chunked_system.run_chunked_propagation(4)
+    full_signal = full_system.get_camera_signal_field().values
+    assert np.abs(full_signal).max() > 0
+    assert np.allclose(chunked_system.get_camera_signal_field().values, full_signal, rtol=0, atol=1e-12*np.abs(full_signal).max())
+
+
+def test_chunked_propagation_memory_scales_with_chunk_size():
+    few_wavelengths_peak_bytes = measure_peak_chunked_propagation_bytes(create_imaging_system(4), 2)
+    many_wavelengths_peak_bytes = measure_peak_chunked_propagation_bytes(create_imaging_system(16), 2)
+    larger_chunks_peak_bytes = measure_peak_chunked_propagation_bytes(create_imaging_system(16), 8)
+
+    # Four times as many wavelengths must not require notably more memory for the same chunk size
+    assert many_wavelengths_peak_bytes < 1.5*few_wavelengths_peak_bytes
+    assert larger_chunks_peak_bytes > 2*many_wavelengths_peak_bytes
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+# This file is part of the APSimulator API.
+# Author: Lars Frogner
+import numpy as np
+import threading
+import pytest
+import fft_utils
+
+
+@pytest.fixture
+def plan_limit():
+    original_max_plans = fft_utils.get_max_plans()
+    fft_utils.clear_plans()
+    fft_utils.set_max_plans(3)
+    yield
+    fft_utils.set_max_plans(original_max_plans)
+    fft_utils.clear_plans()
+
+
+@pytest.mark.skipif(fft_utils.pyfftw is None, reason='FFTW plans are only cached per thread with pyFFTW')
+def test_plans_from_many_threads_are_bounded(plan_limit):
+    original_backend = fft_utils.get_backend()
+    fft_utils.set_backend('pyfftw')
+
+    def transform():
+        fft_utils.fft2(np.ones((4, 8, 8), dtype='complex128'))
+
+    # Plans cached per thread must not accumulate when threads come and go
+    for _ in range(10):
+        thread = threading.Thread(target=transform)
+        thread.start()
+        thread.join()
+    assert len(fft_utils.plans) <= 3
+
+    fft_utils.set_backend(original_backend)
+
+
+def test_least_recently_used_plan_is_discarded(plan_limit):
+    first_plan = fft_utils.get_plan('fft', (8, 8), 'complex128')
+    fft_utils.get_plan('fft', (16, 16), 'complex128')
+    fft_utils.get_plan('fft', (32, 32), 'complex128')
+    assert fft_utils.get_plan('fft', (8, 8), 'complex128') is first_plan
+
+    fft_utils.get_plan('fft', (64, 64), 'complex128')
+    assert len(fft_utils.plans) == 3
+    assert fft_utils.get_plan('fft', (8, 8), 'complex128') is first_plan
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+# This file is part of the APSimulator API.
+# Author: Lars Frogner
+import numpy as np
+import pytest
+import grids
+import fields
+import field_io
+
+
+@pytest.fixture
+def small_chunks():
+    original_chunk_size = field_io.chunk_size
+    # Small chunks make partial reads cover only some of the chunks
+    field_io.set_chunk_size(2000)
+    yield
+    field_io.set_chunk_size(original_chunk_size)
+
+
+def create_field(window_only=False):
+    grid = grids.FFTGrid(7, 6, 1.0, 2.0, grid_type='source')
+    grid.define_window((-0.2, 0.3), (-0.5, 0.4))
+    wavelengths = np.linspace(400e-9, 700e-9, 9)
+    values = np.random.default_rng(0).random((9, 128, 64))
+    return fields.SpectralField(grid, wavelengths, initial_value=values, window_only=window_only, padding_value=2)
+
+
+@pytest.mark.parametrize('file_format', field_io.available_formats)
+@pytest.mark.parametrize('window_only', [False, True])
+def test_field_round_trip(tmp_path, small_chunks, file_format, window_only):
+    field = create_field(window_only=window_only)
+    path = tmp_path / 'field.{}'.format('h5' if file_format == 'hdf5' else 'npz')
+
+    field_io.write_field(field, path)
+    read_field = field_io.read_field(path)
+
+    assert isinstance(read_field, fields.SpectralField)
+    assert read_field.window_only == window_only
+    assert read_field.padding_value == field.padding_value
+    assert np.array_equal(read_field.wavelengths, field.wavelengths)
+    assert read_field.grid.shape == field.grid.shape
+    assert read_field.grid.window.shape == field.grid.window.shape
+    assert np.array_equal(read_field.values, field.values)
+    assert np.array_equal(np.asarray(read_field), np.asarray(field))
+
+
+@pytest.mark.parametrize('file_format', field_io.available_formats)
+def test_partial_read_by_wavelength_range_and_window(tmp_path, small_chunks, file_format):
+    field = create_field()
+    path = tmp_path / 'field.{}'.format('h5' if file_format == 'hdf5' else 'npz')
+    field_io.write_field(field, path)
+
+    window = field.grid.window
+    inner_window = grids.IndexRange2D(window.x.start + 3, window.x.end - 2, window.y.start + 1, window.y.end)
+    wavelength_indices = np.nonzero((field.wavelengths >= 450e-9) & (field.wavelengths <= 600e-9))[0]
+    expected_values = field.values[wavelength_indices[0]:wavelength_indices[-1] + 1,
+                                   inner_window.x.start:inner_window.x.end,
+                                   inner_window.y.start:inner_window.y.end]
+
+    read_field = field_io.read_field(path, wavelength_range=(450e-9, 600e-9), window=inner_window)
+
+    assert read_field.window_only
+    assert np.array_equal(read_field.wavelengths, field.wavelengths[wavelength_indices])
+    assert np.array_equal(read_field.values, expected_values)
+    assert np.array_equal(field_io.read_values(path, wavelength_range=(450e-9, 600e-9), window=inner_window), expected_values)
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+# This file is part of the APSimulator API.
+# Author: Lars Frogner
+import numpy as np
+import pytest
+import grids
+import fields
+import field_processing
+
+
+def create_field(**field_kwargs):
+    grid = grids.FFTGrid(3, 3, 1, 1)
+    grid.define_window((-0.25, 0.25), (-0.25, 0.25))
+    return fields.SpectralField(grid, [500e-9, 600e-9], initial_value=np.arange(2*8*8, dtype='float64').reshape(2, 8, 8), **field_kwargs)
+
+
+class DirectlyDoublingProcessor(field_processing.FieldProcessor):
+    def process(self, field):
+        field.values *= 2
+
+
+def test_array_protocol_honours_copy():
+    field = create_field()
+
+    assert np.shares_memory(field.__array__(), field.values)
+    assert np.shares_memory(field.__array__(copy=False), field.values)
+    copied_values = field.__array__(copy=True)
+    assert not np.shares_memory(copied_values, field.values)
+    assert np.array_equal(copied_values, field.values)
+    assert field.__array__(dtype='float32', copy=None).dtype == np.float32
+
+    with pytest.raises(ValueError):
+        field.__array__(dtype='float32', copy=False)
+
+
+def test_array_protocol_of_new_arrays_refuses_copy_false():
+    field = create_field()
+    window_field = create_field(window_only=True)
+    lazy_expression = field.multiplied(2, lazy=True)
+
+    for array_like in (lazy_expression, fields.PaddedWindowValues(window_field)):
+        assert array_like.__array__(copy=True).shape == field.shape
+        with pytest.raises(ValueError):
+            array_like.__array__(copy=False)
+
+
+def test_processor_modifying_values_directly_does_not_affect_original_field():
+    original_field = create_field()
+    original_values = original_field.values.copy()
+    pipeline = field_processing.FieldProcessingPipeline(original_field)
+    pipeline.add_field_processor('doubling', DirectlyDoublingProcessor())
+
+    pipeline.compute_processed_field()
+
+    assert np.array_equal(pipeline.get_processed_field().values, 2*original_values)
+    assert np.array_equal(original_field.values, original_values)
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+# This file is part of the APSimulator API.
+# Author: Lars Frogner
+import numpy as np
+import pytest
+import math_utils
+import imaging_system
+import imagers
+import apertures
+import sources
+import turbulence
+
+
+def create_imaging_system(incremental, fixed_realization):
+    system = imaging_system.ImagingSystem(math_utils.radian_from_arcsec(20),
+                                          math_utils.radian_from_arcsec(20),
+                                          math_utils.radian_from_arcsec(1),
+                                          np.linspace(400, 700, 3)*1e-9,
+                                          incremental=incremental)
+    system.set_imager(imagers.FraunhoferImager(aperture_diameter=0.15, focal_length=0.75))
+    system.set_aperture(apertures.CircularAperture(diameter=0.15))
+    system.add_source('stars', sources.UniformStarField(stellar_density=1, near_distance=2, far_distance=5000, seed=3,
+                                                       fixed_realization=fixed_realization))
+    system.add_aperture_modulator('phase_screen', turbulence.KolmogorovPhaseScreen(reference_fried_parameter=0.08, seed=1))
+    system.add_image_postprocessor('seeing', turbulence.AveragedKolmogorovTurbulence(reference_fried_parameter=0.08))
+    return system
+
+
+@pytest.mark.parametrize('fixed_realization', [False, True])
+def test_incremental_propagation_matches_full_recomputation(fixed_realization):
+    incremental_system = create_imaging_system(True, fixed_realization)
+    full_system = create_imaging_system(False, fixed_realization)
+
+    for run_idx in range(3):
+        if run_idx == 2:
+            # Only the seeing changes, which the incremental system can skip everything else for
+            for system in (incremental_system, full_system):
+                system.image_postprocessing_pipeline.get_processor('seeing').set_reference_fried_parameter(0.1, 500e-9, 0)
+        incremental_system.run_full_propagation()
+        full_system.run_full_propagation()
+        assert np.array_equal(incremental_system.get_source_field().values, full_system.get_source_field().values)
+        assert np.array_equal(incremental_system.get_postprocessed_image_field().values, full_system.get_postprocessed_image_field().values)
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+# This file is part of the APSimulator API.
+# Author: Lars Frogner
+import numpy as np
+import pytest
+import fft_utils
+import parallel_utils
+
+
+class RecordingLazyValues:
+    '''
+    Lazily evaluated values recording the number of elements along the first axis
+    evaluated in each indexing.
+    '''
+    def __init__(self, values):
+        self.values = values
+        self.shape = values.shape
+        self.ndim = values.ndim
+        self.dtype = values.dtype
+        self.evaluated_lengths = []
+
+    def __getitem__(self, indices):
+        evaluated_values = self.values[indices].copy()
+        self.evaluated_lengths.append(evaluated_values.shape[0])
+        return evaluated_values
+
+
+@pytest.fixture
+def threads_without_native_threading(monkeypatch):
+    monkeypatch.setattr(fft_utils, 'has_native_threading', lambda: False)
+    # Two threads are used even on single core machines
+    monkeypatch.setattr(parallel_utils.mp, 'cpu_count', lambda: 2)
+    original_n_threads = parallel_utils.get_number_of_threads()
+    parallel_utils.set_number_of_threads(2)
+    yield
+    parallel_utils.set_number_of_threads(original_n_threads)
+
+
+@pytest.mark.parametrize('use_real_values', [True, False])
+def test_lazy_values_are_evaluated_one_chunk_at_a_time_without_native_threading(threads_without_native_threading, use_real_values):
+    values = np.random.default_rng(0).standard_normal((6, 8, 8))
+    if not use_real_values:
+        values = values + 1j*np.random.default_rng(1).standard_normal((6, 8, 8))
+    lazy_values = RecordingLazyValues(values)
+
+    fourier_coefficients = parallel_utils.parallel_fft2(lazy_values)
+
+    assert parallel_utils.get_thread_pool() is not None
+    assert lazy_values.evaluated_lengths == [1]*values.shape[0]
+    assert np.allclose(fourier_coefficients, parallel_utils.parallel_fft2(values))
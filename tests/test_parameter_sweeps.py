@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+# This file is part of the APSimulator API.
+# Author: Lars Frogner
+import numpy as np
+import pytest
+import math_utils
+import imaging_system
+import imagers
+import apertures
+import sources
+import turbulence
+import filters
+import cameras
+import parallel_utils
+import profiling_utils
+import parameter_sweeps
+
+
+def create_imaging_system(aperture_diameter=0.15, incremental=True):
+    system = imaging_system.ImagingSystem(math_utils.radian_from_arcsec(40),
+                                          math_utils.radian_from_arcsec(40),
+                                          math_utils.radian_from_arcsec(0.5),
+                                          np.linspace(400, 700, 4)*1e-9,
+                                          incremental=incremental)
+    system.set_imager(imagers.FraunhoferImager(aperture_diameter=aperture_diameter, focal_length=0.75))
+    system.set_aperture(apertures.CircularAperture(diameter=aperture_diameter, inner_diameter=0.03))
+    system.set_camera(cameras.Camera(filter_set=filters.FilterSet(filters.Filter('visual', 400e-9, 700e-9)), seed=3))
+    system.add_source('stars', sources.UniformStarField(seed=42, fixed_realization=True), store_field=True)
+    system.add_aperture_modulator('phase_screen', turbulence.KolmogorovPhaseScreen(reference_fried_parameter=0.08, seed=1))
+    system.add_image_postprocessor('seeing', turbulence.AveragedKolmogorovTurbulence(reference_fried_parameter=0.08))
+    return system
+
+
+def set_stellar_seed(system, seed):
+    system.get_source('stars').set_seed(seed)
+
+
+def set_seeing_fried_parameter(system, fried_parameter):
+    system.image_postprocessing_pipeline.get_processor('seeing').set_reference_fried_parameter(fried_parameter, 500e-9, 0)
+
+
+def compute_total_signal(system):
+    return float(system.get_camera_signal_field().values.sum())
+
+
+def get_postprocessed_image_values(system):
+    return system.get_postprocessed_image_field().values.copy()
+
+
+@pytest.fixture
+def two_workers(monkeypatch):
+    original_n_threads = parallel_utils.get_number_of_threads()
+    # Two workers are used even on single core machines
+    monkeypatch.setattr(parallel_utils.mp, 'cpu_count', lambda: 2)
+    parallel_utils.set_number_of_threads(2)
+    profiling_utils.reset_profiling()
+    profiling_utils.enable_profiling()
+    yield
+    profiling_utils.disable_profiling()
+    profiling_utils.reset_profiling()
+    parallel_utils.set_number_of_threads(original_n_threads)
+
+
+@pytest.mark.parametrize('backend', ['threads', 'processes'])
+def test_sweep_results_equal_direct_runs(two_workers, backend):
+    sweep = parameter_sweeps.ParameterSweep(create_imaging_system)
+    sweep.add_parameter('aperture_diameter', [0.1, 0.15])
+    sweep.add_parameter('seed', [42, 7], set_stellar_seed)
+    sweep.add_parameter('fried_parameter', [0.05, 0.1], set_seeing_fried_parameter)
+    sweep.set_exposure_times([1, 10])
+    sweep.add_metric('total_signal', compute_total_signal)
+    sweep.add_metric('image_values', get_postprocessed_image_values)
+
+    results = sweep.run(n_workers=2, backend=backend)
+
+    assert profiling_utils.get_counter('parallel_utils.concurrent_tasks') == 2
+    assert len(results) == 2*2*2*2
+    for result in results:
+        parameters = result['parameters']
+        system = create_imaging_system(aperture_diameter=parameters['aperture_diameter'], incremental=False)
+        set_stellar_seed(system, parameters['seed'])
+        set_seeing_fried_parameter(system, parameters['fried_parameter'])
+        system.run_full_propagation()
+        system.capture_exposure(parameters['exposure_time'])
+
+        # Workers may use a different number of FFT threads, which changes the rounding errors
+        image_values = system.get_postprocessed_image_field().values
+        assert np.allclose(result['metrics']['image_values'], image_values, rtol=0, atol=1e-12*np.abs(image_values).max())
+        assert result['metrics']['total_signal'] > 0
+        assert np.isclose(result['metrics']['total_signal'], compute_total_signal(system), rtol=1e-12, atol=0)
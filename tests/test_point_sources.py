@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+# This file is part of the APSimulator API.
+# Author: Lars Frogner
+import numpy as np
+import pytest
+import math_utils
+import imaging_system
+import imagers
+import apertures
+import sources
+
+
+def create_imaging_system(use_point_sources, combine_overlapping_stars):
+    system = imaging_system.ImagingSystem(math_utils.radian_from_arcsec(20),
+                                          math_utils.radian_from_arcsec(20),
+                                          math_utils.radian_from_arcsec(1),
+                                          np.linspace(400, 700, 4)*1e-9,
+                                          use_point_sources=use_point_sources)
+    system.set_imager(imagers.FraunhoferImager(aperture_diameter=0.15, focal_length=0.75))
+    system.set_aperture(apertures.CircularAperture(diameter=0.15, inner_diameter=0.03))
+    # The star fields are dense enough for stars to overlap, both within each field and between them
+    for seed in (42, 43):
+        system.add_source('stars_{:d}'.format(seed), sources.UniformStarField(stellar_density=10, near_distance=2, far_distance=5000, seed=seed,
+                                                                           combine_overlapping_stars=combine_overlapping_stars,
+                                                                           fixed_realization=True))
+    return system
+
+
+@pytest.mark.parametrize('combine_overlapping_stars', [False, True])
+def test_point_source_aperture_field_matches_source_field_transform(combine_overlapping_stars):
+    dense_system = create_imaging_system(False, combine_overlapping_stars)
+    point_source_system = create_imaging_system(True, combine_overlapping_stars)
+    assert point_source_system.uses_point_sources() and not dense_system.uses_point_sources()
+
+    star_indices, _ = dense_system.get_source('stars_42').generate_star_realization()
+    assert np.unique(star_indices).size < star_indices.size
+
+    dense_system.run_full_propagation()
+    point_source_system.run_full_propagation()
+
+    dense_aperture_values = dense_system.get_aperture_field().get_values_inside_window()
+    point_source_aperture_values = point_source_system.get_aperture_field().get_values_inside_window()
+    assert np.allclose(point_source_aperture_values, dense_aperture_values, rtol=0, atol=1e-12*np.abs(dense_aperture_values).max())
+
+    dense_image_values = dense_system.get_image_field().get_values_inside_window()
+    point_source_image_values = point_source_system.get_image_field().get_values_inside_window()
+    assert np.allclose(point_source_image_values, dense_image_values, rtol=0, atol=1e-12*dense_image_values.max())
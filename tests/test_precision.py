@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+# This file is part of the APSimulator API.
+# Author: Lars Frogner
+import numpy as np
+import math_utils
+import imaging_system
+import imagers
+import apertures
+import sources
+import turbulence
+
+
+def create_imaging_system(precision):
+    # The phase screen draws from the global generator, so it is seeded for an identical scene in both precisions
+    np.random.seed(0)
+    system = imaging_system.ImagingSystem(math_utils.radian_from_arcsec(60),
+                                          math_utils.radian_from_arcsec(60),
+                                          math_utils.radian_from_arcsec(0.5),
+                                          np.linspace(400, 700, 4)*1e-9,
+                                          precision=precision)
+    system.set_imager(imagers.FraunhoferImager(aperture_diameter=0.15, focal_length=0.75))
+    system.set_aperture(apertures.CircularAperture(diameter=0.15, inner_diameter=0.03))
+    system.add_source('stars', sources.UniformStarField(seed=42))
+    system.add_aperture_modulator('phase_screen', turbulence.KolmogorovPhaseScreen(reference_fried_parameter=0.08))
+    return system
+
+
+def test_single_precision_image_error_is_within_estimate():
+    single_precision_system = create_imaging_system('single')
+    double_precision_system = create_imaging_system('double')
+    for system in (single_precision_system, double_precision_system):
+        system.compute_source_field()
+        system.compute_aperture_field()
+        system.compute_modulated_aperture_field()
+        system.compute_image_field()
+
+    single_precision_fluxes = single_precision_system.get_image_field().get_values_inside_window().astype('float64')
+    double_precision_fluxes = double_precision_system.get_image_field().get_values_inside_window()
+
+    relative_rms_difference = np.sqrt(np.mean((single_precision_fluxes - double_precision_fluxes)**2)/np.mean(double_precision_fluxes**2))
+    assert 0 < relative_rms_difference < single_precision_system.estimate_relative_image_flux_error()
+    assert double_precision_system.estimate_relative_image_flux_error() < single_precision_system.estimate_relative_image_flux_error()
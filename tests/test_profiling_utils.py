@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+# This file is part of the APSimulator API.
+# Author: Lars Frogner
+import numpy as np
+import threading
+import pytest
+import profiling_utils
+
+
+@pytest.fixture
+def memory_profiling():
+    profiling_utils.reset_profiling()
+    profiling_utils.enable_profiling(track_memory=True)
+    yield
+    profiling_utils.disable_profiling()
+    profiling_utils.reset_profiling()
+
+
+def allocate(n_bytes):
+    return np.ones(n_bytes, dtype=np.uint8)
+
+
+def test_nested_timers_measure_their_own_peaks(memory_profiling):
+    with profiling_utils.timed('outer'):
+        with profiling_utils.timed('inner'):
+            values = allocate(4_000_000)
+        del values
+        values = allocate(1_000_000)
+        del values
+
+    inner = profiling_utils.get_timer_statistics('inner')
+    outer = profiling_utils.get_timer_statistics('outer')
+    assert 4_000_000 <= inner.peak_allocated_bytes < 4_500_000
+    assert 4_000_000 <= outer.peak_allocated_bytes < 4_500_000
+    assert inner.concurrent_calls == outer.concurrent_calls == 0
+
+
+def test_concurrent_timers_record_no_memory(memory_profiling):
+    both_entered = threading.Barrier(2)
+    both_allocated = threading.Barrier(2)
+
+    def run_timer(name, n_bytes):
+        with profiling_utils.timed(name):
+            both_entered.wait()
+            values = allocate(n_bytes)
+            both_allocated.wait()
+            del values
+
+    threads = [threading.Thread(target=run_timer, args=('first', 4_000_000)),
+               threading.Thread(target=run_timer, args=('second', 1_000_000))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    for name in ('first', 'second'):
+        statistics = profiling_utils.get_timer_statistics(name)
+        assert statistics.calls == 1
+        assert statistics.concurrent_calls == 1
+        assert statistics.peak_allocated_bytes is None
+
+    # Memory is measured again once the timers no longer overlap
+    with profiling_utils.timed('first'):
+        values = allocate(2_000_000)
+        del values
+    assert 2_000_000 <= profiling_utils.get_timer_statistics('first').peak_allocated_bytes < 2_500_000
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+# This file is part of the APSimulator API.
+# Author: Lars Frogner
+import numpy as np
+import math_utils
+import imaging_system
+import imagers
+import apertures
+import turbulence
+import filters
+import cameras
+import field_processing
+
+
+class PointSources(field_processing.AdditiveFieldProcessor):
+    '''
+    Adds point sources with the given (x-index, y-index, flux) to the source field.
+    '''
+    def __init__(self, points):
+        self.points = list(points)
+
+    def get_parameters(self):
+        return (tuple(self.points),)
+
+    def process(self, field):
+        for idx_x, idx_y, flux in self.points:
+            field.values[:, idx_x, idx_y] += flux
+
+
+points = [(69, 61, 2.0), (44, 75, 1.0), (30, 90, 0.5)]
+
+
+def create_imaging_system(points, **system_kwargs):
+    system = imaging_system.ImagingSystem(math_utils.radian_from_arcsec(40),
+                                          math_utils.radian_from_arcsec(30),
+                                          math_utils.radian_from_arcsec(0.5),
+                                          np.linspace(400, 700, 5)*1e-9,
+                                          **system_kwargs)
+    system.set_imager(imagers.FraunhoferImager(aperture_diameter=0.15, focal_length=0.75))
+    system.set_aperture(apertures.CircularAperture(diameter=0.15, inner_diameter=0.03))
+    system.set_camera(cameras.Camera(filter_set=filters.FilterSet(filters.Filter('visual', 400e-9, 700e-9)), seed=3))
+    system.add_aperture_modulator('phase_screen', turbulence.KolmogorovPhaseScreen(reference_fried_parameter=0.08, seed=1))
+    system.add_source('points', PointSources(points))
+    return system
+
+
+def test_static_psf_image_equals_incoherent_sum_of_point_images():
+    incoherent_sum = 0
+    for point in points:
+        system = create_imaging_system([point])
+        system.run_full_propagation()
+        incoherent_sum = incoherent_sum + system.get_image_field().get_values_inside_window()
+
+    static_psf_system = create_imaging_system(points, use_static_psfs=True)
+    static_psf_system.run_full_propagation()
+    image_values = static_psf_system.get_image_field().get_values_inside_window()
+
+    assert np.allclose(image_values, incoherent_sum, rtol=0, atol=1e-12*np.abs(incoherent_sum).max())
+
+
+def test_chunked_static_psf_propagation_matches_full_propagation():
+    full_system = create_imaging_system(points, use_static_psfs=True)
+    full_system.run_full_propagation()
+    full_signal = full_system.get_camera_signal_field().values
+
+    chunked_system = create_imaging_system(points, use_static_psfs=True)
+    chunked_system.run_chunked_propagation(2)
+
+    assert np.abs(full_signal).max() > 0
+    assert np.allclose(chunked_system.get_camera_signal_field().values, full_signal, rtol=0, atol=1e-12*np.abs(full_signal).max())
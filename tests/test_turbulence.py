@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+# This file is part of the APSimulator API.
+# Author: Lars Frogner
+import numpy as np
+import math_utils
+import imaging_system
+import imagers
+import apertures
+import turbulence
+
+
+def create_moving_phase_screen(wind_speed):
+    system = imaging_system.ImagingSystem(math_utils.radian_from_arcsec(40),
+                                          math_utils.radian_from_arcsec(40),
+                                          math_utils.radian_from_arcsec(0.5),
+                                          np.linspace(400, 700, 3)*1e-9)
+    system.set_imager(imagers.FraunhoferImager(aperture_diameter=0.15, focal_length=0.75))
+    system.set_aperture(apertures.CircularAperture(diameter=0.15))
+    system.add_aperture_modulator('moving_screen', turbulence.MovingKolmogorovPhaseScreen(reference_fried_parameter=0.08, wind_speed=wind_speed, seed=1))
+    return system.get_aperture_modulator('moving_screen')
+
+
+def test_setting_wind_speed_updates_temporal_quantities():
+    phase_screen = create_moving_phase_screen(5)
+    reference_phase_screen = create_moving_phase_screen(10)
+
+    phase_screen.move_phase_screen(0.01)
+    total_aperture_shift = phase_screen.total_aperture_shift
+    phase_screen.set_wind_speed(10)
+
+    for name in ('coherence_time', 'normalized_wind_speed', 'grid_speed', 'min_time_step', 'aperture_crossing_duration'):
+        assert getattr(phase_screen, name) == getattr(reference_phase_screen, name)
+
+    # The screen keeps its position and moves with the new speed from there
+    assert phase_screen.total_aperture_shift == total_aperture_shift
+    phase_screen.move_phase_screen(0.01)
+    assert phase_screen.total_aperture_shift == total_aperture_shift + int(round(reference_phase_screen.grid_speed*0.01))